@@ -22,6 +22,9 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
+#
+# TEALPKG-PACKAGES: kernel-generic
+# TEALPKG-OPERATIONS: install upgrade
 
 if [[ "$1" == "install" || "$1" == "upgrade" ]]; then
     kver=$(grep '^kernel-generic ' "$2" | awk '{print $2}')
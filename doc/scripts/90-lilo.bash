@@ -21,6 +21,9 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
+#
+# TEALPKG-PACKAGES: kernel-generic kernel-huge
+# TEALPKG-OPERATIONS: install upgrade remove
 
 if grep -q '^kernel-generic ' "$2" || grep -q '^kernel-huge ' "$2"; then
     /sbin/lilo
@@ -0,0 +1,62 @@
+# Displays the phase timing report produced by --profile.
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+from tealpkg.util.size import friendly_size
+
+from .colorprint import cprint
+from .table import Table
+
+
+def print_profile(profiler):
+    table = Table(separator_style='separator')
+    table.add_column(width=30, spacing=2, proportional=True)
+    table.add_column(width=6, spacing=2, proportional=False)
+    table.add_column(width=10, spacing=2, proportional=False)
+    table.add_column(width=10, spacing=2, proportional=False)
+    table.add_column(width=12, spacing=0, proportional=False)
+
+    header = table.add_row()
+    header.add_column('PHASE', style='table_header', align='left')
+    header.add_column('CALLS', style='table_header', align='right')
+    header.add_column('WALL', style='table_header', align='right')
+    header.add_column('CPU', style='table_header', align='right')
+    header.add_column('PEAK MEMORY', style='table_header', align='right')
+    table.add_separator()
+
+    for phase in profiler.phases.values():
+        row = table.add_row()
+        row.add_column(phase.name, style='label', align='left')
+        row.add_column(str(phase.calls), style='table_data', align='right')
+        row.add_column('%.3f s' % phase.wall, style='table_data', align='right')
+        row.add_column('%.3f s' % phase.cpu, style='table_data', align='right')
+        row.add_column(friendly_size(phase.peak), style='table_data', align='right')
+    #
+
+    table.add_separator()
+    table.render()
+
+    if profiler.stats_path:
+        cprint()
+        cprint('cProfile statistics written to', profiler.stats_path, style='notice')
+    #
+#
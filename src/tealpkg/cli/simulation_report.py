@@ -0,0 +1,94 @@
+# Displays the report of a simulated (dry run) transaction.
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+from tealpkg.util.size import friendly_size
+
+from .colorprint import cprint
+from .table import Table
+
+
+def signed_size(size):
+    result = '+' + friendly_size(size)
+    if size < 0:
+        result = '-' + friendly_size(-size)
+    #
+    return result
+#
+
+
+def print_simulation(report):
+    cprint('Simulated', report.operation, 'of', report.packages, 'packages (no changes were made)', style='notice')
+    cprint()
+
+    table = Table(separator_style='table_separator')
+    table.add_column(width=24, spacing=2, proportional=False)
+    table.add_column(width=24, spacing=0, proportional=True)
+    rows = [ ('Files Added:', str(report.added)),
+             ('Files Replaced:', str(report.replaced)),
+             ('Files Removed:', str(report.removed)) ]
+    if report.operation != 'remove':
+        rows.insert(0, ('Estimated Download:', friendly_size(report.download_size) + ' (' + \
+                str(report.download_count) + ' packages)'))
+    #
+    for label, value in rows:
+        row = table.add_row()
+        row.add_column(label, style='info_label', align='left')
+        row.add_column(value, style='table_data', align='left')
+    #
+    table.render()
+    cprint()
+
+    if report.mount_delta:
+        table = Table(separator_style='separator')
+        table.add_column(width=30, spacing=2, proportional=True)
+        table.add_column(width=14, spacing=0, proportional=False)
+        header = table.add_row()
+        header.add_column('MOUNT POINT', style='table_header', align='left')
+        header.add_column('DISK USAGE', style='table_header', align='right')
+        table.add_separator()
+        for mount in sorted(report.mount_delta):
+            row = table.add_row()
+            row.add_column(mount, style='label', align='left')
+            row.add_column(signed_size(report.mount_delta[mount]), style='table_data', align='right')
+        #
+        table.add_separator()
+        table.render()
+        cprint()
+    #
+
+    if report.new_configs:
+        cprint('Configuration files that would need review:', style='warning')
+        for path in report.new_configs:
+            cprint('NEW:', path, style='warning')
+        #
+        cprint()
+    #
+
+    if report.missing_manifest:
+        cprint('No manifest file list available for:', ' '.join(report.missing_manifest), style='warning')
+    #
+
+    if report.scripts:
+        cprint('Scripts that would run:', ' '.join(report.scripts))
+    #
+#
@@ -20,10 +20,15 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+import os
 import sys
+import time
 
 from tealpkg.cli.colorprint import cprint, get_printer
+from tealpkg.cli.profile_report import print_profile
 from tealpkg.config import Configuration
+from tealpkg.util.metrics import get_metrics
+from tealpkg.util.profile import get_profiler
 
 from .command import dispatch
 from .interface import handle_arguments
@@ -31,10 +36,16 @@ from .interface import handle_arguments
 
 def main():
     status = 0
+    start = time.time()
     args = handle_arguments()
 
+    profiler = get_profiler()
+    if args.profile or args.profile_stats:
+        profiler.enable(args.profile_stats)
+    #
 
-    config = Configuration(args.config, args.enablerepo, args.disablerepo, args.force_expire, args.debug)
+    config = Configuration(args.config, args.enablerepo, args.disablerepo, args.force_expire, args.debug, \
+            args.reverify)
     printer = get_printer()
     printer.quiet = args.quiet
 
@@ -60,5 +71,23 @@ def main():
         #
     #
 
+    config.save_state()
+
+    metrics = get_metrics()
+    command = args.command if args.command else 'refresh'
+    metrics.set('tealpkg_last_run_timestamp_seconds', time.time(), 'Time at which the last run finished', \
+            command=command)
+    metrics.set('tealpkg_last_run_duration_seconds', time.time() - start, 'Duration of the last run', \
+            command=command)
+    metrics.set('tealpkg_last_run_status', status, 'Exit status of the last run', command=command)
+    metrics.write()
+
+    if profiler.enabled:
+        profiler.disable()
+        if args.profile:
+            print_profile(profiler)
+        #
+    #
+
     return status
 #
@@ -25,12 +25,15 @@ import os
 
 from .check_update import check_update
 from .clean import clean
+from .download import download
 from .info_list import info_list
 from .install import install
 from .provides import provides
 from .remove import remove
+from .repo_build import repo_build
 from .repolist import repolist
 from .search import search
+from .serve import serve
 from .sync import sync
 
 from tealpkg.cli.colorprint import cprint
@@ -39,13 +42,16 @@ from tealpkg.cli.colorprint import cprint
 COMMAND_MAP = {   # command: (function, needs_root)
         'check-update': (check_update, False),
         'clean': (clean, False),
+        'download': (download, True),
         'info': (info_list, False),
         'install': (install, True),
         'list': (info_list, False),
         'provides': (provides, False),
         'remove': (remove, True),
+        'repo-build': (repo_build, False),
         'repolist': (repolist, False),
         'search': (search, False),
+        'serve': (serve, False),
         'sync': (sync, True),
         'update': (sync, True),
         'upgrade': (sync, True),
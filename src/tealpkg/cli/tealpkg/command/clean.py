@@ -22,6 +22,7 @@
 
 
 from tealpkg.cli.colorprint import cprint
+from tealpkg.util.size import friendly_size
 
 
 def clean(args, config):
@@ -29,16 +30,41 @@ def clean(args, config):
     # TODO check that we have permissions to clean, then be sure to adjust status
     config.repo_force_enable = [ '*' ]  # cleaning works on all repositories, enabled or not
     config.load_repos()
-    clean_metadata = True
-    clean_packages = True
-    if args.clean_what == 'metadata':
-        clean_packages = False
-    elif args.clean_what == 'packages':
-        clean_metadata = False
+
+    if args.clean_what is None and not args.auto:
+        cprint('clean: specify what to clean, or --auto', style='error', stderr=True)
+        status = 2
+    elif not config.metadata_lock.acquire(exclusive=True):
+        # Wait for any refresh in progress to finish, and keep new refreshes out until cleaning is done
+        cprint('Could not acquire the metadata lock: is tealpkg already running?', style='error', stderr=True)
+        status = 1
+    elif args.clean_what:
+        clean_metadata = True
+        clean_packages = True
+        if args.clean_what == 'metadata':
+            clean_packages = False
+        elif args.clean_what == 'packages':
+            clean_metadata = False
+        #
+        for repo in config.repolist:
+            cprint('Cleaning repository', repo.repoid)
+            repo.clean(clean_metadata, clean_packages)
+        #
+
+        # Remove stored packages that are no longer linked from any repository
+        count, size = config.store.prune()
+        if count:
+            cprint('Removed', count, 'unused files (' + friendly_size(size) + ') from the content store')
+        #
     #
-    for repo in config.repolist:
-        cprint('Cleaning repository', repo.repoid)
-        repo.clean(clean_metadata, clean_packages)
+
+    if status == 0 and args.auto:
+        if config.cache_limit > 0:
+            count, size = config.enforce_cache_limit()
+            cprint('Evicted', count, 'packages (' + friendly_size(size) + ') from the package cache')
+        else:
+            cprint('No cache_limit is configured', style='warning', stderr=True)
+        #
     #
 
     return status
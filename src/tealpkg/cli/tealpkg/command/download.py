@@ -0,0 +1,75 @@
+# Implementation of the tealpkg "download" command
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import os
+
+from tealpkg.cli.colorprint import cprint, get_printer
+from tealpkg.core.search import Searcher
+from tealpkg.core.transaction import Transaction
+
+
+# Niceness increment for downloading, so that prefetching does not compete with other work on the host
+DOWNLOAD_NICENESS = 10
+
+
+def download(args, config):
+    status = 0
+    quiet = args.quiet or args.prefetch
+    get_printer().quiet = quiet
+    os.nice(DOWNLOAD_NICENESS)
+
+    if config.load_all():
+        searcher = Searcher(config.repolist, config.package_db, config.file_map, config.exclude_file, args.include, args.exclude)
+
+        if len(args.name) == 0:
+            packages = searcher.find_all_upgrades()
+        else:
+            # Only packages available from a repository can be downloaded, and installed packages only if they have
+            # an upgrade (local and SlackBuild packages are matched by the search, but have nothing available)
+            packages = {}
+            for name, pair in searcher.find_package(*args.name).items():
+                if pair.available and (pair.installed is None or pair.has_upgrade()):
+                    packages[name] = pair
+            #####
+        #
+
+        if len(packages) > 0:
+            transaction = Transaction(None, config.lockfile, None, args.dry_run, quiet, prompt=False, \
+                    verify_workers=config.gpg_workers)
+            status = transaction.download(packages)
+            if status == 0 and not args.dry_run:
+                cprint('Downloaded', len(packages), 'packages into the cache.')
+            #
+        elif len(args.name) == 0:
+            # Like sync, having nothing to download is not an error, so that prefetching can run quietly from cron
+            cprint('Already up to date.')
+        else:
+            cprint('No matching packages found for download.', style='error', stderr=True)
+            status = 1
+        #
+    else:
+        status = 1
+    #
+
+    return status
+#
@@ -28,7 +28,6 @@ from tealpkg.cli.colorprint import cprint
 from tealpkg.core.search import Searcher
 from tealpkg.core.transaction import Transaction
 from tealpkg.core.transaction.scripts import ScriptHandler
-from tealpkg.distro.slackware.pkgtools import Pkgtools
 from tealpkg.distro.slackware.tagfile import parse_tagfile
 
 
@@ -75,10 +74,16 @@ def install(args, config):
             #
 
             if status == 0 and len(package_pairs) > 0:
-                pkgtools = Pkgtools(config.installpkg, config.upgradepkg, config.removepkg, args.dry_run, args.quiet, config.log_pkgtools)
+                pkgtools = config.make_pkgtools(args.dry_run, args.quiet)
                 scripts = ScriptHandler(config.scripts, args.dry_run, args.quiet, config.log_scripts)
-                transaction = Transaction(pkgtools, config.lockfile, scripts, args.dry_run, args.quiet)
+                transaction = Transaction(pkgtools, config.lockfile, scripts, args.dry_run, args.quiet, \
+                        verify_workers=config.gpg_workers, stager=None if args.dry_run else config.make_stager(), \
+                        batch_size=config.batch_size, simulator=config.make_simulator() if args.dry_run else None, \
+                        preflight=config.make_preflight(), lock_timeout=config.lock_timeout)
                 status = transaction.install(package_pairs)
+                if config.cache_limit > 0 and not args.dry_run:
+                    config.enforce_cache_limit()
+                #
             #
         else:
             cprint('No matching packages found.', style='error', stderr=True)
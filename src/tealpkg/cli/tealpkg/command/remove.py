@@ -25,7 +25,6 @@ from tealpkg.cli.colorprint import cprint
 from tealpkg.core.search import Searcher
 from tealpkg.core.transaction import Transaction
 from tealpkg.core.transaction.scripts import ScriptHandler
-from tealpkg.distro.slackware.pkgtools import Pkgtools
 
 
 def remove(args, config):
@@ -35,9 +34,11 @@ def remove(args, config):
     searcher = Searcher([], config.package_db, config.file_map)
     packages = searcher.find_package(*args.name, installed=True, available=False)
     if len(packages) > 0:
-        pkgtools = Pkgtools(config.installpkg, config.upgradepkg, config.removepkg, args.dry_run, args.quiet, config.log_pkgtools)
+        pkgtools = config.make_pkgtools(args.dry_run, args.quiet)
         scripts = ScriptHandler(config.scripts, args.dry_run, args.quiet, config.log_scripts)
-        transaction = Transaction(pkgtools, config.lockfile, scripts, args.dry_run, args.quiet)
+        transaction = Transaction(pkgtools, config.lockfile, scripts, args.dry_run, args.quiet, \
+                batch_size=config.batch_size, simulator=config.make_simulator() if args.dry_run else None, \
+                lock_timeout=config.lock_timeout)
         status = transaction.remove(packages)
     else:
         cprint('No matching packages found.', style='error', stderr=True)
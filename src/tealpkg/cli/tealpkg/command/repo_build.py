@@ -0,0 +1,49 @@
+# Implementation of the tealpkg "repo-build" command
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+from tealpkg.cli.colorprint import cprint
+from tealpkg.distro.slackware.repo_build import RepoBuilder, RepoBuildError
+
+
+def repo_build(args, config):
+    status = 0
+    builder = RepoBuilder(args.directory, args.workers, args.sign, args.key, args.full)
+
+    def progress(done, total):
+        cprint('\rScanned', done, 'of', total, 'packages', end='', flush=True)
+        if done == total:
+            cprint()
+        #
+    #
+
+    try:
+        count = builder.build(progress)
+    except (OSError, RepoBuildError) as e:
+        cprint('Unable to build repository metadata:', e, style='error', stderr=True)
+        status = 1
+    else:
+        cprint('Wrote metadata for', count, 'packages in', args.directory)
+    #
+
+    return status
+#
@@ -0,0 +1,57 @@
+# Implementation of the tealpkg "serve" command
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+from tealpkg.cli.colorprint import cprint
+from tealpkg.net.cache_server import CacheServer
+from tealpkg.util.file_lock import FileLock
+
+
+def serve(args, config):
+    status = 0
+    config.load_repos()
+
+    if config.load_metadata():
+        # The server never waits for the metadata lock: if another process is refreshing, it serves the cached
+        # metadata and refreshes on a later request
+        lock = FileLock(config.metadata_lock.path, config.metadata_lock.name, 0)
+        try:
+            server = CacheServer( (args.bind, args.port), config.repolist, lock )
+        except OSError as e:
+            cprint('Unable to listen on', args.bind + ':' + str(args.port) + ':', e, style='error', stderr=True)
+            status = 1
+        else:
+            cprint('Serving', len(config.repolist), 'repositories on', args.bind + ':' + str(args.port))
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                cprint()
+            finally:
+                server.server_close()
+            #
+        #
+    else:
+        status = 1
+    #
+
+    return status
+#
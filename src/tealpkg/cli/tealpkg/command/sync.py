@@ -24,14 +24,70 @@
 from tealpkg.cli.colorprint import cprint
 from tealpkg.core.search import Searcher
 from tealpkg.core.transaction import Transaction
+from tealpkg.core.transaction.plan import PlanError, load_plan, save_plan
 from tealpkg.core.transaction.scripts import ScriptHandler
-from tealpkg.distro.slackware.pkgtools import Pkgtools
+
+
+def run_upgrade(args, config, packages):
+    pkgtools = config.make_pkgtools(args.dry_run, args.quiet)
+    scripts = ScriptHandler(config.scripts, args.dry_run, args.quiet, config.log_scripts)
+    transaction = Transaction(pkgtools, config.lockfile, scripts, args.dry_run, args.quiet, \
+            verify_workers=config.gpg_workers, stager=None if args.dry_run else config.make_stager(), \
+            batch_size=config.batch_size, simulator=config.make_simulator() if args.dry_run else None, \
+            preflight=config.make_preflight(), lock_timeout=config.lock_timeout)
+    status = transaction.upgrade(packages)
+    if config.cache_limit > 0 and not args.dry_run:
+        config.enforce_cache_limit()
+    #
+    return status
+#
+
+
+def apply_plan(args, config):
+    # Applies a plan written by sync --plan-out, without loading (or refreshing) the repository metadata
+    status = 0
+    config.load_package_db()
+    config.load_repos()
+
+    try:
+        packages = load_plan(args.plan_in, config.repolist, config.package_db)
+    except (OSError, PlanError) as e:
+        cprint('Unable to load plan:', e, style='error', stderr=True)
+        status = 1
+    else:
+        # The plan does not override the packages excluded on this host
+        searcher = Searcher(config.repolist, config.package_db, config.file_map, config.exclude_file, args.include, \
+                args.exclude)
+        for name in sorted(packages):
+            if not searcher.is_included(name):
+                cprint('Skipping excluded package', name, style='warning', stderr=True)
+                del packages[name]
+        #####
+
+        if len(packages) > 0:
+            if args.dry_run:
+                cprint('Warning: repository metadata are not loaded when applying a plan, so file changes cannot be', \
+                        'simulated', style='warning', stderr=True)
+            #
+            status = run_upgrade(args, config, packages)
+        else:
+            cprint('Already up to date.')
+        #
+    #
+
+    return status
+#
 
 
 def sync(args, config):
     status = 0
 
-    if config.load_all():
+    if args.plan_in and len(args.name) > 0:
+        cprint('sync: package names cannot be combined with --plan-in', style='error', stderr=True)
+        status = 2
+    elif args.plan_in:
+        status = apply_plan(args, config)
+    elif config.load_all():
         searcher = Searcher(config.repolist, config.package_db, config.file_map, config.exclude_file, args.include, args.exclude)
 
         query = args.name
@@ -40,11 +96,18 @@ def sync(args, config):
         #
 
         packages = searcher.find_package(*query, only_upgrades=True)
-        if len(packages) > 0:
-            pkgtools = Pkgtools(config.installpkg, config.upgradepkg, config.removepkg, args.dry_run, args.quiet, config.log_pkgtools)
-            scripts = ScriptHandler(config.scripts, args.dry_run, args.quiet, config.log_scripts)
-            transaction = Transaction(pkgtools, config.lockfile, scripts, args.dry_run, args.quiet)
-            status = transaction.upgrade(packages)
+        if args.plan_out:
+            # Only record the plan: the system is left unchanged
+            try:
+                save_plan(args.plan_out, packages)
+            except (OSError, PlanError) as e:
+                cprint('Unable to write plan:', e, style='error', stderr=True)
+                status = 1
+            else:
+                cprint('Wrote a plan for', len(packages), 'packages to', args.plan_out)
+            #
+        elif len(packages) > 0:
+            status = run_upgrade(args, config, packages)
         else:
             if len(args.name) == 0:
                 # Running tealpkg sync by itself is not an error if no updates are available. This way, it can be run with
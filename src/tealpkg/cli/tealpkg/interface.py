@@ -42,6 +42,9 @@ def handle_arguments():
     ap.add_argument('--enablerepo', action='extend', default=[], nargs=1, help='Enables a repository')
     ap.add_argument('--disablerepo', action='extend', default=[], nargs=1, help='Disables a repository')
     ap.add_argument('--refresh', action='store_const', dest='force_expire', const=0, default=-1, help='Force metadata update')
+    ap.add_argument('--reverify', action='store_true', help='Verify GPG signatures of cached files again')
+    ap.add_argument('--profile', action='store_true', help='Report time and peak memory used by each phase')
+    ap.add_argument('--profile-stats', action='store', dest='profile_stats', help='Write cProfile statistics to a file')
 
     # The -V|--version isn't actually handled by the argument parser, since the multicall dispatch
     # code takes care of it first. However, include it here to document the option in the user
@@ -54,7 +57,12 @@ def handle_arguments():
     parser_check_update = subparsers.add_parser('check-update', help='Checks for updates')
 
     parser_clean = subparsers.add_parser('clean', help='Removes downloaded files')
-    parser_clean.add_argument('clean_what', choices=['all', 'metadata', 'packages'], help='Select items to clean')
+    parser_clean.add_argument('--auto', action='store_true', help='Evict least recently used packages down to cache_limit')
+    parser_clean.add_argument('clean_what', nargs='?', choices=['all', 'metadata', 'packages'], help='Select items to clean')
+
+    parser_download = subparsers.add_parser('download', help='Downloads packages into the cache without installing them')
+    parser_download.add_argument('--prefetch', action='store_true', help='Suppress output for use from cron (implies -q)')
+    parser_download.add_argument('name', nargs='*', help='Name of package to download (default: all upgrades)')
 
     parser_info = subparsers.add_parser('info', help='Displays package information')
     parser_info_group = parser_info.add_mutually_exclusive_group()
@@ -94,6 +102,14 @@ def handle_arguments():
     parser_remove = subparsers.add_parser('remove', help='Removes installed packages')
     parser_remove.add_argument('name', nargs='+', help='Name of package to remove')
 
+    parser_repo_build = subparsers.add_parser('repo-build', help='Generates repository metadata for a package tree')
+    parser_repo_build.add_argument('--full', action='store_true', help='Rescan all packages, ignoring the cache')
+    parser_repo_build.add_argument('--key', action='store', help='ID of the GPG key used with --sign')
+    parser_repo_build.add_argument('--sign', action='store_true', help='Sign the metadata and unsigned packages with gpg')
+    parser_repo_build.add_argument('--workers', action='store', type=int, default=0, \
+            help='Number of worker processes (default: one per CPU)')
+    parser_repo_build.add_argument('directory', help='Root directory of the package tree')
+
     parser_repolist = subparsers.add_parser('repolist', help='Lists enabled repositories')
     pr_group = parser_repolist.add_mutually_exclusive_group()
     pr_group.add_argument('--enabled', action='store_const', const='enabled', dest='repolist_what', help='enabled repositories')
@@ -103,6 +119,10 @@ def handle_arguments():
     parser_search = subparsers.add_parser('search', help='Searches for packages')
     parser_search.add_argument('query', nargs='+', help='Search query')
 
+    parser_serve = subparsers.add_parser('serve', help='Serves the package cache as a mirror over HTTP')
+    parser_serve.add_argument('--bind', action='store', default='0.0.0.0', help='Address on which to listen')
+    parser_serve.add_argument('--port', action='store', type=int, default=8080, help='Port on which to listen')
+
     parser_sync = subparsers.add_parser('sync', help='Synchronize installed packages')
     parser_sync.add_argument('name', nargs='*', help='Name of package to synchronize')
 
@@ -112,6 +132,14 @@ def handle_arguments():
     parser_upgrade = subparsers.add_parser('upgrade', help='Alias for sync')
     parser_upgrade.add_argument('name', nargs='*', help='Name of package to synchronize')
 
+    # sync and its aliases can record the resolved upgrades in a plan, or apply a plan recorded elsewhere
+    for parser in (parser_sync, parser_update, parser_upgrade):
+        parser_plan_group = parser.add_mutually_exclusive_group()
+        parser_plan_group.add_argument('--plan-in', action='store', help='Apply the upgrades recorded in a plan file')
+        parser_plan_group.add_argument('--plan-out', action='store', \
+                help='Record the upgrades in a plan file instead of applying them')
+    #
+
     parser_whatprovides = subparsers.add_parser('whatprovides', help='Alias for provides')
     parser_whatprovides.add_argument('file', nargs='+', help='File to search')
 
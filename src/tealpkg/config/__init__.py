@@ -30,27 +30,54 @@ import os
 import pathlib
 import re
 import tempfile
+import time
 
 from urllib.parse import urlparse, urlunparse
 
 from tealpkg.cli.colorprint import clear_status, cprint, get_printer, write_status
+from tealpkg.core.cache import CacheManager
+from tealpkg.core.transaction.preflight import Preflight
+from tealpkg.core.transaction.simulator import Simulator
+from tealpkg.core.transaction.stager import Stager
+from tealpkg.distro.slackware.native_pkgtools import NativePkgtools
 from tealpkg.distro.slackware.package_db import load_package_db
+from tealpkg.distro.slackware.pkgtools import Pkgtools
+from tealpkg.net.content_store import ContentStore
 from tealpkg.util.compute_time import compute_time
+from tealpkg.util.file_lock import FileLock
+from tealpkg.util.metrics import get_metrics
+from tealpkg.util.profile import profile_span
+from tealpkg.util.size import parse_size
 
 from .repository import Repository
 
 
 class Configuration:
-    def __init__(self, config_file, force_enable=[], force_disable=[], force_expire=-1, debug=False):
+    def __init__(self, config_file, force_enable=[], force_disable=[], force_expire=-1, debug=False, reverify=False):
         preload = { 'CWD': pathlib.Path.cwd().as_posix(), 'HOME': pathlib.Path.home().as_posix(), 'TMP': tempfile.gettempdir() }
         self.parser = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
         self.parser.read_dict({'path': preload})
-        self.parser.read(config_file)
+        with profile_span('configuration'):
+            self.parser.read(config_file)
+        #
 
         self.scripts = self.parser.get('path', 'scripts', fallback='/etc/tealpkg/scripts')
         self.log_scripts = self.parser.getboolean('settings', 'log_scripts', fallback=False)
         self.log_pkgtools = self.parser.getboolean('settings', 'log_pkgtools', fallback=False)
 
+        # Number of worker threads verifying package signatures (0 for one per CPU)
+        self.gpg_workers = self.parser.getint('settings', 'gpg_workers', fallback=0)
+
+        # Order mirrors by their measured performance instead of the order in the mirror list
+        self.adaptive_mirrors = self.parser.getboolean('settings', 'adaptive_mirrors', fallback=True)
+
+        # Packages at least segment_threshold in size are downloaded in parallel ranges from up to segments mirrors
+        self.segment_threshold = parse_size(self.parser.get('settings', 'segment_threshold', fallback='0'))
+        self.segments = self.parser.getint('settings', 'segments', fallback=4)
+
+        # Number of times an interrupted or failed download is retried (resuming where it stopped)
+        self.download_retries = self.parser.getint('settings', 'download_retries', fallback=3)
+
         loglevel = logging.INFO
         if debug:
             loglevel = logging.DEBUG
@@ -71,10 +98,16 @@ class Configuration:
         #
         pathlib.PosixPath(self.gpg_keys).mkdir(mode=0o755, parents=True, exist_ok=True)
 
+        # Persistent keyring shared by all repositories (gpg insists on a private home directory)
+        keyring = pathlib.PosixPath(self.gpg_keys).joinpath('keyring')
+        keyring.mkdir(mode=0o700, exist_ok=True)
+        keyring.chmod(0o700)
+
         self.repobase = self.parser.get('path', 'repositories', fallback='/etc/tealpkg/repos')
         self.repo_force_enable = force_enable
         self.repo_force_disable = force_disable
         self.repo_force_expire = force_expire
+        self.reverify = reverify
         self.repolist = []
         self.disabled_repos = []
 
@@ -84,9 +117,33 @@ class Configuration:
         #
         pathlib.PosixPath(self.cache_dir).mkdir(mode=0o755, parents=True, exist_ok=True)
 
+        # Packages are stored once by MD5 digest and hard linked into each repository cache directory
+        self.store = ContentStore(pathlib.PosixPath(self.cache_dir).joinpath('__store__'))
+
+        # Maximum size of the cached packages, enforced by evicting the least recently used (0 for no limit)
+        self.cache_limit = parse_size(self.parser.get('settings', 'cache_limit', fallback='0'))
+
+        # Packages are decompressed ahead of the native backend into staging_dir (preferably a tmpfs), keeping at most
+        # staging_limit of uncompressed packages staged at once (0 for no limit). Staging is disabled if unset, and is
+        # not used with the pkgtools backend, whose commands do not accept uncompressed packages.
+        self.staging_dir = self.parser.get('settings', 'staging_dir', fallback='')
+        self.staging_limit = parse_size(self.parser.get('settings', 'staging_limit', fallback='1G'))
+        self.staging_workers = self.parser.getint('settings', 'staging_workers', fallback=0)
+
+        # Check the free space on each file system before a transaction: refuse (to start it when short of space),
+        # warn, or no. space_reserve is the space that must remain free.
+        self.space_check = self.parser.get('settings', 'space_check', fallback='refuse')
+        self.space_reserve = parse_size(self.parser.get('settings', 'space_reserve', fallback='64M'))
+
         self.package_db = {}
         self.file_map = {}
 
+        # Package tools backend: pkgtools (run the commands below) or native (install packages in-process)
+        self.backend = self.parser.get('settings', 'backend', fallback='pkgtools')
+
+        # Number of packages passed to each upgradepkg or removepkg command (1 to run one command per package)
+        self.batch_size = self.parser.getint('settings', 'batch_size', fallback=1)
+
         self.installpkg = self.parser.get('command', 'installpkg', fallback='/sbin/upgradepkg --install-new --reinstall')
         self.upgradepkg = self.parser.get('command', 'upgradepkg', fallback='/sbin/upgradepkg')
         self.removepkg = self.parser.get('command', 'removepkg', fallback='/sbin/removepkg')
@@ -130,10 +187,22 @@ class Configuration:
         #
 
         self.lockfile = self.parser.get('path', 'transaction_lock', fallback='/run/lock/tealpkg')
+
+        # Seconds to wait for a lock held by another tealpkg process (0 to fail at once, negative to wait forever)
+        self.lock_timeout = self.parser.getint('settings', 'lock_timeout', fallback=300)
+
+        # Refreshing or cleaning the metadata requires this lock exclusively (readers do not take it)
+        self.metadata_lock = FileLock(pathlib.PosixPath(self.cache_dir).joinpath('.metadata.lock').as_posix(), \
+                'metadata', self.lock_timeout)
+
+        get_metrics().enable(self.parser.get('path', 'metrics_textfile', fallback=None), \
+                self.parser.get('path', 'metrics_json', fallback=None))
     #
     def load_package_db(self):
         write_status('Loading package database...', style='loadstatus')
-        self.package_db, self.file_map = load_package_db(self.parser['path']['package_db'])
+        with profile_span('load_package_db'):
+            self.package_db, self.file_map = load_package_db(self.parser['path']['package_db'])
+        #
         clear_status()
     #
     def load_repos(self):
@@ -145,7 +214,9 @@ class Configuration:
             self.log.debug('Reading repository configuration %s', path.as_posix())
             parser = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
             parser.read_dict({'repo': preload})
-            parser.read(path)
+            with profile_span('configuration'):
+                parser.read(path)
+            #
 
             repoid = parser['repo']['id']
             name = parser['repo']['name']
@@ -196,9 +267,10 @@ class Configuration:
 
             # Mirror list
             mirrorlist = []
+            subdirectory = parser.get('repo', 'subdirectory', fallback='')
             for mirror in mirrors:
                 tup = urlparse(mirror)
-                mirror_path = pathlib.PurePosixPath(tup.path).joinpath(parser.get('repo', 'subdirectory', fallback=''))
+                mirror_path = pathlib.PurePosixPath(tup.path).joinpath(subdirectory)
                 mirrorlist.append(urlunparse( ( tup.scheme, tup.netloc, mirror_path.as_posix(), tup.params, tup.query, tup.fragment) ))
             #
             self.log.debug('Mirrorlist: %s', mirrorlist)
@@ -233,7 +305,9 @@ class Configuration:
             #
 
             repo = Repository(self.cache_dir, repoid, name, mirrorlist, manifest, self.gpg_keys, gpg_url, gpg_fp, \
-                              enabled, priority, expire, extract_groups, strip_path, max_age)
+                              enabled, priority, expire, extract_groups, strip_path, max_age, self.reverify, \
+                              self.adaptive_mirrors, self.segment_threshold, self.segments, \
+                              self.download_retries, subdirectory, self.store)
             #
 
             if enabled:
@@ -251,11 +325,36 @@ class Configuration:
     def load_metadata(self):
         result = True
 
+        # Queries read the published metadata generations without taking the lock, since a published generation is
+        # never modified, so they never wait for a refresh. The lock is only held exclusively while a repository
+        # builds and publishes a new generation, so that two processes never refresh the same repository at once.
+        # If the lock cannot be obtained, the metadata already cached are used, even if they have expired.
+        lock_available = True
         for repo in self.repolist:
             write_status('Loading repository metadata for ' + repo.name + '...', style='loadstatus')
             self.log.debug('Loading metadata for repository: %s', repo.repoid)
+            start = time.monotonic()
             repo.load_gpg()
-            check = repo.load_metadata()
+
+            refresh = lock_available and repo.needs_refresh()
+            if refresh and not self.metadata_lock.acquire(exclusive=True):
+                cprint('Unable to obtain the metadata lock: using cached metadata', style='warning', stderr=True)
+                lock_available = False
+                refresh = False
+            #
+            try:
+                check = repo.load_metadata(allow_refresh=refresh)
+            finally:
+                if refresh:
+                    self.metadata_lock.release()
+                #
+            #
+
+            metrics = get_metrics()
+            metrics.set('tealpkg_metadata_load_seconds', time.monotonic() - start, \
+                    'Time taken to load (and refresh, if expired) repository metadata', repo=repo.repoid)
+            metrics.set('tealpkg_metadata_load_success', 1 if check else 0, \
+                    'Whether repository metadata loaded successfully', repo=repo.repoid)
             if not check:
                 cprint('Failed to load metadata for repository', repo.repoid, style='error', stderr=True)
                 self.log.error('Failed to load metadata for repository %s', repo.repoid)
@@ -266,6 +365,52 @@ class Configuration:
 
         return result
     #
+    def make_pkgtools(self, dry_run=False, quiet=False):
+        result = None
+        if self.backend == 'native':
+            adm_dir = pathlib.PosixPath(self.parser['path']['package_db']).parent
+            result = NativePkgtools(adm_dir, '/', dry_run, quiet, self.log_pkgtools)
+        else:
+            if self.backend != 'pkgtools':
+                self.log.warning('Unknown backend %s: using pkgtools', self.backend)
+            #
+            result = Pkgtools(self.installpkg, self.upgradepkg, self.removepkg, dry_run, quiet, self.log_pkgtools, \
+                              self.parser.get('path', 'package_db', fallback=None))
+        #
+        return result
+    #
+    def make_preflight(self):
+        result = None
+        if self.space_check in ('refuse', 'warn'):
+            result = Preflight(self.repolist, self.cache_dir, self.space_reserve, self.space_check == 'refuse')
+        #
+        return result
+    #
+    def make_simulator(self):
+        return Simulator(self.repolist, self.file_map)
+    #
+    def make_stager(self):
+        result = None
+        if self.staging_dir:
+            if self.backend == 'native':
+                result = Stager(self.staging_dir, self.staging_workers, self.staging_limit)
+            else:
+                self.log.warning('staging_dir is only used with the native backend: not staging packages')
+            #
+        #
+        return result
+    #
+    def enforce_cache_limit(self):
+        # Uses all repositories, enabled or not, since disabled repositories may still have cached packages
+        repos = self.repolist + self.disabled_repos
+        manager = CacheManager(self.cache_dir, repos, self.parser['path']['package_db'], self.cache_limit)
+        return manager.enforce()
+    #
+    def save_state(self):
+        for repo in self.repolist:
+            repo.save_state()
+        #
+    #
     def load_all(self):
         self.load_package_db()
         self.load_repos()
@@ -25,8 +25,10 @@
 
 import fnmatch
 import logging
+import os
 import pathlib
-import pickle
+import shutil
+import sqlite3
 import time
 
 from urllib.parse import urlparse, urlunparse
@@ -34,15 +36,21 @@ from urllib.parse import urlparse, urlunparse
 from tealpkg.cli.colorprint import cprint
 from tealpkg.distro.slackware.parse_manifest import parse_manifest
 from tealpkg.distro.slackware.parse_packages import parse_packages
-from tealpkg.distro.slackware.verify_checksum import verify_checksum
+from tealpkg.distro.slackware.verify_checksum import load_checksums
 from tealpkg.net.downloader import Downloader
 from tealpkg.net.file_path import FilePath
 from tealpkg.net.gpg_verify import GPGVerifier
+from tealpkg.net.mirror_stats import MirrorStats
+from tealpkg.net.verify_cache import DigestCache, VerificationCache
+from tealpkg.util.atomic_write import atomic_write
+from tealpkg.util.generations import Generations
+from tealpkg.util.profile import profile_span
 
 
 class Repository:
     def __init__(self, cache_dir, repoid, name, mirrorlist, manifest_path, gpg_path=None, gpg_url=None, gpg_fp=None,
-            enabled=False, priority=99, expire=3600, extract_groups=False, strip_path=0, max_age=0):
+            enabled=False, priority=99, expire=3600, extract_groups=False, strip_path=0, max_age=0, reverify=False,
+            adaptive_mirrors=True, segment_threshold=0, segments=1, retries=3, subdirectory='', store=None):
         cache_path = pathlib.PosixPath(cache_dir).joinpath(repoid)
         cache_path.mkdir(mode=0o755, parents=True, exist_ok=True)
         self.cache_dir = cache_path.as_posix()
@@ -59,55 +67,115 @@ class Repository:
         self.extract_groups = extract_groups
         self.strip_path = strip_path
         self.max_age = max_age
+        self.reverify = reverify
+        self.subdirectory = subdirectory
+        self.segment_threshold = segment_threshold
+        self.segments = segments
+        self.retries = retries
+        self.store = store
+        self.digests = DigestCache(cache_path.joinpath('__digests__.json'))
 
         self.log = logging.getLogger(__name__)
         self.gpg = None
-        self.downloader = Downloader()
+        self.downloader = self.make_downloader()
+
+        self.mirror_stats = None
+        if adaptive_mirrors:
+            self.mirror_stats = MirrorStats(cache_path.joinpath('__mirrors__.json'))
+        #
+
+        # Metadata are kept in immutable generations under metadata/, and this object reads from the generation that
+        # was published when its metadata were loaded, even if a newer one is published in the meantime
+        self.generations = Generations(cache_path.joinpath('metadata'))
+        self.metadata_dir = None
 
         self.timestamp = 0
+        self.checksums = {}
         self.packages = {}
-        self.manifest = {}
-        self.file_map = {}
+        self.manifest_db = None
         self.groups = {}
     #
+    def make_downloader(self, quiet=False):
+        return Downloader(self.repoid, self.segment_threshold, self.segments, self.retries, quiet)
+    #
     def __repr__(self):
         return '<Repository ' + self.repoid + ' priority ' + str(self.priority) + ' expire ' + str(self.expire) + '>'
     #
-    def mtime(self, filename):
+    def mtime(self, filename, directory=None):
         result = 0
-        path = pathlib.PosixPath(self.cache_dir).joinpath(filename)
-        if path.exists():
-            result = path.stat().st_mtime
+        if directory is None:
+            directory = self.metadata_dir or self.generations.current()
+        #
+        if directory:
+            path = pathlib.PosixPath(directory).joinpath(filename)
+            if path.exists():
+                result = path.stat().st_mtime
+        #####
+        return result
+    #
+    def needs_refresh(self):
+        # True if load_metadata() would need to build a new metadata generation. The age of a generation is that of
+        # its directory, since the metadata files themselves are not copied from local mirrors.
+        current = self.generations.current()
+        result = current is None or not current.joinpath('__manifest__.db').exists()
+        if not result and self.expire >= 0 and (time.time() - current.stat().st_mtime) > self.expire:
+            result = True
         #
         return result
     #
     def load_gpg(self):
         if self.gpg_fp:
-            mirrorlist = self.mirrorlist
-            relpath = './GPG-KEY'
-            if self.gpg_url:
-                parts = urlparse(self.gpg_url)
-                path = pathlib.PurePosixPath(parts.path)
-                url = urlunparse( (parts.scheme, parts.netloc, path.parent.as_posix(), parts.params, parts.query, parts.fragment) )
-                mirrorlist = [ url ]
-                relpath = './' + path.name
+            with profile_span('gpg key import'):
+                keyring = pathlib.PosixPath(self.gpg_path).joinpath('keyring').as_posix()
+                cache = VerificationCache(pathlib.PosixPath(self.cache_dir).joinpath('__verified__.json'), self.gpg_fp, \
+                        self.reverify)
+                self.gpg = GPGVerifier(keyring, self.gpg_fp, cache)
+
+                # The key only needs to be downloaded the first time, or if the pinned fingerprint changes
+                if not self.gpg.have_key:
+                    mirrorlist = self.mirrorlist
+                    relpath = './GPG-KEY'
+                    if self.gpg_url:
+                        parts = urlparse(self.gpg_url)
+                        path = pathlib.PurePosixPath(parts.path)
+                        url = urlunparse( (parts.scheme, parts.netloc, path.parent.as_posix(), parts.params, parts.query, parts.fragment) )
+                        mirrorlist = [ url ]
+                        relpath = './' + path.name
+                    #
+                    resolved = FilePath(mirrorlist, relpath, self.gpg_path, None, self.downloader, verify=False, \
+                            quiet=True, filename=self.repoid).resolve()
+                    self.gpg.import_key(resolved)
+                #
             #
-            resolved = FilePath(mirrorlist, relpath, self.gpg_path, None, self.downloader, verify=False, quiet=True, \
-                    filename=self.repoid).resolve()
-            self.gpg = GPGVerifier(resolved, self.gpg_fp)
         else:
             cprint('WARNING: GPG verification disabled for ' + self.repoid + ' (' + self.name + ')', style='warning', stderr=True)
         #
     #
+    def save_state(self):
+        if self.gpg and self.gpg.cache:
+            self.gpg.cache.save()
+        #
+        if self.mirror_stats:
+            self.mirror_stats.save()
+        #
+        self.digests.save()
+    #
+    def remove_flat_metadata(self):
+        # Removes metadata files left directly in the cache directory by versions that did not keep generations
+        cache = pathlib.PosixPath(self.cache_dir)
+        for item in ('CHECKSUMS.md5', 'CHECKSUMS.md5.asc', 'MANIFEST.bz2', 'PACKAGES.TXT', '__manifest__.db'):
+            cache.joinpath(item).unlink(missing_ok=True)
+        #
+    #
     def clean(self, metadata, packages):
         cache = pathlib.PosixPath(self.cache_dir)
 
         if metadata:
-            for item in ('CHECKSUMS.md5', 'CHECKSUMS.md5.asc', 'MANIFEST.bz2', 'PACKAGES.TXT', '__filemap__.pickle',
-                    '__manifest__.pickle'):
-                # Leave the __timestamp__ to provide anti-rollback protection
-                cache.joinpath(item).unlink(missing_ok=True)
-        #####
+            # Leave the __timestamp__ to provide anti-rollback protection (and __mirrors__.json, which holds mirror
+            # statistics rather than metadata)
+            shutil.rmtree(self.generations.base, ignore_errors=True)
+            self.remove_flat_metadata()
+        #
 
         if packages:
             for item in cache.glob('*.t?z'):
@@ -116,20 +184,87 @@ class Repository:
             for item in cache.glob('*.t?z.asc'):
                 item.unlink(missing_ok=True)
             #
+            for item in cache.glob('*.part'):
+                item.unlink(missing_ok=True)
+            #
         #
     #
-    def load_metadata(self):
+    def load_metadata(self, allow_refresh=True):
         result = True
 
-        manifest_mod = self.mtime('MANIFEST.bz2')
+        # A refresh builds a new generation (starting from links to the files in the published one), which is only
+        # published once it is complete and verified. Otherwise, the published generation is used as it is. Callers
+        # that do not hold the metadata lock exclusively pass allow_refresh=False, in which case metadata that have
+        # expired since the caller checked are used as they are, unless there is no complete generation to use. A
+        # generation is then built and published, but old generations are left for a refresh under the lock.
+        refresh = self.needs_refresh()
+        current = self.generations.current()
+        if refresh and not allow_refresh and current and current.joinpath('__manifest__.db').exists():
+            self.log.debug('Using expired metadata for %s without the exclusive metadata lock', self.repoid)
+            refresh = False
+        #
+        if refresh:
+            work = self.generations.create()
+            expire = self.expire
+        else:
+            work = current
+            expire = -1
+        #
+        work_dir = work.as_posix()
+
+        manifest_mod = self.mtime('MANIFEST.bz2', work)
 
-        checksums = FilePath(self.mirrorlist, './CHECKSUMS.md5', self.cache_dir, self.gpg, self.downloader, \
-                quiet=True).resolve(self.expire)
-        packages = FilePath(self.mirrorlist, './PACKAGES.TXT', self.cache_dir, self.gpg, self.downloader, \
-                verify=False, quiet=True).resolve(self.expire)
         manifest_relpath = './' + self.manifest_path
-        manifest = FilePath(self.mirrorlist, manifest_relpath, self.cache_dir, self.gpg, self.downloader, \
-                verify=False, quiet=True).resolve(self.expire)
+        packages = None
+        manifest = None
+        with profile_span('metadata download (' + self.repoid + ')'):
+            previous = {}
+            if refresh and work.joinpath('CHECKSUMS.md5').exists():
+                previous = load_checksums(work.joinpath('CHECKSUMS.md5').as_posix())
+            #
+
+            # All the metadata files are obtained from a single mirror, so that files from mirrors that are out of
+            # sync are never mixed, and a checksum mismatch is charged to the mirror that served both files. If the
+            # mirror fails, whatever it served is dropped, and the whole set is obtained from the next mirror.
+            mirrors = self.mirror_stats.rank(self.mirrorlist) if self.mirror_stats else self.mirrorlist
+            for mirror in mirrors:
+                packages = None
+                manifest = None
+                checksums = FilePath([ mirror ], './CHECKSUMS.md5', work_dir, self.gpg, self.downloader, \
+                        quiet=True, stats=self.mirror_stats).resolve(expire)
+                self.checksums = load_checksums(checksums) if checksums else {}
+
+                # PACKAGES.TXT and the manifest are pinned by CHECKSUMS.md5, so they never expire by age. The copies
+                # linked from the previous generation are kept if their checksums are unchanged, and are otherwise
+                # dropped, so that the new versions are downloaded (and checked against CHECKSUMS.md5).
+                packages_md5 = self.checksums.get('./PACKAGES.TXT')
+                manifest_md5 = self.checksums.get(manifest_relpath)
+                if packages_md5 and manifest_md5:
+                    if refresh:
+                        for relpath, checksum in ( ('./PACKAGES.TXT', packages_md5), (manifest_relpath, manifest_md5) ):
+                            if previous.get(relpath) != checksum:
+                                work.joinpath(pathlib.PurePosixPath(relpath).name).unlink(missing_ok=True)
+                    #####
+
+                    packages_fp = FilePath([ mirror ], './PACKAGES.TXT', work_dir, self.gpg, self.downloader, \
+                            verify=False, quiet=True, checksum=packages_md5, stats=self.mirror_stats, \
+                            digests=self.digests)
+                    packages = packages_fp.resolve()
+                    if packages:
+                        manifest = FilePath([ mirror ], manifest_relpath, work_dir, self.gpg, self.downloader, \
+                                verify=False, quiet=True, checksum=manifest_md5, stats=self.mirror_stats, \
+                                digests=self.digests).resolve()
+                #####
+
+                if checksums and packages and manifest:
+                    break
+                #
+                if refresh:
+                    for item in ('CHECKSUMS.md5', 'CHECKSUMS.md5.asc', 'PACKAGES.TXT', \
+                            pathlib.PurePosixPath(manifest_relpath).name):
+                        work.joinpath(item).unlink(missing_ok=True)
+            #########
+        #
 
         self.log.debug('CHECKSUMS.md5: %s', checksums)
         self.log.debug('PACKAGES.TXT: %s', packages)
@@ -146,78 +281,150 @@ class Repository:
 
         # TODO log below here
         if checksums and packages and manifest:
-            if verify_checksum(checksums, packages, './PACKAGES.TXT'):
-                if verify_checksum(checksums, manifest, manifest_relpath):
-                    new_packages, timestamp = parse_packages(packages, self.repoid, self.extract_groups, self.strip_path)
-
-                    if timestamp < last_stamp:
-                        cprint('Repository rollback detected for', self.repoid, style='warning', stderr=True)
-                        result = False
-                    elif self.max_age > 0 and (time.time() - timestamp) > self.max_age:
-                        cprint('Outdated mirror detected for', self.repoid, style='warning', stderr=True)
-                        result = False
-                    else:
-                        self.packages = new_packages
-
-                        mj_path = pathlib.PosixPath(self.cache_dir).joinpath('__manifest__.pickle')
-                        fm_path = pathlib.PosixPath(self.cache_dir).joinpath('__filemap__.pickle')
-
-                        if self.mtime('MANIFEST.bz2') != manifest_mod or not mj_path.exists() or not fm_path.exists():
-                            self.manifest, self.file_map = parse_manifest(manifest)
-                            with open(mj_path, 'wb') as fh:
-                                pickle.dump(self.manifest, fh)
-                            #
-                            with open(fm_path, 'wb') as fh:
-                                pickle.dump(self.file_map, fh)
-                            #
-                        else:
-                            with open(mj_path, 'rb') as fh:
-                                self.manifest = pickle.load(fh)
-                            #
-                            with open(fm_path, 'rb') as fh:
-                                self.file_map = pickle.load(fh)
-                            #
-                        #
-
-                        # Load package file lists from the manifest
-                        for name in self.manifest:
-                            if name in self.packages:
-                                for path in sorted(self.manifest[name]):
-                                    self.packages[name].files.append(path)
-                                #
-                        #####
-
-                        if timestamp != last_stamp:
-                            with open(stamp_path, 'w') as fh:
-                                fh.write(str(timestamp) + '\n')
-                            #
-                        #
-
-                        if self.extract_groups:
-                            for pkg in self.packages:
-                                group = self.packages[pkg].group
-                                if group:
-                                    if group in self.groups:
-                                        self.groups[group].append(pkg)
-                                    else:
-                                        self.groups[group] = [ pkg ]
-                        #############
-                    #
-                else:
-                    cprint('MANIFEST.bz2 checksum verification failed for', self.repoid, style='error', stderr=True)
-                    result = False
+            with profile_span('packages parsing'):
+                new_packages, timestamp = parse_packages(packages, self.repoid, self.extract_groups, self.strip_path)
+            #
+
+            # Track how current each mirror is, so that mirrors serving outdated metadata are ranked lower
+            if self.mirror_stats and packages_fp.downloaded:
+                self.mirror_stats.record_timestamp(packages_fp.mirror, timestamp)
+                if timestamp < last_stamp or (self.max_age > 0 and (time.time() - timestamp) > self.max_age):
+                    self.mirror_stats.record(packages_fp.mirror, False)
                 #
-            else:
-                cprint('PACKAGES.TXT checksum verification failed for', self.repoid, style='error', stderr=True)
+            #
+
+            if timestamp < last_stamp:
+                cprint('Repository rollback detected for', self.repoid, style='warning', stderr=True)
                 result = False
+            elif self.max_age > 0 and (time.time() - timestamp) > self.max_age:
+                cprint('Outdated mirror detected for', self.repoid, style='warning', stderr=True)
+                result = False
+            else:
+                self.packages = new_packages
+
+                # The manifest is parsed into an SQLite database (built under a temporary name, so that an
+                # interrupted parse is never mistaken for a complete one), which is kept until the manifest changes
+                db_path = work.joinpath('__manifest__.db')
+                with profile_span('manifest parsing'):
+                    if self.mtime('MANIFEST.bz2', work) != manifest_mod or not db_path.exists():
+                        temp_path = db_path.with_name(db_path.name + '.tmp')
+                        parse_manifest(manifest, temp_path.as_posix())
+                        os.replace(temp_path, db_path)
+                    #
+                    self.manifest_db = db_path
+
+                    # Load package file lists from the manifest
+                    for name, path in self.query_manifest('SELECT "package", "path" FROM "manifest" ORDER BY "path";'):
+                        if name in self.packages:
+                            self.packages[name].files.append(path)
+                #########
+
+                # The timestamp is kept outside the generations, so that it survives cleaning the metadata
+                if timestamp != last_stamp:
+                    atomic_write(stamp_path, str(timestamp) + '\n')
+                #
+
+                if self.extract_groups:
+                    for pkg in self.packages:
+                        group = self.packages[pkg].group
+                        if group:
+                            if group in self.groups:
+                                self.groups[group].append(pkg)
+                            else:
+                                self.groups[group] = [ pkg ]
+                #############
             #
+        elif checksums and not (packages_md5 and manifest_md5):
+            cprint('Incomplete CHECKSUMS.md5 for', self.repoid, style='error', stderr=True)
+            self.log.error('PACKAGES.TXT or %s missing from CHECKSUMS.md5 for %s', manifest_relpath, self.repoid)
+            result = False
         else:
-            cprint('Metadata download failed for', self.repoid, style='error', stderr=True)
+            cprint('Metadata download or checksum verification failed for', self.repoid, style='error', stderr=True)
             result = False
         #
 
+        if refresh and result:
+            self.generations.publish(work)
+
+            # Without the lock, another process may be using or preparing the generations that would be removed
+            if allow_refresh:
+                self.generations.collect()
+                self.remove_flat_metadata()
+            #
+        elif refresh:
+            # Readers continue to use the published generation, which the failed refresh has not touched
+            self.generations.discard(work)
+        #
+        if result:
+            self.metadata_dir = work.as_posix()
+        #
+
+        return result
+    #
+    def query_manifest(self, query, params=()):
+        result = []
+        if self.manifest_db:
+            db = sqlite3.connect(self.manifest_db)
+            try:
+                result = db.execute(query, params).fetchall()
+            finally:
+                db.close()
+            #
+        #
+        return result
+    #
+    def manifest_files(self, name):
+        # Returns (path, size) pairs for the files (not directories) of a package, as listed in the manifest. Symbolic
+        # links are listed by their own path, with a size of 0.
+        result = []
+        for path, size in self.query_manifest('SELECT "path", "size" FROM "manifest" WHERE "package" = ?;', (name,)):
+            if not path.endswith('/'):
+                result.append( (path.partition(' -> ')[0], int(size) if size.isdigit() else 0) )
+            #
+        #
+        return result
+    #
+    def manifest_usage(self, names, mounts):
+        # Returns { mount: [ files, bytes ] } for the files of the named packages, with each file assigned to the
+        # longest mount point that contains it (mounts must be sorted longest first). The grouping is done by SQLite,
+        # using the package index, rather than by iterating over the files here.
+        result = {}
+        if self.manifest_db and names:
+            cases = []
+            params = []
+            for mount in mounts:
+                prefix = mount.rstrip('/') + '/'
+                cases.append('WHEN substr("path", 1, ?) = ? THEN ?')
+                params += [ len(prefix), prefix, mount ]
+            #
+            query = 'SELECT CASE ' + ' '.join(cases) + ' ELSE \'/\' END AS "mount", COUNT(*), ' + \
+                    'SUM(CAST("size" AS INTEGER)) FROM "manifest" WHERE "package" IN (SELECT "name" FROM "wanted") ' + \
+                    'AND substr("path", -1) != \'/\' GROUP BY "mount";'
+
+            db = sqlite3.connect(self.manifest_db)
+            try:
+                db.execute('CREATE TEMP TABLE "wanted" ("name" TEXT PRIMARY KEY);')
+                db.executemany('INSERT OR IGNORE INTO "wanted" VALUES (?);', [ (name,) for name in names ])
+                for mount, count, size in db.execute(query, params):
+                    result[mount] = [ count, size or 0 ]
+                #
+            finally:
+                db.close()
+            #
+        #
         return result
     #
+    def package_filepath(self, package, downloader=None, quiet=False, checksum=None):
+        if downloader is None:
+            downloader = self.downloader
+        #
+        if checksum is None:
+            checksum = self.checksums.get('./' + package.relpath)
+        #
+        return FilePath(self.mirrorlist, package.relpath, self.cache_dir, self.gpg, downloader, quiet=quiet, \
+                checksum=checksum, stats=self.mirror_stats, size=package.csize, store=self.store, \
+                digests=self.digests)
+    #
     def find_package(self, glob):
         result = {}
         matches = []
@@ -235,19 +442,26 @@ class Repository:
 
         for name in matches:
             package = self.packages[name]
-            package.filepath = FilePath(self.mirrorlist, package.relpath, self.cache_dir, self.gpg, self.downloader)
+            package.filepath = self.package_filepath(package)
             result[name] = package
         #
         return result
     #
     def find_file(self, filepath):
+        # Returns the names of the packages whose manifest lists a path matching the glob. Manifest paths always begin
+        # with /, and symbolic links are stored as "path -> target", so the glob is matched against the link path too.
+        # SQLite spells a negated character class [^...] instead of [!...].
+        if not filepath.startswith('/') and not filepath.startswith('*'):
+            filepath = '/' + filepath
+        #
+        pattern = filepath.replace('[!', '[^')
+
         result = []
-        match_keys = fnmatch.filter(self.file_map, filepath)
-        for key in match_keys:
-            for name in self.file_map[key]:
-                if name not in result:
-                    result.append(name)
-        #########
+        query = 'SELECT DISTINCT "package" FROM "manifest" WHERE "path" GLOB ? OR "path" GLOB ? || \' -> *\' ' + \
+                'ORDER BY "package";'
+        for row in self.query_manifest(query, (pattern, pattern)):
+            result.append(row[0])
+        #
 
         return result
     #
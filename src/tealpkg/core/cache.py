@@ -0,0 +1,142 @@
+# Size-bounded package cache management with least-recently-used eviction.
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import logging
+import pathlib
+
+from tealpkg.distro.slackware.pkgtools import splitpkg
+
+
+# Cached files are grouped by inode, since a package in the content store is hard linked into each repository that
+# uses it. Each group holds the data file and signature links, and is evicted as a unit.
+class CacheEntry:
+    def __init__(self, name):
+        self.name = name
+        self.paths = []
+        self.size = 0
+        self.atime = 0
+    #
+#
+
+
+class CacheManager:
+    def __init__(self, cache_dir, repolist, package_db_path, limit):
+        self.cache_dir = pathlib.PosixPath(cache_dir)
+        self.repolist = repolist
+        self.package_db_path = pathlib.PosixPath(package_db_path)
+        self.limit = limit
+        self.log = logging.getLogger(__name__)
+    #
+    def installed(self):
+        # Names of the installed packages (name-version-arch-build), read directly from the package database
+        # directory, since it may have changed since the database was loaded
+        result = set()
+        if self.package_db_path.exists():
+            for item in self.package_db_path.iterdir():
+                if splitpkg(item.name):
+                    result.add(item.name)
+                #
+            #
+        #
+        return result
+    #
+    def scan(self):
+        entries = {}
+
+        def add(path, name):
+            st = path.stat()
+            key = (st.st_dev, st.st_ino)
+            if key not in entries:
+                entries[key] = CacheEntry(name)
+                entries[key].size = st.st_size
+                entries[key].atime = st.st_atime
+            #
+            entries[key].paths.append(path)
+            return entries[key]
+        #
+
+        for repo in self.repolist:
+            cache = pathlib.PosixPath(repo.cache_dir)
+            for path in cache.glob('*.t?z'):
+                entry = add(path, path.stem)
+                sig = path.with_name(path.name + '.asc')
+                if sig.exists():
+                    entry.paths.append(sig)
+                #
+            #
+            for path in cache.glob('*.part'):
+                add(path, path.name)
+            #
+        #
+
+        # Entries in the content store that are no longer linked from a repository are the first to go
+        store = self.cache_dir.joinpath('__store__')
+        for path in store.glob('??/*'):
+            if not path.name.endswith('.asc'):
+                entry = add(path, path.name)
+                entry.paths.extend(path.parent.glob(path.name + '.*asc'))
+                if path.stat().st_nlink <= 1:
+                    entry.atime = 0
+                #
+            #
+        #
+
+        return list(entries.values())
+    #
+    def usage(self, entries):
+        return sum(entry.size for entry in entries)
+    #
+    def enforce(self):
+        count = 0
+        freed = 0
+
+        if self.limit > 0:
+            entries = self.scan()
+            total = self.usage(entries)
+            pinned = self.installed()
+            self.log.debug('Package cache usage %d bytes (limit %d)', total, self.limit)
+
+            candidates = [ entry for entry in entries if entry.name not in pinned ]
+            candidates.sort(key=lambda entry: entry.atime)
+            index = 0
+            while total > self.limit and index < len(candidates):
+                entry = candidates[index]
+                self.log.info('Evicting %s from the package cache (%d bytes)', entry.name, entry.size)
+                for path in entry.paths:
+                    path.unlink(missing_ok=True)
+                #
+                total -= entry.size
+                freed += entry.size
+                count += 1
+                index += 1
+            #
+
+            if total > self.limit:
+                self.log.warning('Package cache still exceeds its limit after eviction (installed packages are pinned)')
+            #
+        #
+
+        return (count, freed)
+    #
+#
+
@@ -24,6 +24,8 @@
 
 import fnmatch
 
+from tealpkg.util.profile import profiled
+
 from .package import PackagePair
 
 
@@ -65,6 +67,7 @@ class Searcher:
 
         return result
     #
+    @profiled('search')
     def search_file(self, filepath, installed=True, available=True):
         result = {}
         pkgnames = set()
@@ -94,6 +97,7 @@ class Searcher:
 
         return result
     #
+    @profiled('search')
     def search_package(self, *queryset, fields=['name', 'short'], installed=True, available=True):
         found = []
 
@@ -122,6 +126,7 @@ class Searcher:
 
         return self.find_package(*found, installed=installed, available=available)
     #
+    @profiled('search')
     def find_package(self, *globs, installed=True, available=True, only_upgrades=False, only_extras=False):
         found = {}
 
@@ -171,3 +176,48 @@ class Searcher:
         return result
     #
 #
+
+
+if __name__ == '__main__':
+    # Self-check for file searches against a repository manifest database
+    import bz2
+    import tempfile
+
+    from tealpkg.config.repository import Repository
+    from tealpkg.distro.slackware.parse_manifest import parse_manifest
+
+    from .package import Package
+
+    MANIFEST = '''||   Package:  ./a/hello-1.0-x86_64-1.txz
+drwxr-xr-x root/root         0 2022-01-01 00:00 ./
+drwxr-xr-x root/root         0 2022-01-01 00:00 usr/bin/
+-rwxr-xr-x root/root      1024 2022-01-01 00:00 usr/bin/hello
+lrwxrwxrwx root/root         0 2022-01-01 00:00 usr/bin/hi -> hello
+||   Package:  ./a/world-2.0-noarch-1.txz
+-rw-r--r-- root/root        12 2022-01-01 00:00 usr/share/world/README
+'''
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        manifest_path = tmpdir + '/MANIFEST.bz2'
+        with bz2.open(manifest_path, 'wt') as fh:
+            fh.write(MANIFEST)
+        #
+
+        repo = Repository(tmpdir, 'test', 'Test', [ 'file://' + tmpdir ], 'MANIFEST.bz2', adaptive_mirrors=False)
+        repo.manifest_db = tmpdir + '/__manifest__.db'
+        parse_manifest(manifest_path, repo.manifest_db)
+        for name, version in (('hello', '1.0'), ('world', '2.0')):
+            repo.packages[name] = Package(name, version, 'x86_64', '1')
+            repo.packages[name].relpath = './a/' + name + '-' + version + '-x86_64-1.txz'
+        #
+
+        searcher = Searcher([ repo ], {}, {})
+        checks = [ ('/usr/bin/hello', ['hello']), ('hello', ['hello']), ('usr/bin/h*', ['hello']),
+                   ('/usr/bin/hi', ['hello']), ('README', ['world']), ('/usr/*', ['hello', 'world']),
+                   ('/usr/bin/[!h]*', []), ('missing', []) ]
+        for pattern, expected in checks:
+            found = sorted(searcher.search_file(pattern, installed=False))
+            print('OK  ' if found == expected else 'FAIL', pattern, found)
+        #
+    #
+#
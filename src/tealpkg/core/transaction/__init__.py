@@ -23,19 +23,32 @@
 # TODO: refactor to MVC
 
 import collections
+import concurrent.futures
 import logging
 import os
 import signal
 import sys
+import time
 
 from tealpkg.cli.colorprint import cprint
 from tealpkg.cli.progress_bar import ProgressBar
+from tealpkg.cli.simulation_report import print_simulation
 from tealpkg.cli.status_line import StatusLine
 from tealpkg.cli.transaction_prompt import prompt_install, prompt_remove
+from tealpkg.util.metrics import get_metrics
+from tealpkg.util.profile import profile_span
+from tealpkg.util.size import friendly_size
 
 from .lock import TransactionLock
 
 
+# TODO: move this logic into distro
+# Certain packages should be upgraded first. Per the Slackware 15.0 UPGRADE.TXT
+# file (as of July 17, 2021), these are: aaa_glibc-solibs, pkgtools, tar, xz,
+# findutils.
+UPGRADE_FIRST = ('aaa_glibc-solibs', 'pkgtools', 'tar', 'xz', 'findutils')
+
+
 # When using SIGHUP protection to guard against an SSH connection (running tealpkg) dropping in the
 # middle of a transaction, we need to set stdout and stderr to /dev/null to prevent exceptions
 # whenever data are written to the streams. This way, the transaction can run to completion, instead
@@ -48,13 +61,19 @@ def sighup(signum, frame):
 
 
 class Transaction:
-    def __init__(self, pkgtools, lockfile, scripts=None, dry_run=False, quiet=False, prompt=True):
+    def __init__(self, pkgtools, lockfile, scripts=None, dry_run=False, quiet=False, prompt=True, verify_workers=0, \
+                 stager=None, batch_size=1, simulator=None, preflight=None, lock_timeout=-1):
         self.pkgtools = pkgtools
-        self.lock = TransactionLock(lockfile)
+        self.lock = TransactionLock(lockfile, lock_timeout)
         self.scripts = scripts
         self.dry_run = dry_run
         self.quiet = quiet
         self.prompt = prompt
+        self.verify_workers = verify_workers if verify_workers > 0 else (os.cpu_count() or 1)
+        self.stager = stager
+        self.batch_size = max(batch_size, 1)
+        self.simulator = simulator
+        self.preflight = preflight
         self.status_line = StatusLine()
         self.log = logging.getLogger(__name__)
     #
@@ -76,9 +95,19 @@ class Transaction:
             self.status_line.leave()
         #
     #
+    def record_operation(self, name, operation, status, start, share=1):
+        # For batched operations, each package is credited with an equal share of the time taken by the batch
+        metrics = get_metrics()
+        metrics.set('tealpkg_package_operation_seconds', (time.monotonic() - start) / share, \
+                'Time taken by the package tool for each package', package=name, operation=operation)
+        metrics.add('tealpkg_package_operations', 1, 'Number of package operations by outcome', \
+                operation=operation, result='ok' if status == 0 else 'failed')
+    #
     def resolve_install(self, package_pairs):
         ok = True
         install_map = collections.OrderedDict()
+        resolved = {}
+        pending = {}
 
         total_size = 0
         for name in package_pairs:
@@ -87,22 +116,55 @@ class Transaction:
 
         completed_size = 0
         self.enable_status()
-        for name in sorted(package_pairs):
-            package = package_pairs[name].available
-            self.progress_bar('Obtaining ' + name, completed_size, total_size)
-            fp = package.filepath
-            completed_size += package.csize
-            path = fp.resolve()
-            if not path:
-                cprint('Could not resolve file for', name, style='error', stderr=True)
-                self.log.error('Cannot install or upgrade %s: path not resolved', name)
-                ok = False
-            else:
-                install_map[name] = path
+
+        # Signatures are checked by a pool of worker threads as each download completes. Each check runs in a
+        # separate gpg process, so the checks proceed in parallel with each other and with the remaining downloads.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.verify_workers) as pool:
+            for name in sorted(package_pairs):
+                package = package_pairs[name].available
+                verified = sum(1 for future in pending if future.done())
+                self.progress_bar('Obtaining ' + name + ' (' + str(verified) + ' verified)', completed_size, total_size)
+                fp = package.filepath
+                completed_size += package.csize
+                with profile_span('package download'):
+                    path = fp.fetch()
+                #
+                if not path:
+                    cprint('Could not resolve file for', name, style='error', stderr=True)
+                    self.log.error('Cannot install or upgrade %s: path not resolved', name)
+                    ok = False
+                else:
+                    resolved[name] = path
+                    pending[pool.submit(fp.check_pending)] = name
+                #
+            #
+
+            verified = 0
+            for future in concurrent.futures.as_completed(pending):
+                name = pending[future]
+                verified += 1
+                self.progress_bar('Verifying signatures', verified, len(pending))
+                if not future.result():
+                    # The corrupt file has been removed, so go through the mirrors again in the usual way
+                    self.log.warning('Signature verification failed for %s: retrying', name)
+                    cprint('Signature verification failed for', name, style='warning', stderr=True)
+                    path = package_pairs[name].available.filepath.resolve()
+                    if path:
+                        resolved[name] = path
+                    else:
+                        cprint('Could not resolve file for', name, style='error', stderr=True)
+                        self.log.error('Cannot install or upgrade %s: signature verification failed', name)
+                        ok = False
+                    #
+                #
             #
         #
         self.status_line.disable()
 
+        for name in sorted(resolved):
+            install_map[name] = resolved[name]
+        #
+
         if not ok:
             install_map = {}
         #
@@ -121,87 +183,230 @@ class Transaction:
         signal.signal(signal.SIGHUP, signal.SIG_DFL)
         return ok
     #
+    def start_staging(self, install_map, package_pairs):
+        # Decompresses the first packages (or all of them, if the staging area is unlimited) before the transaction
+        # begins, so that corrupt packages are found before the system is changed
+        sizes = {}
+        for name in install_map:
+            sizes[name] = package_pairs[name].available.usize
+        #
+
+        with profile_span('staging'):
+            self.stager.start(install_map, sizes)
+            failed = self.stager.check()
+        #
+        for name in failed:
+            cprint('Package', name, 'is corrupt or unreadable', style='error', stderr=True)
+        #
+
+        return len(failed) == 0
+    #
+    def staged_path(self, name, path):
+        result = path
+        if self.stager:
+            with profile_span('staging wait'):
+                result = self.stager.get(name)
+            #
+            if not result:
+                cprint('Package', name, 'is corrupt or unreadable', style='error', stderr=True)
+            #
+        #
+        return result
+    #
+    def simulate(self, package_pairs, operation):
+        # Dry runs report the effects of the transaction from the manifest file lists, instead of downloading the
+        # packages and stepping through the commands
+        with profile_span('simulation'):
+            report = self.simulator.simulate(package_pairs, operation, self.scripts)
+        #
+        if not self.quiet:
+            print_simulation(report)
+        #
+        self.log.info('Simulated %s of %d packages: %d files added, %d replaced, %d removed', operation, \
+                report.packages, report.added, report.replaced, report.removed)
+        return 0
+    #
+    def make_batches(self, names, upgrade_first=True):
+        # Splits the packages into groups of at most batch_size, each run with a single pkgtools command. For installs
+        # and upgrades, the packages that must be upgraded first are kept apart from the rest, so that later batches
+        # run with the new tools. Removals keep the given order, since removing the tools first would break the rest.
+        result = []
+        first = [ name for name in names if upgrade_first and name in UPGRADE_FIRST ]
+        rest = [ name for name in names if not (upgrade_first and name in UPGRADE_FIRST) ]
+        for group in (first, rest):
+            for index in range(0, len(group), self.batch_size):
+                result.append(group[index:index + self.batch_size])
+            #
+        #
+        return result
+    #
+    def run_install(self, install_map, batch, upgrade):
+        # Returns the status of each package in the batch. Packages that failed to stage are not run.
+        result = {}
+        paths = {}
+        for name in batch:
+            path = self.staged_path(name, install_map[name])
+            if path:
+                paths[name] = path
+                if path != install_map[name]:
+                    # Staging is only used with the native backend, which records the cached package path instead
+                    self.pkgtools.locations[path] = install_map[name]
+                #
+            else:
+                result[name] = 1
+            #
+        #
+
+        names = list(paths)
+        if len(names) == 1:
+            if upgrade:
+                with profile_span('upgradepkg'):
+                    result[names[0]] = self.pkgtools.upgrade(paths[names[0]])
+                #
+            else:
+                with profile_span('installpkg'):
+                    result[names[0]] = self.pkgtools.install(paths[names[0]])
+                #
+            #
+        elif names:
+            if upgrade:
+                with profile_span('upgradepkg'):
+                    result.update(zip(names, self.pkgtools.upgrade_batch([ paths[name] for name in names ])))
+                #
+            else:
+                with profile_span('installpkg'):
+                    result.update(zip(names, self.pkgtools.install_batch([ paths[name] for name in names ])))
+                #
+            #
+        #
+
+        if self.stager:
+            for name in batch:
+                self.pkgtools.locations.pop(paths.get(name), None)
+                self.stager.release(name)
+            #
+        #
+
+        return [ result[name] for name in batch ]
+    #
+    def run_remove(self, batch):
+        result = []
+        with profile_span('removepkg'):
+            if len(batch) == 1:
+                result.append(self.pkgtools.remove(batch[0]))
+            else:
+                result = self.pkgtools.remove_batch(batch)
+            #
+        #
+        return result
+    #
+    def announce(self, action, batch, index, total):
+        if len(batch) == 1:
+            self.progress_bar(action + ' ' + batch[0], index, total)
+        else:
+            self.progress_bar(action + ' ' + str(len(batch)) + ' packages', index, total)
+        #
+
+        if not self.quiet:
+            cprint()
+            cprint(action, style='action', end=' ')
+            cprint(', '.join(batch), style='target', end='')
+            cprint('...', style='default')
+        #
+    #
     def install(self, package_pairs, upgrade=False):
         status = 0
 
-        if self.prompt:
+        # Check for space before prompting, downloading, or installing anything
+        if self.preflight:
+            with profile_span('preflight'):
+                status = self.preflight.check(package_pairs)
+            #
+        #
+
+        if self.prompt and status == 0:
             status = prompt_install(package_pairs, upgrade)
         #
 
-        if status == 0:
+        if status == 0 and self.simulator:
+            status = self.simulate(package_pairs, 'upgrade' if upgrade else 'install')
+        elif status == 0:
             install_map = self.resolve_install(package_pairs)
             if install_map:
-                # TODO: move this logic into distro
-                # Certain packages should be upgraded first. Per the Slackware 15.0 UPGRADE.TXT
-                # file (as of July 17, 2021), these are: aaa_glibc-solibs, pkgtools, tar, xz,
-                # findutils. We need to do these in reverse order, as the OrderedDict allows
-                # us to move things easily to the beginning of the list.
-                for name in ('findutils', 'xz', 'tar', 'pkgtools', 'aaa_glibc-solibs'):
+                # Move the packages that must be upgraded first to the beginning. We need to do these in
+                # reverse order, as the OrderedDict allows us to move things easily to the beginning of
+                # the list.
+                for name in reversed(UPGRADE_FIRST):
                     if name in install_map:
                         install_map.move_to_end(name, last=False)
                 #####
 
-                if self.begin_transaction():
-                    self.enable_status()
-                    try:
-                        insindex = 0
-                        for name in install_map:
-                            if upgrade:
-                                self.log.info('Upgrading: %s', name)
-                            else:
-                                self.log.info('Installing: %s', name)
-                            #
-
-                            disp = 'Upgrading' if upgrade else 'Installing'
-                            self.progress_bar(disp + ' ' + name, insindex, len(install_map))
-
-                            if not self.quiet:
-                                cprint()
-                                cprint(disp, style='action', end=' ')
-                                cprint(name, style='target', end='')
-                                cprint('...', style='default')
+                # The staging area may be in memory (tmpfs), so it is always cleaned up, even on an exception
+                try:
+                    if self.stager and not self.start_staging(install_map, package_pairs):
+                        self.log.error('Transaction aborted: packages failed to stage')
+                        status = 1
+                    elif self.begin_transaction():
+                        self.enable_status()
+                        try:
+                            insindex = 0
+                            for batch in self.make_batches(list(install_map)):
+                                for name in batch:
+                                    if upgrade:
+                                        self.log.info('Upgrading: %s', name)
+                                    else:
+                                        self.log.info('Installing: %s', name)
+                                #####
+
+                                action = 'Upgrading' if upgrade else 'Installing'
+                                self.announce(action, batch, insindex, len(install_map))
+
+                                start = time.monotonic()
+                                checks = self.run_install(install_map, batch, upgrade)
+                                operation = 'upgrade' if upgrade else 'install'
+                                for name, check in zip(batch, checks):
+                                    self.record_operation(name, operation, check, start, len(batch))
+                                    if check != 0:
+                                        cprint('Operation error when processing', name, style='error', stderr=True)
+                                        status = check
+                                #####
+
+                                insindex += len(batch)
                             #
+                        finally:
+                            self.disable_status()
+                        #
 
-                            if upgrade:
-                                check = self.pkgtools.upgrade(install_map[name])
-                            else:
-                                check = self.pkgtools.install(install_map[name])
+                        if self.scripts:
+                            operation = 'upgrade' if upgrade else 'install'
+                            with profile_span('scripts'):
+                                check = self.scripts.run_scripts(operation, package_pairs)
                             #
-
                             if check != 0:
-                                cprint('Operation error when processing', name, style='error', stderr=True)
                                 status = check
                             #
-
-                            insindex += 1
                         #
-                    finally:
-                        self.disable_status()
-                    #
 
-                    if self.scripts:
-                        operation = 'upgrade' if upgrade else 'install'
-                        check = self.scripts.run_scripts(operation, package_pairs)
-                        if check != 0:
-                            status = check
+                        if not self.end_transaction():
+                            cprint('Failed to release transaction lock', style='error', stderr=True)
+                            status = 1
                         #
-                    #
 
-                    if not self.end_transaction():
-                        cprint('Failed to release transaction lock', style='error', stderr=True)
+                        if not self.quiet:
+                            for name in install_map:
+                                for entry in package_pairs[name].available.files:
+                                    if entry.endswith('.new') and os.path.exists(entry):
+                                        cprint('NEW:', entry, style='warning')
+                        #############
+                    else:
+                        cprint('Could not acquire transaction lock: is tealpkg already running?', style='error', \
+                                stderr=True)
                         status = 1
                     #
-
-                    if not self.quiet:
-                        for name in install_map:
-                            for entry in package_pairs[name].available.files:
-                                if entry.endswith('.new') and os.path.exists(entry):
-                                    cprint('NEW:', entry, style='warning')
-                    #############
-                else:
-                    cprint('Could not acquire transaction lock: is tealpkg already running?', style='error', stderr=True)
-                    status = 1
-                #
+                finally:
+                    if self.stager:
+                        self.stager.close()
+                #####
 
                 if status == 0:
                     self.log.info('Transaction completed successfully')
@@ -211,6 +416,33 @@ class Transaction:
 
         return status
     #
+    def download(self, package_pairs):
+        # Downloads and verifies the available packages into the cache, without changing the system. A dry run only
+        # reports the packages that are not yet cached, and the volume that would be downloaded.
+        status = 0
+        if self.dry_run:
+            needed = [ name for name in sorted(package_pairs) if package_pairs[name].available.filepath is None or \
+                    package_pairs[name].available.filepath.needs_download() ]
+            size = sum(package_pairs[name].available.csize for name in needed)
+            if not self.quiet:
+                for name in needed:
+                    cprint('Would download', name)
+                #
+                cprint('Would download', len(needed), 'of', len(package_pairs), 'packages (' + friendly_size(size) + ')')
+            #
+            self.log.info('Dry run: %d of %d packages (%d bytes) would be downloaded', len(needed), len(package_pairs), \
+                    size)
+        else:
+            install_map = self.resolve_install(package_pairs)
+            if len(install_map) == 0:
+                self.log.error('Download failed')
+                status = 1
+            else:
+                self.log.info('Downloaded %d packages', len(install_map))
+            #
+        #
+        return status
+    #
     def upgrade(self, package_pairs):
         return self.install(package_pairs, upgrade=True)
     #
@@ -221,34 +453,38 @@ class Transaction:
             status = prompt_remove(package_pairs)
         #
 
-        if status == 0:
+        if status == 0 and self.simulator:
+            status = self.simulate(package_pairs, 'remove')
+        elif status == 0:
             if self.begin_transaction():
                 self.enable_status()
                 try:
                     rindex = 0
-                    for name in sorted(package_pairs):
-                        self.progress_bar('Removing ' + name, rindex, len(package_pairs))
-                        self.log.info('Removing: %s', name)
-
-                        if not self.quiet:
-                            cprint('Removing', style='action', end=' ')
-                            cprint(name, style='target', end='')
-                            cprint('...', style='default')
+                    for batch in self.make_batches(sorted(package_pairs), upgrade_first=False):
+                        for name in batch:
+                            self.log.info('Removing: %s', name)
                         #
 
-                        check = self.pkgtools.remove(name)
-                        if check != 0:
-                            status = check
-                        #
+                        self.announce('Removing', batch, rindex, len(package_pairs))
+
+                        start = time.monotonic()
+                        checks = self.run_remove(batch)
+                        for name, check in zip(batch, checks):
+                            self.record_operation(name, 'remove', check, start, len(batch))
+                            if check != 0:
+                                status = check
+                        #####
 
-                        rindex += 1
+                        rindex += len(batch)
                     #
                 finally:
                     self.disable_status()
                 #
 
                 if self.scripts:
-                    check = self.scripts.run_scripts('remove', package_pairs)
+                    with profile_span('scripts'):
+                        check = self.scripts.run_scripts('remove', package_pairs)
+                    #
                     if check != 0:
                         status = check
                     #
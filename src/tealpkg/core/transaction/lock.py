@@ -21,78 +21,28 @@
 # IN THE SOFTWARE.
 
 
-import os
-import pathlib
+from tealpkg.util.file_lock import FileLock
 
 
 class TransactionLock:
-    def __init__(self, lockfile):
-        self.path = pathlib.PosixPath(lockfile)
-    #
-    def check_lock(self):
-        result = False
-        if self.path.exists():
-            this_pid = os.getpid()
-            check_pid = 0
-            with open(self.path, 'r') as fh:
-                check_pid = int(fh.read().strip())
-            #
-            if this_pid == check_pid:
-                # We already hold the lock
-                result = True
-            else:
-                # See if we have a stale lock
-                # TODO: improve this logic
-                procpath = pathlib.PosixPath('/proc').joinpath(str(check_pid))
-                if procpath.exists():
-                    data = ''
-                    with open(procpath.joinpath('status')) as fh:
-                        data = fh.read()
-                    #
-                    if 'python' not in data:
-                        # pid has been reused, so it should be safe to clean up the lock file
-                        result = True
-                        self.path.unlink(missing_ok=True)
-                    #
-                else:
-                    # Stale lock: clean it up
-                    result = True
-                    self.path.unlink(missing_ok=True)
-            #####
-        else:
-            # Not locked, so we're good to proceed
-            result = True
-        #
-        return result
+    def __init__(self, lockfile, timeout=-1):
+        self.lock_file = FileLock(lockfile, 'transaction', timeout)
+        self.in_transaction = False
     #
     def lock(self):
-        result = False
-        if self.check_lock():
-            with open(self.path, 'w') as fh:
-                pid = os.getpid()
-                fh.write(str(pid) + '\n')
-            #
-
-            # We really shouldn't have a close race condition with this application, since it is anticipated that the
-            # system administrator will run it manually (or perhaps via cron, but even then not especially frequently).
-            result = self.check_lock()
-            if result:
-                self.in_transaction = True
-            #
+        result = self.lock_file.acquire(exclusive=True)
+        if result:
+            self.lock_file.write_pid()
+            self.in_transaction = True
         #
-
         return result
     #
     def unlock(self):
-        result = False
-
-        # Check that we're the process holding the lock
-        if self.check_lock():
-            self.path.unlink(missing_ok=True)
-            result = True
+        result = self.in_transaction
+        if result:
+            self.lock_file.release()
             self.in_transaction = False
         #
-
         return result
     #
 #
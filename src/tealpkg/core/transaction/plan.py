@@ -0,0 +1,110 @@
+# Transaction plans: resolved package sets recorded on one host and applied unchanged on others.
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import json
+import time
+
+from tealpkg.core.package import Package, PackagePair
+from tealpkg.util.atomic_write import atomic_write
+
+
+PLAN_FORMAT = 1
+
+
+def save_plan(path, package_pairs):
+    # Records the exact packages to be installed, including the MD5 checksums from the repository metadata, so that
+    # the plan can be applied without loading the metadata and without being affected by later mirror updates
+    packages = []
+    for name in sorted(package_pairs):
+        package = package_pairs[name].available
+        checksum = package.filepath.checksum if package.filepath else None
+        if not checksum:
+            raise PlanError('No checksum is known for ' + name)
+        #
+        packages.append({ 'name': name, 'version': package.version, 'arch': package.arch, 'build': package.build, \
+                'repo': package.repo, 'relpath': package.relpath, 'md5': checksum, 'csize': int(package.csize), \
+                'usize': int(package.usize) })
+    #
+
+    plan = { 'format': PLAN_FORMAT, 'created': int(time.time()), 'packages': packages }
+    atomic_write(path, json.dumps(plan, indent=1, sort_keys=True) + '\n')
+#
+
+
+def load_plan(path, repolist, package_db):
+    # Returns package pairs for the planned packages that are installed here at another version. Each package is
+    # obtained through its repository's mirrors, but is checked against the checksum pinned in the plan (and by GPG
+    # signature, if enabled for the repository). Only the GPG keys of the repositories in the plan are loaded.
+    result = {}
+    repos = { repo.repoid: repo for repo in repolist }
+    loaded = set()
+
+    with open(path, 'r') as fh:
+        try:
+            plan = json.load(fh)
+        except ValueError as e:
+            raise PlanError('Invalid plan file ' + path + ': ' + str(e))
+        #
+    #
+
+    if not isinstance(plan, dict) or plan.get('format') != PLAN_FORMAT:
+        raise PlanError('Unsupported plan format in ' + path)
+    #
+
+    try:
+        for entry in plan['packages']:
+            name = entry['name']
+            repo = repos.get(entry['repo'])
+            if repo is None:
+                raise PlanError('Repository ' + entry['repo'] + ' for ' + name + ' is not enabled')
+            #
+
+            package = Package(name, entry['version'], entry['arch'], entry['build'])
+            package.repo = repo.repoid
+            package.relpath = entry['relpath']
+            package.csize = int(entry['csize'])
+            package.usize = int(entry['usize'])
+
+            pair = PackagePair(name)
+            pair.available = package
+            pair.installed = package_db.get(name)
+            if pair.has_upgrade():
+                if repo.repoid not in loaded:
+                    repo.load_gpg()
+                    loaded.add(repo.repoid)
+                #
+                package.filepath = repo.package_filepath(package, checksum=entry['md5'])
+                result[name] = pair
+            #
+        #
+    except (KeyError, TypeError, ValueError) as e:
+        raise PlanError('Invalid plan entry in ' + path + ': ' + str(e))
+    #
+
+    return result
+#
+
+
+class PlanError(Exception):
+    pass
+#
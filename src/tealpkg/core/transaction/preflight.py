@@ -0,0 +1,168 @@
+# Free space and inode checks, run before packages are downloaded or installed.
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import collections
+import logging
+import os
+
+from tealpkg.cli.colorprint import cprint
+from tealpkg.util.size import friendly_size
+
+from .simulator import find_mount, load_mounts
+
+
+class MountUsage:
+    def __init__(self, mount):
+        self.mount = mount
+        self.size = 0          # net change in bytes
+        self.inodes = 0        # net change in files
+        self.free = 0
+        self.free_inodes = 0
+        self.has_inodes = True
+    #
+#
+
+
+class Preflight:
+    def __init__(self, repolist, cache_dir, reserve=0, refuse=True):
+        self.repos = { repo.repoid: repo for repo in repolist }
+        self.cache_dir = cache_dir
+        self.reserve = reserve      # bytes that must remain free on each file system
+        self.refuse = refuse        # refuse the transaction when short of space (otherwise only warn)
+        self.log = logging.getLogger(__name__)
+    #
+    def estimate(self, package_pairs):
+        # Estimates the net change per file system. The new files come from the manifest. Each upgraded package is
+        # assumed to free its installed size (and file count) spread over the file systems in the same proportions
+        # as the new files, since the installed files carry no sizes. Downloads add to the cache file system.
+        mounts = load_mounts()
+        usage = {}
+        by_repo = collections.defaultdict(list)
+        old_size = 0
+        old_files = 0
+        download = 0
+        unlisted = 0
+
+        for name in package_pairs:
+            pair = package_pairs[name]
+            repo = self.repos.get(pair.available.repo)
+            if repo is None or repo.manifest_db is None:
+                # Without the manifest (e.g. when applying a plan), only the net change in the recorded package sizes
+                # is known, which is counted against the root file system
+                unlisted += pair.available.usize - (pair.installed.usize if pair.installed else 0)
+            else:
+                by_repo[pair.available.repo].append(name)
+            #
+            if pair.installed and repo and repo.manifest_db:
+                old_size += pair.installed.usize
+                old_files += len([ path for path in pair.installed.files if not path.endswith('/') ])
+            #
+            if pair.available.filepath is None or pair.available.filepath.needs_download():
+                download += pair.available.csize
+            #
+        #
+
+        for repoid in by_repo:
+            found = self.repos[repoid].manifest_usage(by_repo[repoid], mounts)
+            for mount in found:
+                entry = usage.setdefault(mount, MountUsage(mount))
+                entry.inodes += found[mount][0]
+                entry.size += found[mount][1]
+            #
+        #
+
+        new_size = sum(entry.size for entry in usage.values())
+        new_files = sum(entry.inodes for entry in usage.values())
+        for entry in usage.values():
+            if new_size > 0:
+                entry.size -= int(old_size * entry.size / new_size)
+            #
+            if new_files > 0:
+                entry.inodes -= int(old_files * entry.inodes / new_files)
+            #
+        #
+
+        if unlisted != 0:
+            self.log.warning('No file lists available: estimating space from package sizes only')
+            cprint('Warning: no file lists are loaded, so space is estimated from package sizes only, and inodes are', \
+                    'not checked', style='warning', stderr=True)
+            mount = find_mount('/', mounts)
+            usage.setdefault(mount, MountUsage(mount)).size += int(unlisted)
+        #
+
+        if download > 0:
+            mount = find_mount(os.path.abspath(self.cache_dir), mounts)
+            usage.setdefault(mount, MountUsage(mount)).size += int(download)
+        #
+
+        for entry in usage.values():
+            st = os.statvfs(entry.mount)
+            # root may use the blocks and inodes reserved for it
+            if os.geteuid() == 0:
+                entry.free = st.f_bfree * st.f_frsize
+                entry.free_inodes = st.f_ffree
+            else:
+                entry.free = st.f_bavail * st.f_frsize
+                entry.free_inodes = st.f_favail
+            #
+            entry.has_inodes = st.f_files > 0     # some file systems (e.g. btrfs) allocate inodes dynamically
+        #
+
+        return sorted(usage.values(), key=lambda entry: entry.mount)
+    #
+    def check(self, package_pairs):
+        # Returns 0 if there is enough space for the transaction (or if shortages only produce warnings), 1 otherwise
+        status = 0
+        short = []
+
+        try:
+            usage = self.estimate(package_pairs)
+        except OSError as e:
+            self.log.warning('Unable to check free space: %s', e)
+            cprint('Unable to check free space:', e, style='warning', stderr=True)
+            usage = []
+        #
+
+        for entry in usage:
+            self.log.info('Preflight %s: change %d bytes (%d free), %d files (%d free)', entry.mount, entry.size, \
+                    entry.free, entry.inodes, entry.free_inodes)
+            if entry.size > 0 and entry.size + self.reserve > entry.free:
+                short.append(entry)
+                cprint('Not enough space on', entry.mount + ':', friendly_size(entry.size + self.reserve), \
+                        'needed (including reserve),', friendly_size(entry.free), 'available', \
+                        style='error' if self.refuse else 'warning', stderr=True)
+            elif entry.has_inodes and entry.inodes > 0 and entry.inodes > entry.free_inodes:
+                short.append(entry)
+                cprint('Not enough inodes on', entry.mount + ':', entry.inodes, 'needed,', entry.free_inodes, \
+                        'available', style='error' if self.refuse else 'warning', stderr=True)
+            #
+        #
+
+        if short and self.refuse:
+            self.log.error('Transaction refused: insufficient space on %s', ', '.join(entry.mount for entry in short))
+            status = 1
+        #
+
+        return status
+    #
+#
@@ -23,17 +23,51 @@
 # TODO: refactor for MVC
 
 
+import concurrent.futures
+import fnmatch
 import logging
 import pathlib
+import re
 import subprocess
 import tempfile
-import time
 
 from tealpkg.cli.colorprint import cprint
 from tealpkg.util.filetest import is_executable
 from tealpkg.util.run import log_run
 
 
+# Scripts may declare, in comment lines near the top, the packages (as globs) and the operations that they handle:
+#     # TEALPKG-PACKAGES: kernel-generic kernel-huge
+#     # TEALPKG-OPERATIONS: install upgrade
+# A script is only run when both match the transaction. A missing tag matches everything.
+TAG_LINE = re.compile(r'^#\s*TEALPKG-(PACKAGES|OPERATIONS):\s*(.*)$')
+
+# Amount of the start of a script searched for tags
+HEADER_SIZE = 8192
+
+# Scripts with the same numeric prefix (e.g. 90-grub.bash and 90-lilo.bash) are run concurrently
+PREFIX = re.compile(r'^(\d+)')
+
+
+def read_tags(path):
+    tags = {}
+    try:
+        with open(path, 'r', errors='replace') as fh:
+            header = fh.read(HEADER_SIZE)
+        #
+        for line in header.splitlines():
+            match = TAG_LINE.match(line.strip())
+            if match:
+                tags.setdefault(match.group(1), []).extend(match.group(2).replace(',', ' ').split())
+            #
+        #
+    except OSError:
+        pass   # unreadable scripts are run (and fail) as before
+    #
+    return tags
+#
+
+
 class ScriptHandler:
     def __init__(self, script_path, dry_run=False, quiet=False, log_script_output=False):
         self.script_path = pathlib.PosixPath(script_path)
@@ -42,12 +76,17 @@ class ScriptHandler:
         self.log_script_output = log_script_output
         self.log = logging.getLogger(__name__)
     #
-    def run(self, args):
+    def run(self, args, output=None):
+        # If output is a list, the output is collected into it instead of being written as it arrives
         status = 0
 
         if self.dry_run:
             cprint('DRY RUN:', ' '.join(args), style='notice')
-            time.sleep(1)
+        elif output is not None:
+            status = log_run(args, True, self.log_script_output, on_output=output.append)
+            if status != 0:
+                self.log.error('Process returned error code: %d', status)
+            #
         else:
             status = log_run(args, self.quiet, self.log_script_output)
             if status != 0:
@@ -73,9 +112,67 @@ class ScriptHandler:
         script_list.sort(key=lambda p: p.name)
         return script_list
     #
+    def wants(self, script, operation, package_pairs):
+        tags = read_tags(script)
+        result = operation in tags.get('OPERATIONS', [ operation ])
+        if result and 'PACKAGES' in tags:
+            result = any(fnmatch.filter(package_pairs, pattern) for pattern in tags['PACKAGES'])
+        #
+        if not result:
+            self.log.info('Skipping script %s: no matching packages or operation', script.name)
+        #
+        return result
+    #
+    def group_scripts(self, script_list):
+        # Groups consecutive scripts sharing a numeric prefix. Scripts without one run on their own.
+        groups = []
+        last = None
+        for script in script_list:
+            match = PREFIX.match(script.name)
+            prefix = match.group(1) if match else None
+            if prefix is not None and prefix == last:
+                groups[-1].append(script)
+            else:
+                groups.append([ script ])
+            #
+            last = prefix
+        #
+        return groups
+    #
+    def run_group(self, group, operation, packages_path):
+        status = 0
+        args = { script: [ script.as_posix(), operation, packages_path ] for script in group }
+
+        if len(group) == 1:
+            cprint('Running script', style='action', end=' ')
+            cprint(group[0].name, style='target', end='')
+            cprint('...', style='default')
+            status = self.run(args[group[0]])
+        else:
+            cprint('Running scripts', style='action', end=' ')
+            cprint(', '.join(script.name for script in group), style='target', end='')
+            cprint('...', style='default')
+
+            # The output of each script is collected and shown once it finishes, so that it is not interleaved
+            outputs = { script: [] for script in group }
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(group)) as pool:
+                futures = { script: pool.submit(self.run, args[script], outputs[script]) for script in group }
+            #
+            for script in group:
+                if outputs[script] and not self.quiet:
+                    cprint(''.join(outputs[script]), end='')
+                #
+                check = futures[script].result()
+                if check != 0:
+                    status = check
+            #####
+        #
+
+        return status
+    #
     def run_scripts(self, operation, package_pairs):
         status = 0
-        script_list = self.find_scripts()
+        script_list = [ script for script in self.find_scripts() if self.wants(script, operation, package_pairs) ]
         if len(script_list) > 0:
             with tempfile.TemporaryDirectory() as tempdir:
                 base = pathlib.PosixPath(tempdir)
@@ -88,17 +185,11 @@ class ScriptHandler:
                         fh.write(name + ' ' + package.version + ' ' + package.arch + ' ' + package.build + '\n')
                 #####
 
-                sindex = 0
-                for script in script_list:
-                    cprint('Running script', style='action', end=' ')
-                    cprint(script.name, style='target', end='')
-                    cprint('...', style='default')
-                    args = [ script.as_posix(), operation, base.joinpath('packages').as_posix() ]
-                    check = self.run(args)
+                for group in self.group_scripts(script_list):
+                    check = self.run_group(group, operation, base.joinpath('packages').as_posix())
                     if check != 0:
                         status = check
                     #
-                    sindex += 1
                 #
         #
 
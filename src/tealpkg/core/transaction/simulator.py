@@ -0,0 +1,183 @@
+# Transaction simulation for dry runs.
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import collections
+import os
+import stat
+
+
+MOUNTS = '/proc/self/mounts'
+
+
+def load_mounts():
+    # Returns the mount points, longest first, so that the first prefix match for a path is its file system
+    result = [ '/' ]
+    try:
+        with open(MOUNTS, 'r') as fh:
+            for line in fh:
+                fields = line.split()
+                if len(fields) >= 2:
+                    result.append(fields[1].replace('\\040', ' '))
+                #
+            #
+        #
+    except OSError:
+        pass   # treat everything as one file system
+    #
+    result.sort(key=len, reverse=True)
+    return result
+#
+
+
+def find_mount(path, mounts):
+    # Returns the mount point of the file system holding path (mounts must be sorted longest first)
+    result = '/'
+    for mount in mounts:
+        if path == mount or path.startswith(mount.rstrip('/') + '/'):
+            result = mount
+            break
+        #
+    #
+    return result
+#
+
+
+class SimulationReport:
+    def __init__(self, operation):
+        self.operation = operation
+        self.packages = 0
+        self.download_size = 0
+        self.download_count = 0
+        self.added = 0
+        self.replaced = 0
+        self.removed = 0
+        self.mount_delta = collections.defaultdict(int)
+        self.new_configs = []
+        self.missing_manifest = []
+        self.scripts = []
+    #
+#
+
+
+class Simulator:
+    def __init__(self, repolist, file_map, root='/'):
+        self.repos = { repo.repoid: repo for repo in repolist }
+        self.file_map = file_map       # installed path: [ names of the packages that own it ]
+        self.root = root
+        self.mounts = load_mounts()
+        self.mount_cache = {}
+    #
+    def mount_of(self, path):
+        directory = os.path.dirname(path)
+        if directory not in self.mount_cache:
+            self.mount_cache[directory] = find_mount(directory, self.mounts)
+        #
+        return self.mount_cache[directory]
+    #
+    def size_on_disk(self, path):
+        # Returns the size of an existing file (symbolic links count as 0), or None if nothing exists at the path
+        result = None
+        try:
+            st = os.lstat(os.path.join(self.root, path.lstrip('/')))
+            result = st.st_size if not stat.S_ISLNK(st.st_mode) else 0
+        except OSError:
+            pass
+        #
+        return result
+    #
+    def new_files(self, package):
+        result = {}
+        repo = self.repos.get(package.repo)
+        if repo:
+            for path, size in repo.manifest_files(package.name):
+                result[path] = size
+            #
+        #
+        return result
+    #
+    def add_file(self, report, path, size):
+        current = self.size_on_disk(path)
+        if current is None:
+            report.added += 1
+            report.mount_delta[self.mount_of(path)] += size
+        else:
+            report.replaced += 1
+            report.mount_delta[self.mount_of(path)] += size - current
+        #
+
+        # Configuration files are shipped as .new files, which doinst.sh only moves into place if the file does not
+        # already exist, leaving the .new file for the administrator to review otherwise
+        if path.endswith('.new') and self.size_on_disk(path[:-4]) is not None:
+            report.new_configs.append(path)
+        #
+    #
+    def remove_file(self, report, path, name):
+        # Files also owned by another installed package are kept
+        owners = self.file_map.get(path, [ name ])
+        current = self.size_on_disk(path)
+        if all(owner == name for owner in owners) and current is not None:
+            report.removed += 1
+            report.mount_delta[self.mount_of(path)] -= current
+        #
+    #
+    def simulate(self, package_pairs, operation, scripts=None):
+        # Computes the effects of an install, upgrade, or remove operation without making any changes
+        report = SimulationReport(operation)
+        report.packages = len(package_pairs)
+
+        for name in sorted(package_pairs):
+            pair = package_pairs[name]
+            new = {}
+            if operation != 'remove':
+                package = pair.available
+                new = self.new_files(package)
+                if not new:
+                    report.missing_manifest.append(name)
+                #
+                if package.filepath is None or package.filepath.needs_download():
+                    report.download_size += package.csize
+                    report.download_count += 1
+                #
+                for path in new:
+                    self.add_file(report, path, new[path])
+                #
+            #
+
+            # Without a new file list, the old files cannot be told apart from those that will be replaced
+            if pair.installed and (new or operation == 'remove'):
+                for path in pair.installed.files:
+                    if not path.endswith('/') and path not in new:
+                        self.remove_file(report, path, name)
+                #####
+            #
+        #
+
+        if scripts:
+            report.scripts = [ script.name for script in scripts.find_scripts() \
+                    if scripts.wants(script, operation, package_pairs) ]
+        #
+        report.new_configs.sort()
+
+        return report
+    #
+#
@@ -0,0 +1,150 @@
+# Staging of decompressed packages ahead of the package tools.
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import bz2
+import collections
+import concurrent.futures
+import gzip
+import logging
+import lzma
+import os
+import pathlib
+import shutil
+import tarfile
+import tempfile
+
+from tealpkg.util.digest import BLOCK_SIZE
+
+
+# The native backend accepts uncompressed .tar packages, so each package is decompressed (on a separate core) while an
+# earlier package is being installed, instead of leaving a single-threaded xz process in the critical path. Slackware's
+# installpkg and upgradepkg only accept compressed packages, so staging is not used with the pkgtools backend.
+OPENERS = {
+    '.tbz': bz2.open,
+    '.tgz': gzip.open,
+    '.tlz': lzma.open,
+    '.txz': lzma.open,
+}
+
+
+def decompress(path, directory):
+    # Returns the path to the staged .tar file, or the original path for a compression format we cannot handle. The
+    # decompressors verify the stream integrity, and reading the members verifies the archive structure.
+    result = path
+    package = pathlib.PurePosixPath(path)
+    if package.suffix in OPENERS:
+        result = os.path.join(directory, package.stem + '.tar')
+        with OPENERS[package.suffix](path, 'rb') as src, open(result, 'wb') as dest:
+            shutil.copyfileobj(src, dest, BLOCK_SIZE)
+        #
+        with tarfile.open(result, 'r:') as tar:
+            tar.getmembers()
+        #
+    #
+    return result
+#
+
+
+class Stager:
+    def __init__(self, staging_dir, workers=0, limit=0):
+        self.staging_dir = pathlib.PosixPath(staging_dir)
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.limit = limit           # maximum uncompressed size staged at once (0 for no limit)
+        self.directory = None
+        self.pool = None
+        self.queue = collections.deque()
+        self.futures = collections.OrderedDict()
+        self.sizes = {}
+        self.staged_size = 0
+        self.log = logging.getLogger(__name__)
+    #
+    def start(self, install_map, sizes):
+        # Stages the packages in install order, keeping the total size of the staged packages within the limit
+        self.staging_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix='stage-', dir=self.staging_dir)
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        for name in install_map:
+            self.queue.append( (name, install_map[name], sizes.get(name, 0)) )
+        #
+        self.fill()
+    #
+    def fill(self):
+        # At least one package is always staged, even if it is larger than the limit by itself
+        while self.queue and (self.limit <= 0 or not self.futures or self.staged_size + self.queue[0][2] <= self.limit):
+            name, path, size = self.queue.popleft()
+            self.futures[name] = self.pool.submit(decompress, path, self.directory)
+            self.sizes[name] = size
+            self.staged_size += size
+        #
+    #
+    def check(self):
+        # Waits for the packages staged so far, returning the names of any that failed
+        return [ name for name in list(self.futures) if not self.get(name) ]
+    #
+    def get(self, name):
+        # Returns the path to the staged package (waiting for it if necessary), or None if the package is corrupt
+        result = None
+        future = self.futures.get(name)
+        if future:
+            try:
+                result = future.result()
+            except (OSError, EOFError, lzma.LZMAError, tarfile.TarError) as e:
+                self.log.error('Unable to stage package %s: %s', name, e)
+            #
+        #
+        return result
+    #
+    def release(self, name):
+        # Removes a staged package once the package tools are finished with it, making room to stage the next one
+        future = self.futures.pop(name, None)
+        if future:
+            path = self.get_path(future)
+            if path and path.startswith(self.directory + os.sep):
+                os.remove(path)
+            #
+            self.staged_size -= self.sizes.pop(name)
+            self.fill()
+        #
+    #
+    def get_path(self, future):
+        result = None
+        if future.done() and not future.cancelled() and future.exception() is None:
+            result = future.result()
+        #
+        return result
+    #
+    def close(self):
+        if self.pool:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+        #
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+        #
+        self.queue.clear()
+        self.futures.clear()
+        self.sizes.clear()
+        self.staged_size = 0
+    #
+#
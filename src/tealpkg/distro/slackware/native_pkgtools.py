@@ -0,0 +1,436 @@
+# In-process replacement for the Slackware package tools (installpkg, upgradepkg, and removepkg), which maintains the
+# same package database in /var/lib/pkgtools.
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import collections
+import copy
+import logging
+import lzma
+import math
+import os
+import pathlib
+import re
+import shutil
+import tarfile
+import time
+
+from tealpkg.cli.colorprint import cprint
+from tealpkg.util.atomic_write import atomic_write
+from tealpkg.util.run import log_run
+
+from .pkgtools import package_base, splitpkg
+
+
+# Symbolic links created by the doinst.sh scripts that makepkg generates (also recognized by removepkg)
+LINK_LINE = re.compile(r'^\( cd (\S+) ; ln -sf (\S+) (\S+) \)$')
+
+# Database directories, and where their entries are moved when a package is upgraded or removed
+RETIRED_DIRS = {
+    'douninst.sh': 'removed_uninstall_scripts',
+    'packages': 'removed_packages',
+    'scripts': 'removed_scripts',
+}
+
+
+def human_size(size):
+    '''
+    Formats a size in bytes in the style of "du -h", which installpkg uses in the package database.
+
+    size   --   size in bytes
+    '''
+    value = size / 1024
+    unit = 0
+    while value >= 1024 and unit < 3:
+        value /= 1024
+        unit += 1
+    #
+
+    if value < 10:
+        text = format(math.ceil(value * 10) / 10, '.1f')
+    else:
+        text = str(math.ceil(value))
+    #
+
+    return text + 'KMGT'[unit]
+#
+
+
+def list_name(member):
+    '''
+    Returns the name of a tar archive member as it appears in the FILE LIST of the package database.
+
+    member   --   tarfile.TarInfo object
+    '''
+    name = member.name.removeprefix('./') or './'
+    if member.isdir() and not name.endswith('/'):
+        name += '/'
+    #
+    return name
+#
+
+
+def read_links(script_path):
+    '''
+    Returns the set of symbolic links (relative to the root) created by a doinst.sh script.
+
+    script_path   --   path to the script
+    '''
+    result = set()
+    if os.path.exists(script_path):
+        with open(script_path, 'r', errors='replace') as fh:
+            for line in fh:
+                match = LINK_LINE.match(line.strip())
+                if match:
+                    result.add(os.path.normpath(os.path.join(match.group(1), match.group(3))))
+                #
+            #
+        #
+    #
+    return result
+#
+
+
+class NativePkgtools:
+    def __init__(self, adm_dir='/var/lib/pkgtools', root='/', dry_run=False, quiet=False, log_output=False):
+        '''
+        Constructor. Provides the same install, upgrade, and remove interface as Pkgtools.
+
+        adm_dir      --   package database directory
+        root         --   root directory into which packages are installed
+        dry_run      --   report the operations without performing them
+        quiet        --   suppress output
+        log_output   --   log the operations and the output of the package scripts
+        '''
+        self.adm_dir = pathlib.PosixPath(adm_dir)
+        self.root = root
+        self.dry_run = dry_run
+        self.quiet = quiet
+        self.log_output = log_output
+        self.files = None
+        self.links = None
+        self.file_owners = collections.Counter()
+        self.link_owners = collections.Counter()
+        # Original paths of staged (decompressed) packages, which are recorded in the database in place of the
+        # temporary staging path
+        self.locations = {}
+        self.log = logging.getLogger(__name__)
+    #
+    def message(self, *args):
+        if not self.quiet:
+            cprint(*args)
+        #
+        if self.log_output:
+            self.log.info(' '.join(str(arg) for arg in args))
+        #
+    #
+    def load_db(self):
+        '''
+        Loads the file lists and script links of the installed packages, which are then kept up to date in memory
+        instead of being reread for every operation.
+        '''
+        if self.files is None:
+            self.files = {}
+            self.links = {}
+            for item in sorted(self.adm_dir.joinpath('packages').glob('*')):
+                files = set()
+                with open(item, 'r', errors='replace') as fh:
+                    in_file_list = False
+                    for line in fh:
+                        if in_file_list:
+                            files.add(line.rstrip('\n'))
+                        elif line.startswith('FILE LIST:'):
+                            in_file_list = True
+                        #
+                    #
+                #
+                self.add_entry(item.name, files, read_links(self.adm_dir.joinpath('scripts', item.name)))
+            #
+        #
+    #
+    def add_entry(self, base, files, links):
+        self.files[base] = files
+        self.links[base] = links
+        self.file_owners.update(files)
+        self.link_owners.update(links)
+    #
+    def drop_entry(self, base):
+        files = self.files.pop(base, set())
+        links = self.links.pop(base, set())
+        self.file_owners.subtract(files)
+        self.link_owners.subtract(links)
+        return (files, links)
+    #
+    def installed(self, name):
+        # Returns the installed package bases for a short package name (or full package base)
+        result = []
+        for base in self.files:
+            info = splitpkg(base)
+            if base == name or (info and info.name == name):
+                result.append(base)
+            #
+        #
+        return result
+    #
+    def remove_unowned(self, files, links):
+        '''
+        Removes the files, directories, and script-created links of a package that no installed package owns.
+        Directories are only removed once empty, deepest first.
+
+        files   --   FILE LIST entries of the package
+        links   --   links created by the package doinst.sh script
+        '''
+        directories = []
+        for entry in files:
+            if entry != './' and not entry.startswith('install/') and self.file_owners[entry] <= 0:
+                path = os.path.join(self.root, entry)
+                if entry.endswith('/'):
+                    directories.append(path)
+                elif os.path.lexists(path) and not os.path.isdir(path):
+                    os.unlink(path)
+                #
+            #
+        #
+
+        for entry in links:
+            path = os.path.join(self.root, entry)
+            if self.link_owners[entry] <= 0 and os.path.islink(path):
+                os.unlink(path)
+            #
+        #
+
+        for path in sorted(directories, key=len, reverse=True):
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass   # not empty, or already gone
+            #
+        #
+    #
+    def retire(self, base, reason):
+        # Moves the database entries of a package aside, as upgradepkg and removepkg do
+        stamp = time.strftime('%Y-%m-%d,%H:%M:%S')
+        for subdir in RETIRED_DIRS:
+            path = self.adm_dir.joinpath(subdir, base)
+            if path.exists():
+                dest = self.adm_dir.joinpath(RETIRED_DIRS[subdir])
+                dest.mkdir(mode=0o755, parents=True, exist_ok=True)
+                os.replace(path, dest.joinpath(base + '-' + reason + '-' + stamp))
+            #
+        #
+    #
+    def check_members(self, members):
+        # Raises PackageError for any member that would be extracted (or hard linked) outside of the root
+        for member in members:
+            names = [ member.name ]
+            if member.islnk():
+                names.append(member.linkname)
+            #
+            for name in names:
+                if name.startswith('/') or '..' in pathlib.PurePosixPath(name).parts:
+                    raise PackageError('Unsafe path in package: ' + name)
+            ######
+        #
+    #
+    def extract(self, tar, member):
+        target = os.path.join(self.root, member.name)
+        if member.isdir() and os.path.isdir(target):
+            # Keep existing directories (and symbolic links to directories), only updating their attributes
+            if not os.path.islink(target):
+                tar.chown(member, target, False)
+                tar.chmod(member, target)
+            #
+        elif member.isfile():
+            # Replace regular files by renaming, so that running programs keep their open copies
+            temp = copy.copy(member)
+            temp.name = os.path.join(os.path.dirname(member.name), '.' + os.path.basename(member.name) + '.tealpkg-new')
+            tar.extract(temp, self.root)
+            os.replace(os.path.join(self.root, temp.name), target)
+        else:
+            if os.path.lexists(target) and not os.path.isdir(target):
+                os.unlink(target)
+            #
+            tar.extract(member, self.root)
+        #
+    #
+    def write_entry(self, path, base, desc, files, usize):
+        location = self.locations.get(path, path)
+        lines = [ 'PACKAGE NAME:     ' + base,
+                  'COMPRESSED PACKAGE SIZE:     ' + human_size(os.stat(location).st_size),
+                  'UNCOMPRESSED PACKAGE SIZE:     ' + human_size(usize),
+                  'PACKAGE LOCATION: ' + str(location),
+                  'PACKAGE DESCRIPTION:' ]
+        lines.extend(desc)
+        lines.append('FILE LIST:')
+        lines.extend(files)
+        self.adm_dir.joinpath('packages').mkdir(mode=0o755, parents=True, exist_ok=True)
+        atomic_write(self.adm_dir.joinpath('packages', base), '\n'.join(lines) + '\n')
+    #
+    def install_script(self, name, subdir, base):
+        # Copies a script from the install directory of the extracted package into the database
+        source = os.path.join(self.root, 'install', name)
+        dest = self.adm_dir.joinpath(subdir, base)
+        if os.path.exists(source):
+            dest.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+            shutil.copyfile(source, dest)
+        else:
+            dest.unlink(missing_ok=True)
+        #
+    #
+    def install_package(self, path, base, old):
+        status = 0
+        info = splitpkg(base)
+        desc = []
+        files = []
+
+        with tarfile.open(path, 'r:*') as tar:
+            tar.extraction_filter = getattr(tarfile, 'fully_trusted_filter', None)
+            members = tar.getmembers()
+            self.check_members(members)
+            for member in members:
+                name = list_name(member)
+                files.append(name)
+                if name == 'install/slack-desc' and member.isfile():
+                    text = tar.extractfile(member).read().decode('utf-8', errors='replace')
+                    desc = [ line for line in text.splitlines() if line.startswith(info.name + ':') ]
+                #
+                self.extract(tar, member)
+            #
+        #
+
+        if os.path.exists(os.path.join(self.root, 'install', 'doinst.sh')):
+            status = log_run([ '/bin/sh', 'install/doinst.sh', '-install' ], self.quiet, self.log_output, cwd=self.root)
+        #
+        self.install_script('doinst.sh', 'scripts', base)
+        self.install_script('douninst.sh', 'douninst.sh', base)
+
+        # Files of the old package(s) that the new package no longer provides are removed, unless another package
+        # also owns them
+        dropped = [ self.drop_entry(item) for item in old ]
+        self.add_entry(base, set(files), read_links(self.adm_dir.joinpath('scripts', base)))
+        for old_files, old_links in dropped:
+            self.remove_unowned(old_files, old_links)
+        #
+        for item in old:
+            if item != base:
+                self.retire(item, 'upgraded')
+            #
+        #
+
+        self.write_entry(path, base, desc, files, sum(member.size for member in members))
+        shutil.rmtree(os.path.join(self.root, 'install'), ignore_errors=True)
+
+        if old and old != [ base ]:
+            self.message('Package', ', '.join(old), 'upgraded with new package', base + '.')
+        else:
+            self.message('Package', base, 'installed.')
+        #
+
+        return status
+    #
+    def upgrade_package(self, path, install_new=False, reinstall=False):
+        status = 0
+        base = package_base(path)
+
+        if self.dry_run:
+            cprint('DRY RUN:', 'install' if install_new else 'upgrade', path, style='notice')
+        elif not splitpkg(base):
+            self.log.error('Invalid package name: %s', path)
+            status = 1
+        else:
+            self.load_db()
+            old = self.installed(splitpkg(base).name)
+            if base in old and not reinstall:
+                self.message('Package', base, 'is already installed: skipping.')
+            elif not old and not install_new:
+                self.log.error('Cannot upgrade %s: no package named %s is installed', base, splitpkg(base).name)
+                status = 1
+            else:
+                try:
+                    status = self.install_package(path, base, old)
+                except (OSError, EOFError, lzma.LZMAError, tarfile.TarError, PackageError) as e:
+                    cprint('Unable to install', path + ':', e, style='error', stderr=True)
+                    self.log.error('Unable to install %s: %s', path, e)
+                    status = 1
+                #
+            #
+        #
+
+        if status != 0:
+            self.log.error('Package operation failed for %s with status %d', path, status)
+        #
+
+        return status
+    #
+    def install(self, package_path):
+        # Same behavior as "upgradepkg --install-new --reinstall", the default install command
+        return self.upgrade_package(package_path, install_new=True, reinstall=True)
+    #
+    def upgrade(self, package_path):
+        return self.upgrade_package(package_path)
+    #
+    def remove(self, package_name):
+        status = 0
+
+        if self.dry_run:
+            cprint('DRY RUN: remove', package_name, style='notice')
+        else:
+            self.load_db()
+            bases = self.installed(package_name)
+            if not bases:
+                self.log.error('Cannot remove %s: package is not installed', package_name)
+                status = 1
+            #
+            for base in bases:
+                script = self.adm_dir.joinpath('douninst.sh', base)
+                if script.exists():
+                    status = log_run([ '/bin/sh', str(script) ], self.quiet, self.log_output, cwd=self.root) or status
+                #
+                try:
+                    self.remove_unowned(*self.drop_entry(base))
+                    self.retire(base, 'removed')
+                    self.message('Package', base, 'removed.')
+                except OSError as e:
+                    cprint('Unable to remove', base + ':', e, style='error', stderr=True)
+                    self.log.error('Unable to remove %s: %s', base, e)
+                    status = 1
+                #
+            #
+        #
+
+        return status
+    #
+    def install_batch(self, package_paths):
+        return [ self.install(path) for path in package_paths ]
+    #
+    def upgrade_batch(self, package_paths):
+        return [ self.upgrade(path) for path in package_paths ]
+    #
+    def remove_batch(self, package_names):
+        return [ self.remove(name) for name in package_names ]
+    #
+#
+
+
+class PackageError(Exception):
+    pass
+#
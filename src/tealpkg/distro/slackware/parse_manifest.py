@@ -73,6 +73,7 @@ def parse_manifest(path_to_manifest, output_database_path):
             #
         #
     #
+    cursor.execute('''CREATE INDEX 'manifest_package' ON 'manifest' ('package');''')
     db.commit()
     db.close()
 #
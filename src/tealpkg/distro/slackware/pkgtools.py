@@ -28,10 +28,10 @@
 import collections
 import logging
 import os.path
+import pathlib
 import re
 import shlex
 import subprocess
-import time
 
 from tealpkg.cli.colorprint import cprint
 from tealpkg.util.run import log_run
@@ -42,6 +42,9 @@ REMOVEPKG = '/sbin/removepkg'
 
 PKG_EXT = re.compile('.*\.t[a-z]z$')
 
+# Lines in pkgtools output that indicate the current package failed
+ERROR_LINE = re.compile(r'^\s*(Cannot install|Error|ERROR|Unable to)\b')
+
 
 def splitpkg(filename):
     '''
@@ -65,14 +68,75 @@ def splitpkg(filename):
 #
 
 
+def package_base(path):
+    '''
+    Returns the package name without its directory or extension (e.g. foo-1.0-x86_64-1).
+
+    path   --   path to a package file (which may also be an uncompressed .tar)
+    '''
+    name = pathlib.PurePosixPath(path).name
+    if PKG_EXT.match(name) or name.endswith('.tar'):
+        name = name[0:-4]
+    #
+    return name
+#
+
+
+class BatchOutput:
+    def __init__(self, names):
+        '''
+        Constructor. Attributes the output of a pkgtools command run on several packages to the individual packages.
+        Each line belongs to the package most recently named in the output.
+
+        names   --   short names of the packages in the batch
+        '''
+        self.names = set(names)
+        self.current = None
+        self.partial = ''
+        self.output = { name: [] for name in names }
+        self.errors = set()
+    #
+    def feed(self, text):
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.parse_line(line)
+        #
+    #
+    def finish(self):
+        if self.partial:
+            self.parse_line(self.partial)
+            self.partial = ''
+        #
+    #
+    def parse_line(self, line):
+        for word in line.split():
+            info = splitpkg(package_base(word.strip('.:,;()\'"')))
+            if info and info.name in self.names:
+                self.current = info.name
+                break
+            #
+        #
+        if self.current:
+            self.output[self.current].append(line)
+            if ERROR_LINE.match(line):
+                self.errors.add(self.current)
+            #
+        #
+    #
+#
+
+
 class Pkgtools:
-    def __init__(self, installpkg=INSTALLPKG, upgradepkg=UPGRADEPKG, removepkg=REMOVEPKG, dry_run=False, quiet=False, log_output=False):
+    def __init__(self, installpkg=INSTALLPKG, upgradepkg=UPGRADEPKG, removepkg=REMOVEPKG, dry_run=False, quiet=False, log_output=False, \
+                 package_db=None):
         self.installpkg = shlex.split(installpkg)
         self.upgradepkg = shlex.split(upgradepkg)
         self.removepkg = shlex.split(removepkg)
         self.dry_run = dry_run
         self.quiet = quiet
         self.log_output = log_output
+        self.package_db = package_db
         self.log = logging.getLogger(__name__)
     #
     def run(self, args):
@@ -80,7 +144,6 @@ class Pkgtools:
 
         if self.dry_run:
             cprint('DRY RUN:', ' '.join(args), style='notice')
-            time.sleep(1)
         else:
             status = log_run(args, self.quiet, self.log_output)
             if status != 0:
@@ -99,4 +162,60 @@ class Pkgtools:
     def remove(self, package_name):
         return self.run(self.removepkg + [ package_name ])
     #
+    def check_db(self, name, base):
+        # Checks the package database (if known) for the outcome of an operation: base is installed, or, if base is
+        # None, no package called name remains
+        result = True
+        if self.package_db:
+            installed = []
+            for item in pathlib.PosixPath(self.package_db).glob(name + '-*'):
+                info = splitpkg(item.name)
+                if info and info.name == name:
+                    installed.append(item.name)
+                #
+            #
+            result = (base in installed) if base else (len(installed) == 0)
+        #
+        return result
+    #
+    def run_batch(self, command, items, bases):
+        # Runs a single command for several packages, returning a list with the status of each package
+        result = []
+        names = [ splitpkg(base).name if base else item for item, base in zip(items, bases) ]
+        parser = BatchOutput(names)
+        status = 0
+
+        if self.dry_run:
+            cprint('DRY RUN:', ' '.join(command + items), style='notice')
+        else:
+            status = log_run(command + items, self.quiet, self.log_output, on_output=parser.feed)
+            parser.finish()
+        #
+
+        for name, base in zip(names, bases):
+            check = 0
+            if not self.dry_run:
+                ok = name not in parser.errors and self.check_db(name, base)
+                if not self.package_db:
+                    ok = ok and status == 0
+                #
+                check = 0 if ok else (status or 1)
+            #
+            if check != 0:
+                self.log.error('Batched operation failed for %s: %s', name, ' | '.join(parser.output[name]))
+            #
+            result.append(check)
+        #
+
+        return result
+    #
+    def install_batch(self, package_paths):
+        return self.run_batch(self.installpkg, package_paths, [ package_base(path) for path in package_paths ])
+    #
+    def upgrade_batch(self, package_paths):
+        return self.run_batch(self.upgradepkg, package_paths, [ package_base(path) for path in package_paths ])
+    #
+    def remove_batch(self, package_names):
+        return self.run_batch(self.removepkg, package_names, [ None ] * len(package_names))
+    #
 #
@@ -0,0 +1,327 @@
+# Builds Slackware repository metadata (PACKAGES.TXT, MANIFEST.bz2, and CHECKSUMS.md5) for a package tree.
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import bz2
+import concurrent.futures
+import json
+import logging
+import math
+import os
+import pathlib
+import stat
+import subprocess
+import tarfile
+import time
+
+from tealpkg.util.atomic_write import atomic_write
+from tealpkg.util.digest import file_digest
+
+from .pkgtools import PKG_EXT, splitpkg
+
+
+# Cache of previously scanned packages, kept in the root of the tree, so that rebuilds only rescan changed packages
+CACHE_NAME = '.repo-build.json'
+
+# Incremented whenever the format of a cached scan result changes
+CACHE_VERSION = 1
+
+SEPARATOR = '++' + '=' * 40
+
+
+def format_member(member):
+    '''
+    Formats a tar archive member in the style of "tar tvf", as used in MANIFEST files.
+
+    member   --   tarfile.TarInfo object
+    '''
+    mode = member.mode
+    if member.isdir():
+        mode |= stat.S_IFDIR
+    elif member.issym():
+        mode |= stat.S_IFLNK
+    elif member.ischr():
+        mode |= stat.S_IFCHR
+    elif member.isblk():
+        mode |= stat.S_IFBLK
+    elif member.isfifo():
+        mode |= stat.S_IFIFO
+    else:
+        mode |= stat.S_IFREG
+    #
+
+    owner = (member.uname or str(member.uid)) + '/' + (member.gname or str(member.gid))
+    date = time.strftime('%Y-%m-%d %H:%M', time.gmtime(member.mtime))
+    name = member.name.removeprefix('./') or './'
+    if member.isdir() and not name.endswith('/'):
+        name += '/'
+    #
+    if member.issym():
+        name += ' -> ' + member.linkname
+    elif member.islnk():
+        name += ' link to ' + member.linkname
+    #
+
+    return stat.filemode(mode) + ' ' + owner + ' ' + str(member.size).rjust(10) + ' ' + date + ' ' + name
+#
+
+
+def scan_package(path):
+    '''
+    Reads a package file and returns a dictionary with its compressed and uncompressed sizes, MD5 digest, description
+    (from install/slack-desc), and MANIFEST file listing. Runs in a worker process.
+
+    path   --   path to the package file
+    '''
+    info = splitpkg(pathlib.PurePosixPath(path).name)
+    result = { 'csize': os.stat(path).st_size, 'usize': 0, 'md5': file_digest(path), 'desc': [], 'files': [] }
+
+    with tarfile.open(path, 'r:*') as tar:
+        for member in tar:
+            result['usize'] += member.size
+            result['files'].append(format_member(member))
+            if member.name.removeprefix('./') == 'install/slack-desc' and member.isfile():
+                text = tar.extractfile(member).read().decode('utf-8', errors='replace')
+                for line in text.splitlines():
+                    if line.startswith(info.name + ':'):
+                        result['desc'].append(line.rstrip())
+                    #
+                #
+            #
+        #
+    #
+
+    if not result['desc']:
+        result['desc'].append(info.name + ': ' + info.name)
+    #
+
+    return result
+#
+
+
+def format_size(size):
+    return str(math.ceil(size / 1024)) + ' K'
+#
+
+
+def sign_file(path, key=None):
+    '''
+    Creates a detached, ASCII-armored GPG signature (path + ".asc") for a file. Returns True on success.
+
+    path   --   path to the file to sign
+    key    --   optional ID of the signing key (the default key is used otherwise)
+    '''
+    command = [ 'gpg', '--batch', '--yes', '--armor', '--detach-sign', '--output', str(path) + '.asc' ]
+    if key:
+        command += [ '--local-user', key ]
+    #
+    command.append(str(path))
+    return subprocess.run(command).returncode == 0
+#
+
+
+class RepoBuilder:
+    def __init__(self, directory, workers=0, sign=False, key=None, full=False):
+        '''
+        Constructor.
+
+        directory   --   root of the package tree
+        workers     --   number of worker processes used to scan packages (0 for one per CPU)
+        sign        --   sign the metadata and any unsigned packages using gpg
+        key         --   ID of the signing key (None for the gpg default)
+        full        --   rescan every package, ignoring the cache of previous scans
+        '''
+        self.root = pathlib.PosixPath(directory)
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.sign = sign
+        self.key = key
+        self.full = full
+        self.cache_path = self.root.joinpath(CACHE_NAME)
+        self.log = logging.getLogger(__name__)
+    #
+    def load_cache(self):
+        result = {}
+        if self.cache_path.exists() and not self.full:
+            try:
+                with open(self.cache_path, 'r') as fh:
+                    data = json.load(fh)
+                #
+                if data.get('version') == CACHE_VERSION:
+                    result = data.get('packages', {})
+                #
+            except (OSError, ValueError) as e:
+                self.log.warning('Ignoring unreadable repository build cache %s: %s', self.cache_path, e)
+            #
+        #
+        return result
+    #
+    def find_packages(self):
+        result = []
+        for path in sorted(self.root.rglob('*.t?z')):
+            if PKG_EXT.match(path.name) and splitpkg(path.name) and path.is_file():
+                result.append('./' + path.relative_to(self.root).as_posix())
+            #
+        #
+        return result
+    #
+    def scan(self, relpaths, progress=None):
+        '''
+        Returns a dictionary of scan results for the given packages, rescanning only those that have changed since the
+        previous build (by size and modification time).
+
+        relpaths   --   relative paths of the packages
+        progress   --   optional callback, called with (completed, total) as packages are scanned
+        '''
+        cache = self.load_cache()
+        result = {}
+        pending = []
+
+        for relpath in relpaths:
+            st = self.root.joinpath(relpath).stat()
+            key = [ st.st_size, st.st_mtime_ns ]
+            if relpath in cache and cache[relpath].get('key') == key:
+                result[relpath] = cache[relpath]
+            else:
+                pending.append( (relpath, key) )
+            #
+        #
+
+        self.log.info('Scanning %d of %d packages in %s', len(pending), len(relpaths), self.root)
+        if pending:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+                futures = { pool.submit(scan_package, self.root.joinpath(relpath).as_posix()): (relpath, key) \
+                        for relpath, key in pending }
+                done = 0
+                for future in concurrent.futures.as_completed(futures):
+                    relpath, key = futures[future]
+                    try:
+                        entry = future.result()
+                        entry['key'] = key
+                        result[relpath] = entry
+                    except (OSError, tarfile.TarError, EOFError) as e:
+                        self.log.error('Unable to read package %s: %s', relpath, e)
+                        raise RepoBuildError('Unable to read package ' + relpath + ': ' + str(e))
+                    #
+                    done += 1
+                    if progress:
+                        progress(done, len(pending))
+                    #
+                #
+            #
+        #
+
+        atomic_write(self.cache_path, json.dumps({ 'version': CACHE_VERSION, 'packages': result }))
+        return result
+    #
+    def write_packages(self, scanned):
+        csize = sum(scanned[relpath]['csize'] for relpath in scanned)
+        usize = sum(scanned[relpath]['usize'] for relpath in scanned)
+        lines = [ 'PACKAGES.TXT;  ' + time.strftime('%a %b %d %H:%M:%S UTC %Y', time.gmtime()), '',
+                'This file provides details on the packages found in this repository.', '',
+                'Total size of all packages (compressed):  ' + str(int(round(csize / 1048576))) + ' MB',
+                'Total size of all packages (uncompressed):  ' + str(int(round(usize / 1048576))) + ' MB', '', '' ]
+
+        for relpath in sorted(scanned, key=lambda r: pathlib.PurePosixPath(r).name):
+            entry = scanned[relpath]
+            path = pathlib.PurePosixPath(relpath)
+            location = path.parent.as_posix()
+            lines.append('PACKAGE NAME:  ' + path.name)
+            lines.append('PACKAGE LOCATION:  ' + ('./' if location == '.' else './' + location))
+            lines.append('PACKAGE SIZE (compressed):  ' + format_size(entry['csize']))
+            lines.append('PACKAGE SIZE (uncompressed):  ' + format_size(entry['usize']))
+            lines.append('PACKAGE DESCRIPTION:')
+            lines.extend(entry['desc'])
+            lines.append('')
+        #
+
+        atomic_write(self.root.joinpath('PACKAGES.TXT'), '\n'.join(lines) + '\n')
+    #
+    def write_manifest(self, scanned):
+        target = self.root.joinpath('MANIFEST.bz2')
+        temp = target.with_name('.' + target.name + '.tmp')
+        with bz2.open(temp, 'wt', encoding='utf-8') as fh:
+            for relpath in sorted(scanned):
+                fh.write(SEPARATOR + '\n||\n||   Package:  ' + relpath + '\n||\n' + SEPARATOR + '\n')
+                for line in scanned[relpath]['files']:
+                    fh.write(line + '\n')
+                #
+                fh.write('\n\n')
+            #
+        #
+        os.chmod(temp, 0o644)
+        os.replace(temp, target)
+    #
+    def write_checksums(self, scanned):
+        lines = []
+        skip = ( CACHE_NAME, 'CHECKSUMS.md5', 'CHECKSUMS.md5.asc' )
+        for path in sorted(self.root.rglob('*')):
+            relpath = './' + path.relative_to(self.root).as_posix()
+            if path.is_file() and path.name not in skip and not path.name.startswith('.'):
+                if relpath in scanned:
+                    digest = scanned[relpath]['md5']
+                else:
+                    digest = file_digest(path)
+                #
+                lines.append(digest + '  ' + relpath)
+            #
+        #
+        atomic_write(self.root.joinpath('CHECKSUMS.md5'), '\n'.join(lines) + '\n')
+    #
+    def build(self, progress=None):
+        '''
+        Scans the package tree and writes PACKAGES.TXT, MANIFEST.bz2, and CHECKSUMS.md5 (signing packages and the
+        checksum file if requested). Returns the number of packages in the repository. Raises RepoBuildError on
+        failure.
+
+        progress   --   optional callback, called with (completed, total) as packages are scanned
+        '''
+        relpaths = self.find_packages()
+        scanned = self.scan(relpaths, progress)
+
+        if self.sign:
+            for relpath in relpaths:
+                path = self.root.joinpath(relpath)
+                sig = path.with_name(path.name + '.asc')
+                if not sig.exists() or sig.stat().st_mtime < path.stat().st_mtime:
+                    if not sign_file(path, self.key):
+                        raise RepoBuildError('Unable to sign ' + relpath)
+                    #
+                #
+            #
+        #
+
+        self.write_packages(scanned)
+        self.write_manifest(scanned)
+        self.write_checksums(scanned)
+
+        if self.sign and not sign_file(self.root.joinpath('CHECKSUMS.md5'), self.key):
+            raise RepoBuildError('Unable to sign CHECKSUMS.md5')
+        #
+
+        return len(relpaths)
+    #
+#
+
+
+class RepoBuildError(Exception):
+    pass
+#
@@ -22,55 +22,34 @@
 
 
 # TODO: refactor for MVC
-# TODO: probably good to load the checksums into a data structure instead of hitting the file every time
 
-import hashlib
 import logging
 import pathlib
 
 from tealpkg.cli.colorprint import cprint
 
 
-def verify_checksum(path_to_checksums, path_to_check, entry_name):
-    result = False
-    compare = ''
+def load_checksums(path_to_checksums):
+    '''
+    Parses a CHECKSUMS.md5 file into a dictionary that maps each relative path (e.g. ./PACKAGES.TXT) to its lowercase
+    MD5 digest. Returns an empty dictionary if the file does not exist.
+
+    path_to_checksums   --   path to the CHECKSUMS.md5 file
+    '''
+    result = {}
     logger = logging.getLogger(__name__)
 
     checksums_path = pathlib.PosixPath(path_to_checksums)
     if checksums_path.exists():
-        logger.debug('Looking for %s in CHECKSUMS.md5', entry_name)
-        with open(path_to_checksums, 'r') as fh:
-            line = fh.readline()
-            while line:
+        with open(path_to_checksums, 'r', encoding='utf-8', errors='replace') as fh:
+            for line in fh:
                 parts = line.split()
-                if len(parts) == 2 and parts[1] == entry_name:
-                    compare = parts[0].lower()
-                    break
+                if len(parts) == 2 and len(parts[0]) == 32:
+                    result[parts[1]] = parts[0].lower()
                 #
-                line = fh.readline()
             #
         #
-
-        if compare:
-            check_path = pathlib.PosixPath(path_to_check)
-            if check_path.exists():
-                with open(path_to_check, 'rb') as fh:
-                    md = hashlib.md5()
-                    md.update(fh.read())
-                    if md.hexdigest().lower() == compare:
-                        result = True
-                    else:
-                        cprint('Incorrect MD5 checksum:', path_to_check, style='error', stderr=True)
-                        logger.error('Incorrect MD5 checksum for %s', check_path)
-                    #
-                #
-            else:
-                cprint('Missing file:', path_to_check, style='error', stderr=True)
-                logger.error('No comparison file: %s', check_path)
-        else:
-            cprint('Incomplete CHECKSUMS.md5:', path_to_checksums, style='error', stderr=True)
-            logger.error('Missing %s from CHECKSUMS.md5', compare)
-        #
+        logger.debug('Loaded %d entries from %s', len(result), checksums_path)
     else:
         cprint('Missing CHECKSUMS.md5', style='error', stderr=True)
         logger.error('CHECKSUMS.md5 not found: %s', checksums_path)
@@ -78,3 +57,4 @@ def verify_checksum(path_to_checksums, path_to_check, entry_name):
 
     return result
 #
+
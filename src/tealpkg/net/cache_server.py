@@ -0,0 +1,266 @@
+# HTTP server that publishes the package cache as a mirror for other hosts.
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import http.server
+import logging
+import os
+import pathlib
+import re
+import threading
+
+from urllib.parse import unquote, urlparse
+
+
+BLOCK_SIZE = 1 << 20
+
+
+class CacheServer(http.server.ThreadingHTTPServer):
+    '''
+    Serves the cached metadata, packages, and signatures of the configured repositories over HTTP, using the same
+    layout as an upstream mirror. A path is mapped to a repository either by a leading repository ID (for example,
+    /slackware64/PACKAGES.TXT) or by the repository's mirror subdirectory (for example,
+    /slackware64-15.0/PACKAGES.TXT), so that the server may be listed in a shared mirror list. Files that are not yet
+    cached are obtained from the upstream mirrors on demand, and each file is only fetched once at a time. Clients
+    still verify every file themselves, using their own keys.
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, repolist, metadata_lock=None):
+        '''
+        Constructor.
+
+        address         --   (host, port) tuple on which to listen
+        repolist        --   list of Repository objects with loaded metadata
+        metadata_lock   --   optional FileLock on the metadata cache, taken exclusively (only) while refreshing
+        '''
+        http.server.ThreadingHTTPServer.__init__(self, address, CacheRequestHandler)
+        self.repolist = repolist
+        self.lock = threading.Lock()
+        self.file_locks = {}
+        self.repo_locks = { repo.repoid: threading.Lock() for repo in repolist }
+        self.metadata_lock = metadata_lock
+        self.refresh_lock = threading.Lock()
+        self.package_maps = {}
+        self.log = logging.getLogger(__name__)
+
+        for repo in repolist:
+            self.map_packages(repo)
+        #
+    #
+    def map_packages(self, repo):
+        self.package_maps[repo.repoid] = { repo.packages[name].relpath: repo.packages[name] for name in repo.packages }
+    #
+    def file_lock(self, key):
+        with self.lock:
+            if key not in self.file_locks:
+                self.file_locks[key] = threading.Lock()
+            #
+            result = self.file_locks[key]
+        #
+        return result
+    #
+    def find_repo(self, path):
+        '''
+        Returns a (repository, relpath) tuple for a request path, or (None, None) if no repository matches.
+
+        path   --   decoded request path
+        '''
+        result = (None, None)
+        parts = pathlib.PurePosixPath(path).parts[1:]
+        if '..' not in parts and len(parts) > 1:
+            best = -1
+            for repo in self.repolist:
+                prefix = pathlib.PurePosixPath(repo.subdirectory).parts
+                if repo.repoid == parts[0] and best < 1:
+                    result = (repo, '/'.join(parts[1:]))
+                    best = 1
+                elif prefix and parts[:len(prefix)] == prefix and len(parts) > len(prefix) and len(prefix) > best:
+                    result = (repo, '/'.join(parts[len(prefix):]))
+                    best = len(prefix)
+                #
+            #
+        #
+        return result
+    #
+    def metadata_files(self, repo):
+        files = [ 'CHECKSUMS.md5', 'CHECKSUMS.md5.asc', 'PACKAGES.TXT', repo.manifest_path ]
+        return { pathlib.PurePosixPath(item).as_posix(): pathlib.PurePosixPath(item).name for item in files }
+    #
+    def refresh(self, repo):
+        '''
+        Refreshes the metadata for a repository, or loads the generation published by another tealpkg process. The
+        metadata lock (if any) is held exclusively for the refresh only, and should be created with a short timeout,
+        since requests for the repository's metadata wait for the refresh. If another process holds the lock, the
+        metadata already loaded continue to be served, and the refresh is tried again on a later request.
+
+        repo   --   Repository to refresh
+        '''
+        with self.refresh_lock:
+            locked = self.metadata_lock is None or self.metadata_lock.acquire(exclusive=True)
+            current = repo.generations.current()
+            if locked or (current and current.as_posix() != repo.metadata_dir):
+                self.log.info('Refreshing metadata for %s', repo.repoid)
+                try:
+                    repo.load_metadata(allow_refresh=locked)
+                finally:
+                    if locked and self.metadata_lock:
+                        self.metadata_lock.release()
+                    #
+                #
+                self.map_packages(repo)
+            else:
+                self.log.warning('Serving expired metadata for %s: metadata lock unavailable', repo.repoid)
+            #
+        #
+    #
+    def obtain(self, repo, relpath):
+        '''
+        Returns the path to the cached copy of a repository file, obtaining it from upstream if necessary, or None if
+        the file is not part of the repository or cannot be obtained.
+
+        repo      --   Repository to which the file belongs
+        relpath   --   path of the file relative to the repository base
+        '''
+        result = None
+        metadata = self.metadata_files(repo)
+        cache = pathlib.PosixPath(repo.cache_dir)
+
+        if relpath in metadata:
+            # Metadata are served from the generation most recently loaded, which is never modified in place, until
+            # it expires or another process publishes a newer one
+            with self.repo_locks[repo.repoid]:
+                current = repo.generations.current()
+                if repo.needs_refresh() or current.as_posix() != repo.metadata_dir:
+                    self.refresh(repo)
+                #
+                directory = repo.metadata_dir
+            #
+            if directory:
+                path = pathlib.PosixPath(directory).joinpath(metadata[relpath])
+                if path.exists():
+                    result = path.as_posix()
+            #####
+        else:
+            signature = relpath.endswith('.asc')
+            package = self.package_maps[repo.repoid].get(relpath.removesuffix('.asc'))
+            if package:
+                path = cache.joinpath(pathlib.PurePosixPath(package.relpath).name)
+                with self.file_lock( (repo.repoid, package.relpath) ):
+                    if not path.exists() or (repo.gpg and not path.with_name(path.name + '.asc').exists()):
+                        self.log.info('Fetching %s for %s', package.relpath, repo.repoid)
+                        filepath = repo.package_filepath(package, repo.make_downloader(quiet=True), quiet=True)
+                        filepath.resolve()
+                    #
+                #
+                if signature:
+                    path = path.with_name(path.name + '.asc')
+                #
+                if path.exists():
+                    result = path.as_posix()
+                #
+            #
+        #
+
+        return result
+    #
+#
+
+
+class CacheRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Handles GET and HEAD requests (including single byte ranges) for files in the cache.
+    '''
+    server_version = 'tealpkg'
+
+    def log_message(self, format, *args):
+        self.server.log.info('%s %s', self.address_string(), format % args)
+    #
+    def do_HEAD(self):
+        self.send_file(False)
+    #
+    def do_GET(self):
+        self.send_file(True)
+    #
+    def send_file(self, send_body):
+        repo, relpath = self.server.find_repo(unquote(urlparse(self.path).path))
+        path = None
+        if repo:
+            path = self.server.obtain(repo, relpath)
+        #
+
+        if path is None:
+            self.send_error(404)
+        else:
+            with open(path, 'rb') as fh:
+                size = os.fstat(fh.fileno()).st_size
+                start = 0
+                end = size - 1
+                code = 200
+
+                match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', '').strip())
+                if match and (match.group(1) or match.group(2)):
+                    if match.group(1):
+                        start = int(match.group(1))
+                        if match.group(2):
+                            end = min(int(match.group(2)), size - 1)
+                        #
+                    else:
+                        start = max(size - int(match.group(2)), 0)
+                    #
+                    code = 206
+                #
+
+                if start >= size or start > end:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */' + str(size))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                else:
+                    self.send_response(code)
+                    self.send_header('Content-Type', 'application/octet-stream')
+                    self.send_header('Content-Length', str(end - start + 1))
+                    self.send_header('Accept-Ranges', 'bytes')
+                    self.send_header('Last-Modified', self.date_time_string(int(os.fstat(fh.fileno()).st_mtime)))
+                    if code == 206:
+                        self.send_header('Content-Range', 'bytes ' + str(start) + '-' + str(end) + '/' + str(size))
+                    #
+                    self.end_headers()
+
+                    if send_body:
+                        fh.seek(start)
+                        remaining = end - start + 1
+                        while remaining > 0:
+                            block = fh.read(min(BLOCK_SIZE, remaining))
+                            if not block:
+                                remaining = 0
+                            else:
+                                self.wfile.write(block)
+                                remaining -= len(block)
+                            #
+                        #
+                    #
+                #
+            #
+        #
+    #
+#
@@ -0,0 +1,145 @@
+# Content-addressed store for deduplicating cached files across repositories.
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import logging
+import os
+import pathlib
+
+
+class ContentStore:
+    '''
+    Content-addressed store of cached files, keyed by MD5 digest. Each file in a repository cache directory is a hard
+    link to an entry in the store, so that a file appearing in several repositories is only downloaded and stored once.
+    Verified detached signatures may be stored alongside each entry, one per signing key, since repositories carrying
+    the same file may sign it with different keys. An entry is no longer needed once no repository links to it (its
+    link count has dropped to 1), at which point it can be removed by prune.
+    '''
+    def __init__(self, root):
+        '''
+        Constructor.
+
+        root   --   directory holding the store
+        '''
+        self.root = pathlib.PosixPath(root)
+        self.root.mkdir(mode=0o755, parents=True, exist_ok=True)
+        self.log = logging.getLogger(__name__)
+    #
+    def entry(self, digest):
+        return self.root.joinpath(digest[0:2], digest)
+    #
+    def signature_entry(self, digest, key):
+        return self.root.joinpath(digest[0:2], digest + '.' + key + '.asc')
+    #
+    def replace_link(self, source, target):
+        # Hard links cannot replace an existing file, so link to a temporary name and rename it into place
+        temp = target.with_name('.' + target.name + '.link')
+        temp.unlink(missing_ok=True)
+        os.link(source, temp)
+        os.replace(temp, target)
+    #
+    def link(self, digest, path, key=None):
+        '''
+        Links the stored file with the given digest (and its signature by the given key, if stored) to path. Any
+        existing signature at path + ".asc" is removed if no such signature is stored. Returns True iff the file was
+        linked.
+
+        digest   --   MD5 digest of the file
+        path     --   path in a repository cache directory
+        key      --   fingerprint of the key whose signature is wanted (None if signatures are not checked)
+        '''
+        result = False
+        source = self.entry(digest)
+        target = pathlib.PosixPath(path)
+        sig_target = target.with_name(target.name + '.asc')
+
+        if source.exists():
+            try:
+                self.replace_link(source, target)
+                sig_source = self.signature_entry(digest, key) if key else None
+                if sig_source and sig_source.exists():
+                    self.replace_link(sig_source, sig_target)
+                else:
+                    sig_target.unlink(missing_ok=True)
+                #
+                result = True
+            except OSError as e:
+                self.log.warning('Unable to link %s from the content store: %s', target, e)
+            #
+        #
+
+        return result
+    #
+    def add(self, digest, path, sig_name=None, key=None):
+        '''
+        Adds a verified file (and optionally its verified signature) to the store, unless already present.
+
+        digest     --   MD5 digest of the file
+        path       --   path to the file in a repository cache directory
+        sig_name   --   path to the detached signature of the file
+        key        --   fingerprint of the key that made the signature (required to store the signature)
+        '''
+        entry = self.entry(digest)
+        try:
+            entry.parent.mkdir(mode=0o755, exist_ok=True)
+            if not entry.exists():
+                os.link(path, entry)
+            #
+            if sig_name and key:
+                sig_entry = self.signature_entry(digest, key)
+                if not sig_entry.exists():
+                    os.link(sig_name, sig_entry)
+            #####
+        except FileExistsError:
+            # Another process added the same entry
+            pass
+        except OSError as e:
+            self.log.warning('Unable to add %s to the content store: %s', path, e)
+        #
+    #
+    def prune(self):
+        '''
+        Removes entries that are no longer linked from any repository cache directory. Returns a (count, size) tuple
+        giving the number of files removed and the number of bytes freed.
+        '''
+        count = 0
+        size = 0
+
+        # Sorting places each data file before its signature, so orphaned signatures are removed in the same pass
+        for entry in sorted(self.root.glob('??/*')):
+            if entry.name.endswith('.asc'):
+                # Signatures stored without a key (<digest>.asc) are no longer used
+                data = entry.with_name(entry.name.partition('.')[0])
+                unused = not data.exists() or entry.name.count('.') < 2
+            else:
+                unused = entry.stat().st_nlink <= 1
+            #
+            if unused:
+                size += entry.stat().st_size
+                entry.unlink(missing_ok=True)
+                count += 1
+            #
+        #
+
+        return (count, size)
+    #
+#
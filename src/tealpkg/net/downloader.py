@@ -25,25 +25,84 @@
 # TODO: consider dropping PyCURL dependency and using Python native code for downloading
 
 
+import hashlib
+import logging
+import os
 import pathlib
 import pycurl
+import time
 import traceback
 
 from urllib.parse import urlparse
 
 from tealpkg.cli.colorprint import cprint
 from tealpkg.cli.progress_bar import ProgressBar
+from tealpkg.util.digest import update_digest
+from tealpkg.util.metrics import get_metrics
+
+
+# Segments are never made smaller than this, so that the per-connection overhead stays small
+MIN_SEGMENT_SIZE = 4 << 20
+
+# Base delay (in seconds) before retrying a failed download, doubled on each subsequent retry
+RETRY_BACKOFF = 2
+
+# Seconds allowed to establish a connection, and seconds without any data before a transfer is considered stalled
+CONNECT_TIMEOUT = 30
+STALL_TIMEOUT = 60
+
+
+class Segment:
+    '''
+    Byte range of a file that is downloaded as part of a segmented download.
+    '''
+    def __init__(self, start, end):
+        '''
+        Constructor.
+
+        start   --   offset of the first byte in the range
+        end     --   offset of the last byte in the range (inclusive)
+        '''
+        self.start = start
+        self.end = end
+        self.offset = start
+        self.tried = set()
+    #
+#
 
 
 class Downloader:
     '''
     PyCURL-based downloader with a progress bar.
     '''
-    def __init__(self):
+    def __init__(self, repoid='', segment_threshold=0, segments=1, retries=3, quiet=False):
         '''
         Constructor.
+
+        repoid              --   ID of the repository on whose behalf files are downloaded (used to label metrics)
+        segment_threshold   --   files at least this large (in bytes) are downloaded in segments (0 to disable)
+        segments            --   maximum number of segments (and mirrors) used for a segmented download
+        retries             --   number of times a transient download failure is retried
+        quiet               --   suppresses the progress display
         '''
-        self.progress_bar = ProgressBar('FIXME')
+        self.progress_bar = ProgressBar('FIXME', quiet=quiet)
+        self.repoid = repoid
+        self.segment_threshold = segment_threshold
+        self.segments = segments
+        self.retries = retries
+        self.offset = 0
+        self.last_transfer = None
+        self.last_transfers = []
+        self.last_digest = None
+        self.log = logging.getLogger(__name__)
+    #
+    def use_segments(self, size):
+        '''
+        Returns True iff a file of (approximately) the given size should be downloaded in segments.
+
+        size   --   approximate size of the file in bytes
+        '''
+        return self.segment_threshold > 0 and self.segments > 1 and size >= self.segment_threshold
     #
     def progress(self, dl_total, downloaded, ul_total, uploaded):
         '''
@@ -54,17 +113,31 @@ class Downloader:
         ul_total    --  total number of bytes to upload (unused)
         uploaded    --  total number of bytes uploaded so far (unused)
         '''
-        self.progress_bar.print_progress(downloaded, dl_total)
+        # When resuming, curl only counts the bytes requested in this transfer
+        total = dl_total + self.offset if dl_total else 0
+        self.progress_bar.print_progress(downloaded + self.offset, total)
     #
-    def download(self, url, output_path=None):
+    def download(self, url, output_path=None, digest=None, resume=False):
         '''
         Downloads the specified URL, displaying a progress bar during the process.
 
         Displays the average download speed (in Mbps) at the end of a successful download. Returns the path to the
-        downloaded file if successful, or None if an error occurs.
+        downloaded file if successful, or None if an error occurs. Afterward, last_transfer holds a (success, latency,
+        throughput, size) tuple describing the transfer, with the latency measured as the time to the first byte.
+
+        Transient failures (network errors, stalled transfers, and server errors) are retried with exponential backoff.
+        If resume is True, an existing partial file at the output path is continued using a range request, both
+        initially and on each retry. Otherwise, and whenever the server does not honor the range request, the file is
+        downloaded from the beginning. A partial file is left in place if the download fails.
+
+        If a digest algorithm is named, the digest of the complete file is computed as the data are written (including
+        any data already present when resuming), and it is left in last_digest as a lowercase hex string, so that the
+        file can be checked without reading it back from disk.
 
         url           --   URL of the file to download (must be supported by curl)
         output_path   --   output path (directory or filename) for the downloaded file (None for current directory)
+        digest        --   optional name of the hashlib algorithm used to compute last_digest
+        resume        --   True to continue an existing partial file
         '''
         target = None
 
@@ -81,28 +154,135 @@ class Downloader:
 
         self.progress_bar.label = target.name
         result = None
+        mirror = urlparse(url).netloc
+        metrics = get_metrics()
+        self.last_transfer = (False, None, None, 0)
+        self.last_digest = None
+
+        attempt = 0
+        status = 'retry'
+        while status in ('retry', 'restart'):
+            if status == 'retry' and attempt > 0:
+                time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+            #
+            if status == 'restart':
+                resume = False
+            #
+            status = self.attempt(url, target, digest, resume)
+            if status == 'retry':
+                attempt += 1
+                metrics.add('tealpkg_download_retries', 1, 'Number of download retries', repo=self.repoid, \
+                        mirror=mirror)
+                if attempt > self.retries:
+                    status = 'failed'
+                else:
+                    self.log.warning('Retrying download of %s (attempt %d)', url, attempt + 1)
+                #
+            #
+        #
+
+        if status == 'ok':
+            result = target.as_posix()
+        #
+
+        outcome = 'ok' if result else 'failed'
+        metrics.add('tealpkg_downloads', 1, 'Number of download attempts', repo=self.repoid, mirror=mirror, \
+                result=outcome)
+
+        return result
+    #
+    def attempt(self, url, target, digest, resume):
+        # Makes a single attempt to download a file, returning "ok", "failed", "retry" (transient failure), or
+        # "restart" (the server ignored the range request, so the file must be downloaded from the beginning)
+        status = 'failed'
+        restart = False
+        mirror = urlparse(url).netloc
+        metrics = get_metrics()
+
+        self.offset = 0
+        if resume and target.exists():
+            self.offset = target.stat().st_size
+        #
+
+        hasher = None
+        if digest:
+            hasher = hashlib.new(digest)
+            if self.offset:
+                update_digest(hasher, target)
+            #
+        #
+
+        c = pycurl.Curl()
         try:
-            c = pycurl.Curl()
             c.setopt(c.NOPROGRESS, False)
             c.setopt(c.XFERINFOFUNCTION, self.progress)
-            with open(target, 'wb') as fh:
+            c.setopt(c.CONNECTTIMEOUT, CONNECT_TIMEOUT)
+            c.setopt(c.LOW_SPEED_LIMIT, 1)
+            c.setopt(c.LOW_SPEED_TIME, STALL_TIMEOUT)
+            if self.offset:
+                c.setopt(c.RESUME_FROM_LARGE, self.offset)
+            #
+            with open(target, 'ab' if self.offset else 'wb') as fh:
                 c.setopt(c.URL, url)
                 c.setopt(c.FOLLOWLOCATION, True)
-                c.setopt(c.WRITEDATA, fh)
-                c.perform()
+                def write(data):
+                    nonlocal restart
+                    code = c.getinfo(c.RESPONSE_CODE)
+                    if self.offset and code == 200:
+                        # Full response to a range request: abort, since the data would be appended in the wrong place
+                        restart = True
+                        return 0
+                    elif code in (200, 206):
+                        # Error pages are discarded, so that they never end up in a partial file
+                        fh.write(data)
+                        if hasher:
+                            hasher.update(data)
+                        #
+                    #
+                #
+                c.setopt(c.WRITEFUNCTION, write)
+                try:
+                    c.perform()
+                except pycurl.error as e:
+                    if not restart:
+                        self.log.warning('Transfer error for %s: %s', url, e)
+                        status = 'retry'
+                    #
+                #
             #
 
             code = c.getinfo(c.RESPONSE_CODE)
-            if code == 200:
+            metrics.add('tealpkg_download_bytes', c.getinfo(c.SIZE_DOWNLOAD), 'Bytes downloaded', \
+                    repo=self.repoid, mirror=mirror)
+            metrics.add('tealpkg_download_seconds', c.getinfo(c.TOTAL_TIME), 'Time spent downloading', \
+                    repo=self.repoid, mirror=mirror)
+            if restart:
+                status = 'restart'
+            elif status == 'retry':
+                self.progress_bar.print_complete('Interrupted', False, on_failure='Retry')
+            elif code == 200 or (self.offset and code == 206) or (self.offset and code == 416):
+                # 416 means that the partial file was already complete
+                status = 'ok'
+                if hasher:
+                    self.last_digest = hasher.hexdigest().lower()
+                #
+                self.last_transfer = (True, c.getinfo(c.STARTTRANSFER_TIME), c.getinfo(c.SPEED_DOWNLOAD), \
+                        c.getinfo(c.SIZE_DOWNLOAD))
                 speed = str(int(round(c.getinfo(c.SPEED_DOWNLOAD) * 8 / 1000000, 0)))   # Mbps
                 message = str(speed) + ' Mbps'
+                if self.offset:
+                    message = 'Resumed, ' + message
+                #
                 self.progress_bar.print_complete(message, True)
-                result = target.as_posix()
+            elif code >= 500:
+                status = 'retry'
+                self.progress_bar.print_complete(str(code), False, on_failure='Retry')
             else:
                 dispcode = str(code)
                 self.progress_bar.print_complete(dispcode, False)
             #
         except Exception as e:
+            status = 'failed'
             self.progress_bar.print_label()
             cprint('Download failed due to Python exception', stderr=True, style='error')
             traceback.print_exc()
@@ -110,6 +290,169 @@ class Downloader:
             c.close()
         #
 
+        return status
+    #
+    def get_size(self, url):
+        '''
+        Returns the exact size of the file at a URL (using a HEAD request), or None if the size cannot be determined.
+
+        url   --   URL of the file
+        '''
+        result = None
+        c = pycurl.Curl()
+        try:
+            c.setopt(c.URL, url)
+            c.setopt(c.NOBODY, True)
+            c.setopt(c.FOLLOWLOCATION, True)
+            c.perform()
+            length = c.getinfo(c.CONTENT_LENGTH_DOWNLOAD)
+            if c.getinfo(c.RESPONSE_CODE) == 200 and length > 0:
+                result = int(length)
+            #
+        except pycurl.error:
+            pass
+        finally:
+            c.close()
+        #
+        return result
+    #
+    def download_segmented(self, sources, output_path):
+        '''
+        Downloads a file in byte ranges fetched in parallel from several mirrors, writing each range directly into
+        place in the output file. A range that fails is retried on another mirror. Returns the path to the downloaded
+        file if every range was obtained, or None otherwise (in which case the caller should fall back to a normal
+        download). Afterward, last_transfers holds a (mirror, success, latency, throughput, size) tuple for each range
+        transfer.
+
+        Since the ranges arrive out of order, no checksum is computed while downloading.
+
+        sources       --   list of (mirror, url) pairs for the same file, best mirror first
+        output_path   --   path to the output file
+        '''
+        result = None
+        self.last_transfers = []
+
+        size = self.get_size(sources[0][1])
+        if size is not None and size >= 2 * MIN_SEGMENT_SIZE:
+            result = self.fetch_segments(sources, pathlib.PosixPath(output_path), size)
+        #
+
+        return result
+    #
+    def fetch_segments(self, sources, target, size):
+        self.progress_bar.label = target.name
+        count = min(self.segments, len(sources), size // MIN_SEGMENT_SIZE)
+        step = size // count
+        segments = [ Segment(i * step, (i + 1) * step - 1) for i in range(count) ]
+        segments[-1].end = size - 1
+
+        result = None
+        failed = False
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        multi = pycurl.CurlMulti()
+        handles = {}
+        start = time.monotonic()
+        metrics = get_metrics()
+
+        def make_writer(segment):
+            def write(data):
+                # A mirror that ignores the range request sends too much data: abort the transfer
+                if segment.offset + len(data) > segment.end + 1:
+                    return 0
+                #
+                os.pwrite(fd, data, segment.offset)
+                segment.offset += len(data)
+                self.progress_bar.print_progress(sum(s.offset - s.start for s in segments), size)
+            #
+            return write
+        #
+
+        def start_segment(segment, index):
+            mirror, url = sources[index]
+            segment.tried.add(index)
+            segment.offset = segment.start
+            c = pycurl.Curl()
+            c.setopt(c.URL, url)
+            c.setopt(c.FOLLOWLOCATION, True)
+            c.setopt(c.RANGE, str(segment.start) + '-' + str(segment.end))
+            c.setopt(c.WRITEFUNCTION, make_writer(segment))
+
+            # A stalled mirror fails its segment, which is then reassigned, instead of holding up the whole download
+            c.setopt(c.CONNECTTIMEOUT, CONNECT_TIMEOUT)
+            c.setopt(c.LOW_SPEED_LIMIT, 1)
+            c.setopt(c.LOW_SPEED_TIME, STALL_TIMEOUT)
+            multi.add_handle(c)
+            handles[c] = (segment, mirror)
+        #
+
+        try:
+            for index, segment in enumerate(segments):
+                start_segment(segment, index % len(sources))
+            #
+
+            while handles and not failed:
+                ret = pycurl.E_CALL_MULTI_PERFORM
+                while ret == pycurl.E_CALL_MULTI_PERFORM:
+                    ret, active = multi.perform()
+                #
+
+                queued = 1
+                while queued:
+                    queued, ok_list, err_list = multi.info_read()
+                    for c in ok_list + [ item[0] for item in err_list ]:
+                        segment, mirror = handles.pop(c)
+                        multi.remove_handle(c)
+                        success = c.getinfo(c.RESPONSE_CODE) == 206 and segment.offset == segment.end + 1
+                        self.last_transfers.append( (mirror, success, c.getinfo(c.STARTTRANSFER_TIME), \
+                                c.getinfo(c.SPEED_DOWNLOAD), c.getinfo(c.SIZE_DOWNLOAD)) )
+                        metrics.add('tealpkg_download_bytes', c.getinfo(c.SIZE_DOWNLOAD), 'Bytes downloaded', \
+                                repo=self.repoid, mirror=urlparse(c.getinfo(c.EFFECTIVE_URL)).netloc)
+                        c.close()
+
+                        if not success:
+                            untried = [ i for i in range(len(sources)) if i not in segment.tried ]
+                            if untried:
+                                start_segment(segment, untried[0])
+                            else:
+                                failed = True
+                            #
+                        #
+                    #
+                #
+
+                if handles and not failed:
+                    multi.select(1.0)
+                #
+            #
+        except Exception as e:
+            self.progress_bar.print_label()
+            cprint('Segmented download failed due to Python exception', stderr=True, style='error')
+            traceback.print_exc()
+            failed = True
+        finally:
+            for c in handles:
+                multi.remove_handle(c)
+                c.close()
+            #
+            multi.close()
+            os.close(fd)
+        #
+
+        if failed:
+            target.unlink(missing_ok=True)
+            self.progress_bar.print_complete('Segments', False)
+        else:
+            elapsed = max(time.monotonic() - start, 0.001)
+            speed = str(int(round(size * 8 / elapsed / 1000000, 0)))   # Mbps
+            mirrors = len(set(item[0] for item in self.last_transfers if item[1]))
+            self.progress_bar.print_complete(speed + ' Mbps from ' + str(mirrors) + ' mirrors', True)
+            result = target.as_posix()
+        #
+
+        outcome = 'ok' if result else 'failed'
+        metrics.add('tealpkg_segmented_downloads', 1, 'Number of segmented download attempts', repo=self.repoid, \
+                result=outcome)
+
         return result
     #
 #
@@ -25,12 +25,20 @@
 # TODO: shorten docstring lines
 
 import logging
+import os
 import pathlib
 import time
 
 from urllib.parse import urlparse, urlunparse
 
 from tealpkg.cli.progress_bar import ProgressBar
+from tealpkg.util.digest import file_digest
+from tealpkg.util.metrics import get_metrics
+from tealpkg.util.profile import profile_span
+
+
+# Minimum difference (in bytes) between the actual and expected sizes before a download is considered corrupt
+SIZE_TOLERANCE = 4096
 
 
 class FilePath:
@@ -38,7 +46,8 @@ class FilePath:
     Abstract representation of a file path, which may be located on a remote server. Upon resolving the path, the
     file is downloaded (if necessary) and optionally verified with GPG.
     '''
-    def __init__(self, mirrorlist, relpath, cache_dir, gpg, downloader, verify=True, filename=None, quiet=False):
+    def __init__(self, mirrorlist, relpath, cache_dir, gpg, downloader, verify=True, filename=None, quiet=False, \
+            checksum=None, stats=None, size=0, store=None, digests=None):
         '''
         Constructor.
 
@@ -50,6 +59,11 @@ class FilePath:
         filename    --   local name of the file, if renamed from the URL
         downloader  --   Downloader instance to use for downloading the file, if necessary
         quiet       --   suppresses local, cache, and verification status messages
+        checksum    --   expected MD5 digest of the file (None to skip the checksum test)
+        stats       --   optional MirrorStats instance used to order the mirrors and record their performance
+        size        --   approximate size of the file in bytes (large files may be downloaded from several mirrors)
+        store       --   optional ContentStore in which an identical file (by checksum) is sought before downloading
+        digests     --   optional DigestCache used to skip reading unchanged files again for the checksum test
         '''
         self.mirrorlist = mirrorlist
         self.relpath = relpath
@@ -62,116 +76,423 @@ class FilePath:
         #
         self.filename = filename
         self.downloader = downloader
+        self.checksum = checksum
+        self.stats = stats
+        self.size = size
+        self.store = store
+        self.digests = digests
+        self.store_hit = False      # the file was last obtained from the store
+        self.store_failed = False   # a file obtained from the store failed verification, so download it instead
+        self.mirror = None
+        self.downloaded = False
+        self.pending = None
         self.progress_bar = ProgressBar(quiet=quiet)
         self.log = logging.getLogger(__name__)
     #
-    def resolve(self, download_if_older_than=-1):
+    def touch(self, path, local):
+        # Records the use of a cached file for least-recently-used eviction. The access time is set explicitly, since
+        # file systems are often mounted with noatime or relatime. The modification time is preserved.
+        if not local:
+            try:
+                st = os.stat(path)
+                os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+            except OSError as e:
+                self.log.debug('Unable to update access time of %s: %s', path, e)
+            #
+        #
+    #
+    def mirrors(self):
         '''
-        Resolves the file path to a local path on the system, or to None if the file cannot be resolved. The file
-        will be downloaded into the cache directory if it is not already present on the local system. If GPG verification
-        is enabled, the detached signature will also be downloaded, if necessary. Should GPG verification file, both the
-        file and its detached signature are removed if they were downloaded (but not if the files were already local).
+        Returns the mirrors in the order in which they should be tried.
+        '''
+        result = self.mirrorlist
+        if self.stats:
+            result = self.stats.rank(self.mirrorlist)
+        #
+        return result
+    #
+    def needs_download(self):
+        '''
+        Returns True if obtaining the file would require a download: it is neither in the cache directory nor
+        available from a local mirror. Used to estimate download volumes without fetching anything.
+        '''
+        name = self.filename or pathlib.PurePosixPath(self.relpath).name
+        result = not pathlib.PosixPath(self.cache_dir).joinpath(name).exists()
+        for mirror in self.mirrorlist:
+            if result and urlparse(mirror).scheme in ('', 'file'):
+                local = pathlib.PurePosixPath(urlparse(mirror).path).joinpath(self.relpath)
+                result = not os.path.exists(local)
+            #
+        #
+        return result
+    #
+    def fetch_segments(self, mirror, path):
+        '''
+        Downloads the file in byte ranges from the given mirror and the other remote mirrors, in order of preference.
+        Returns the path to the downloaded file, or None if the segmented download was not possible or failed.
 
-        Returns the path to the resolved file if resolution (and optional verification) succeeds. Returns None if the
-        file cannot be found, the file cannot be downloaded, or a requested optional verification fails.
+        mirror   --   mirror from which the file would otherwise be downloaded
+        path     --   path to the file in the cache directory
+        '''
+        result = None
 
-        The special download_if_older_than flag can be used to force re-downloading existing files (primarily for
-        refreshing metadata). If the file exists locally, but its modification time was more than download_if_older_than
-        seconds ago, the file will be re-downloaded. A value of download_if_older_than < 0 disables this feature.
+        sources = []
+        for item in [ mirror ] + [ m for m in self.mirrors() if m != mirror ]:
+            healthy = item == mirror or self.stats is None or self.stats.healthy(item)
+            if healthy and urlparse(item).scheme not in ('', 'file'):
+                sources.append( (item, pathlib.PurePosixPath(item).joinpath(self.relpath).as_posix()) )
+            #
+        #
 
+        if len(sources) > 1:
+            result = self.downloader.download_segmented(sources[:self.downloader.segments], path)
+            if self.stats:
+                for transfer in self.downloader.last_transfers:
+                    self.stats.record(*transfer)
+                #
+            #
+        #
+
+        return result
+    #
+    def tolerance(self):
+        # Sizes in PACKAGES.TXT are rounded, so only reject sizes that are clearly wrong
+        return max(SIZE_TOLERANCE, self.size // 100)
+    #
+    def size_plausible(self, actual):
+        return not self.size or abs(actual - self.size) <= self.tolerance()
+    #
+    def fetch_from(self, mirror, download_if_older_than=-1):
+        '''
+        Obtains the file from a single mirror, downloading it into the cache directory if necessary, and checks its MD5
+        checksum and approximate size (if given). If GPG verification is enabled, the detached signature is also
+        obtained, but it is not checked here. Returns a (path, signature_path, local, final) tuple, in which path is
+        None if the file could not be obtained.
+
+        A downloaded file is kept in a .part file until it has passed every check, so that an interrupted download can
+        be resumed later, and so that a file in the cache is never incomplete. If the signature still needs to be
+        checked, path and signature_path refer to the staged files, and final is the path to which they are moved
+        (by check_signature) once verified. Otherwise, final is None.
+
+        mirror                  --  mirror from which to obtain the file
         download_if_older_than  --  optional number of seconds before a file has expired
         '''
         local = False
         result = None
-        path = None
+        sig_name = None
+        final = None
+        need_download = False
 
-        for mirror in self.mirrorlist:
-            url = pathlib.PurePosixPath(mirror).joinpath(self.relpath).as_posix()
-            self.log.debug('URL is %s', url)
-
-            urlparts = urlparse(url)
-            name = pathlib.PurePosixPath(urlparts.path).name
-            if self.filename:
-                name = self.filename
-            #
-            self.progress_bar.label = name
-
-            if urlparts.scheme in ('', 'file'):
-                local = True
-                path = pathlib.PosixPath(urlparts.path)
-                if path.exists():
-                    result = urlparts.path
-                    self.progress_bar.print_complete('Local', True)
+        url = pathlib.PurePosixPath(mirror).joinpath(self.relpath).as_posix()
+        self.log.debug('URL is %s', url)
+
+        urlparts = urlparse(url)
+        name = pathlib.PurePosixPath(urlparts.path).name
+        if self.filename:
+            name = self.filename
+        #
+        self.progress_bar.label = name
+
+        if urlparts.scheme in ('', 'file'):
+            local = True
+            path = pathlib.PosixPath(urlparts.path)
+            if path.exists():
+                result = urlparts.path
+                self.progress_bar.print_complete('Local', True)
+                get_metrics().add('tealpkg_cache_requests', 1, 'File resolutions by cache outcome', \
+                        repo=self.downloader.repoid, result='local')
+            else:
+                self.progress_bar.print_complete('Not Found', False)
+            #
+        else:
+            path = pathlib.PosixPath(self.cache_dir)
+            path.mkdir(parents=True, exist_ok=True)
+            path = path.joinpath(name)
+            part = path.with_name(name + '.part')
+
+            need_download = not path.exists()
+            if not need_download and download_if_older_than >= 0:
+                mtime = path.stat().st_mtime
+                if (mtime + download_if_older_than) < time.time():
+                    need_download = True
+                #
+            #
+
+            outcome = 'miss' if need_download else 'hit'
+            self.store_hit = False
+            if need_download and self.store and self.checksum and not self.store_failed and \
+                    self.store.link(self.checksum, path, self.store_key()):
+                # An identical file was already obtained for another repository
+                need_download = False
+                outcome = 'store'
+                self.store_hit = True
+            #
+
+            get_metrics().add('tealpkg_cache_requests', 1, 'File resolutions by cache outcome', \
+                    repo=self.downloader.repoid, result=outcome)
+
+            if need_download:
+                # Only resume a partial file if the result will be checked, since the partial data might have come
+                # from an older version of the file
+                resume = bool(self.checksum or self.verify)
+                if part.exists() and (not resume or (self.size and part.stat().st_size > self.size + self.tolerance())):
+                    part.unlink()
+                #
+
+                if self.downloader.use_segments(self.size) and not part.exists():
+                    result = self.fetch_segments(mirror, part)
+                #
+
+                if result is None:
+                    # Segments are not used or failed: download the whole file in a single stream
+                    result = self.downloader.download(url, part, 'md5' if self.checksum else None, resume)
+                    if self.stats:
+                        self.stats.record(mirror, *self.downloader.last_transfer)
+                    #
+                    digest = self.downloader.last_digest
                 else:
-                    self.progress_bar.print_complete('Not Found', False)
+                    digest = None
                 #
-            else:
-                path = pathlib.PosixPath(self.cache_dir)
-                path.mkdir(parents=True, exist_ok=True)
-                path = path.joinpath(name)
-
-                need_download = not path.exists()
-                if not need_download and download_if_older_than >= 0:
-                    mtime = path.stat().st_mtime
-                    if (mtime + download_if_older_than) < time.time():
-                        need_download = True
+
+                if result and not self.size_plausible(part.stat().st_size):
+                    self.log.error('Unexpected size for %s from %s', name, mirror)
+                    part.unlink(missing_ok=True)
+                    if self.stats:
+                        self.stats.record(mirror, False)
                     #
+                    result = None
+                    self.progress_bar.print_complete('Size', False, on_failure='Corrupt')
                 #
+            else:
+                result = path.as_posix()
+                self.progress_bar.print_complete('In Store' if outcome == 'store' else 'In Cache', True)
+            #
+        #
 
+        if result and self.checksum:
+            if not need_download:
+                # A file that is unchanged since it last passed the test is not read again
+                digest = self.digests.check(result) if self.digests else None
+            #
+            if not digest:
+                digest = file_digest(result)
+            #
+
+            if digest != self.checksum:
+                self.log.error('Incorrect MD5 checksum for %s from %s', name, mirror)
+                if not local:
+                    pathlib.PosixPath(result).unlink(missing_ok=True)
+                #
+                if self.stats and need_download:
+                    self.stats.record(mirror, False)
+                #
+                result = None
+                self.progress_bar.print_complete('MD5', False, on_failure='Corrupt')
+            elif not need_download:
+                if self.digests:
+                    self.digests.add(result, digest)
+                #
+                if self.store and not local:
+                    self.store.add(self.checksum, result)
+                #
+            #
+        #
+
+        if result and self.verify:
+            sig_path = path.with_name(name + '.asc')
+
+            sig_name = sig_path.as_posix()
+            if not local and (not sig_path.exists() or need_download):
+                # The signature of a new download is staged alongside it
                 if need_download:
-                    result = self.downloader.download(url, path)
+                    sig_path = path.with_name(name + '.asc.part')
+                #
+                url = urlunparse( (urlparts.scheme, urlparts.netloc, urlparts.path + '.asc', urlparts.params, \
+                        urlparts.query, urlparts.fragment) )
+                sig_name = self.downloader.download(url, sig_path)
 
-                    if result is None:
-                        # Remove any downloaded file, since the download failed
-                        path.unlink(missing_ok=True)
-                    #
-                else:
-                    result = path.as_posix()
-                    self.progress_bar.print_complete('In Cache', True)
+                if sig_name is None:
+                    # Clean up any empty signature file
+                    sig_path.unlink(missing_ok=True)
                 #
             #
 
-            if result and self.verify:
-                sig_path = path.with_name(name + '.asc')
+            if not sig_name:
+                # Couldn't get the signature, so invalidate the result (a staged file may still be resumed later)
+                result = None
+                self.progress_bar.print_complete('GPG', False, on_failure='No Signature')
+            #
+        #
 
-                sig_name = sig_path.as_posix()
-                if not local and (not sig_path.exists() or need_download):
-                    url = urlunparse( (urlparts.scheme, urlparts.netloc, urlparts.path + '.asc', urlparts.params, \
-                            urlparts.query, urlparts.fragment) )
-                    sig_name = self.downloader.download(url, sig_name)
+        if result and need_download:
+            if self.verify:
+                final = path.as_posix()
+            else:
+                # Nothing further to check, so move the file into place now
+                self.commit(result, None, path.as_posix())
+                result = path.as_posix()
+                if self.store and self.checksum:
+                    self.store.add(self.checksum, result)
+                #
+            #
+        #
 
-                    if sig_name is None:
-                        # Clean up any empty signature file
-                        sig_path.unlink(missing_ok=True)
-                    #
+        self.downloaded = need_download
+        return (result, sig_name, local, final)
+    #
+    def store_key(self):
+        # Signatures are stored per signing key, since another repository may sign the same file with another key
+        return self.gpg.fingerprint if self.verify else None
+    #
+    def commit(self, path, sig_name, final):
+        # Atomically moves a checked download (and its signature, if any) into place
+        os.replace(path, final)
+        if sig_name:
+            os.replace(sig_name, final + '.asc')
+        #
+        if self.digests and self.checksum:
+            self.digests.add(final, self.checksum)
+        #
+    #
+    def check_signature(self, path, sig_name, local, final=None, report=True):
+        '''
+        Checks the detached GPG signature of a file obtained by fetch_from. Returns True iff the signature is valid. If
+        the file and signature were staged, they are moved into place once verified. If verification fails, both the
+        file and its signature are removed, unless they came from a local mirror.
+
+        This method may be called from a worker thread, in which case report should be False, since the progress
+        messages would otherwise be interleaved with output from the main thread.
+
+        path        --  path to the file
+        sig_name    --  path to the detached signature file
+        local       --  True iff the file came from a local mirror
+        final       --  path to which the staged file is moved once verified (None if not staged)
+        report      --  True to display the verification result
+        '''
+        with profile_span('gpg verification'):
+            verified = self.gpg.verify(path, sig_name)
+        #
+
+        if verified:
+            if final:
+                self.commit(path, sig_name, final)
+                path = final
+                sig_name = final + '.asc'
+                if self.gpg.cache:
+                    # Record the verification under the final name, so that it is not repeated on the next run
+                    self.gpg.cache.add(path, sig_name)
                 #
+            #
+            if self.store and self.checksum and not local:
+                self.store.add(self.checksum, path, sig_name, self.store_key())
+            #
+            if report:
+                self.progress_bar.print_complete('GPG', True, on_success='Verified')
+            #
+        else:
+            # Remove both the download and the signature file, since they appear to be corrupt, but only if we
+            # downloaded them first. A file linked from the store is downloaded on the next attempt, since linking
+            # it again would only repeat the failure.
+            if self.store_hit:
+                self.store_failed = True
+            #
+            if not local:
+                pathlib.PosixPath(path).unlink(missing_ok=True)
+                pathlib.PosixPath(sig_name).unlink(missing_ok=True)
+            #
+            if report:
+                self.progress_bar.print_complete('GPG', False, on_failure='Corrupt')
+            #
+        #
+
+        return verified
+    #
+    def resolve(self, download_if_older_than=-1):
+        '''
+        Resolves the file path to a local path on the system, or to None if the file cannot be resolved. The file
+        will be downloaded into the cache directory if it is not already present on the local system. If GPG verification
+        is enabled, the detached signature will also be downloaded, if necessary. Should GPG verification file, both the
+        file and its detached signature are removed if they were downloaded (but not if the files were already local).
+        If an expected MD5 checksum was given, it is computed while downloading (or from the existing file) and
+        checked before the GPG signature. Downloads are staged in .part files, which are resumed on the next attempt
+        if a download fails, and which are moved into place only after passing all checks.
+
+        Returns the path to the resolved file if resolution (and optional verification) succeeds. Returns None if the
+        file cannot be found, the file cannot be downloaded, or a requested optional verification fails.
+
+        The special download_if_older_than flag can be used to force re-downloading existing files (primarily for
+        refreshing metadata). If the file exists locally, but its modification time was more than download_if_older_than
+        seconds ago, the file will be re-downloaded. A value of download_if_older_than < 0 disables this feature.
 
-                if sig_name:
-                    if self.gpg.verify(result, sig_name):
-                        self.progress_bar.print_complete('GPG', True, on_success='Verified')
+        download_if_older_than  --  optional number of seconds before a file has expired
+        '''
+        result = None
+
+        for mirror in self.mirrors():
+            retry = True
+            while retry:
+                retry = False
+                result, sig_name, local, final = self.fetch_from(mirror, download_if_older_than)
+                if result and self.verify:
+                    if self.check_signature(result, sig_name, local, final):
+                        result = final if final else result
                     else:
-                        # Remove both the download and the signature file, since they appear to be corrupt, but only if
-                        # we downloaded them first
-                        if not local:
-                            path.unlink(missing_ok=True)
-                            sig_path.unlink(missing_ok=True)
+                        if self.stats and self.downloaded:
+                            self.stats.record(mirror, False)
                         #
-
                         result = None
-                        self.progress_bar.print_complete('GPG', False, on_failure='Corrupt')
-                    #
-                else:
-                    # Couldn't get the signature, so invalidate the result
-                    result = None
-                    self.progress_bar.print_complete('GPG', False, on_failure='No Signature')
-                #
+
+                        # A copy linked from the store is not linked again, but downloaded from this mirror instead
+                        retry = self.store_hit
+                #####
             #
 
             if result:
+                self.mirror = mirror
+                self.touch(result, local)
                 break
             #
         #
 
         return result
     #
+    def fetch(self, download_if_older_than=-1):
+        '''
+        Works like resolve, except that the GPG signature of the obtained file is not checked. Instead, the signature
+        check is left pending for a later call to check_pending, which may be made from a worker thread. Returns the
+        path to the obtained file, or None if it could not be obtained from any mirror.
+
+        download_if_older_than  --  optional number of seconds before a file has expired
+        '''
+        result = None
+        self.pending = None
+
+        for mirror in self.mirrors():
+            result, sig_name, local, final = self.fetch_from(mirror, download_if_older_than)
+            if result:
+                self.mirror = mirror
+                self.touch(result, local)
+                if self.verify:
+                    self.pending = (result, sig_name, local, final)
+                    result = final if final else result
+                #
+                break
+            #
+        #
+
+        return result
+    #
+    def check_pending(self):
+        '''
+        Checks the signature left pending by fetch, without displaying any output. Returns True iff the signature is
+        valid or no check was pending. On failure, the file and its signature are removed, so that a subsequent call to
+        resolve will obtain them again.
+        '''
+        result = True
+        if self.pending:
+            result = self.check_signature(*self.pending, report=False)
+            self.pending = None
+        #
+        return result
+    #
 #
@@ -24,9 +24,11 @@
 # TODO: refactor for MVC
 
 import gpg
-import tempfile
+import threading
+import time
 
 from tealpkg.cli.colorprint import cprint
+from tealpkg.util.metrics import get_metrics
 
 
 class GPGException(Exception):
@@ -36,51 +38,122 @@ class GPGException(Exception):
 
 class GPGVerifier:
     '''
-    Basic GPG verifier, which checks a GPG signature against an existing public key.
+    Basic GPG verifier, which checks a GPG signature against a public key in a persistent keyring. The keyring may be
+    shared by several repositories, so a signature is only accepted if it was made by the pinned key (or one of its
+    subkeys). Since a GPG context must not be shared between threads, each thread that calls verify gets its own
+    context on the same keyring. If a verification cache is supplied, files that were verified successfully on an
+    earlier run and have not changed are accepted without being verified again.
     '''
-    def __init__(self, gpg_key, gpg_fp):
+    def __init__(self, keyring, gpg_fp, cache=None):
         '''
-        Constructor.
+        Constructor. If the pinned key is not yet present in the keyring, it must be added using import_key before
+        any files can be verified.
 
-        gpg_key   --  path to the GPG public key file to import
+        keyring   --  path to the GPG home directory holding the persistent keyring
         gpg_fp    --  fingerprint of the GPG key (for verification)
+        cache     --  optional VerificationCache for previously verified files
+        '''
+        self.keyring = keyring
+        self.fingerprint = gpg_fp.lower().replace(':', '').replace(' ', '')
+        self.cache = cache
+        self.local = threading.local()
+        self.signers = set()
+
+        try:
+            self.context = gpg.Context(home_dir=self.keyring)
+            self.local.context = self.context
+        except Exception as e:
+            cprint(e, stderr=True, style='error')
+            raise GPGException('Unable to open GPG keyring: ' + self.keyring)
+        #
+
+        self.load_signers()
+    #
+    def load_signers(self):
+        try:
+            key = self.context.get_key(self.fingerprint)
+        except (KeyError, gpg.errors.GPGMEError):
+            key = None
+        #
+
+        if key:
+            self.signers = set(subkey.fpr.lower() for subkey in key.subkeys)
+        #
+    #
+    @property
+    def have_key(self):
+        return self.fingerprint in self.signers
+    #
+    def import_key(self, gpg_key):
         '''
-        self.context = None
-        self.temp = tempfile.TemporaryDirectory()
+        Imports the pinned public key into the keyring.
 
+        gpg_key   --  path to the GPG public key file to import
+        '''
         try:
             with open(gpg_key, 'rb') as fh:
                 keydata = fh.read()
             #
         except Exception as e:
             cprint(e, stderr=True, style='error')
-            raise GPGException('Unable to load GPG public key file: ' + gpg_key)
+            raise GPGException('Unable to load GPG public key file: ' + str(gpg_key))
         else:
             try:
-                self.context = gpg.Context(home_dir=self.temp.name)
                 result = self.context.key_import(keydata)
-                if result.imported == 1:
-                    fpr = result.imports[0].fpr.lower()
-                    if fpr != gpg_fp.lower().replace(':', '').replace(' ', ''):
-                        raise GPGException('Downloaded key does not match expected fingerprint')
-                    #
-                else:
-                    raise GPGException('Failed to import GPG key from: ' + gpg_key)
+                fprs = [ item.fpr.lower() for item in getattr(result, 'imports', []) ]
+                if self.fingerprint not in fprs:
+                    raise GPGException('Downloaded key does not match expected fingerprint')
                 #
             except Exception as e:
                 cprint(e, stderr=True, style='error')
-                raise GPGException('Exception occurred while importing GPG key from: ' + gpg_key)
+                raise GPGException('Exception occurred while importing GPG key from: ' + str(gpg_key))
             #
         #
+
+        self.load_signers()
+        if not self.have_key:
+            raise GPGException('Failed to import GPG key from: ' + str(gpg_key))
+        #
+    #
+    def get_context(self):
+        '''
+        Returns the GPG context belonging to the calling thread, creating it if necessary.
+        '''
+        context = getattr(self.local, 'context', None)
+        if context is None:
+            context = gpg.Context(home_dir=self.keyring)
+            self.local.context = context
+        #
+        return context
     #
     def verify(self, data_file, signature_file):
         '''
-        Verifies a data file using an existing GPG context and a detached signature file. Returns True iff the
-        signature can be verified using the public key(s) present in the GPG context.
+        Verifies a data file using the calling thread's GPG context and a detached signature file. Returns True iff
+        the signature can be verified using the public key(s) present in the keyring, or if the verification cache
+        shows that the same file and signature were verified successfully before.
 
         data_file       --  path to the file that is to be checked
         signature_file  --  path to the detached signature file for the data_file
         '''
+        metrics = get_metrics()
+
+        if self.cache and self.cache.check(data_file, signature_file):
+            result = True
+            metrics.add('tealpkg_gpg_verifications', 1, 'Number of GPG signature verifications', result='cached')
+        else:
+            start = time.monotonic()
+            result = self.verify_signature(data_file, signature_file)
+            if result and self.cache:
+                self.cache.add(data_file, signature_file)
+            #
+            metrics.add('tealpkg_gpg_verify_seconds', time.monotonic() - start, 'Time spent verifying GPG signatures')
+            metrics.add('tealpkg_gpg_verifications', 1, 'Number of GPG signature verifications', \
+                    result='ok' if result else 'failed')
+        #
+
+        return result
+    #
+    def verify_signature(self, data_file, signature_file):
         result = True
         signed_data = None
         signature = None
@@ -88,7 +161,12 @@ class GPGVerifier:
         try:
             signed_data = open(data_file, 'rb')
             signature = open(signature_file, 'rb')
-            self.context.verify(signed_data, signature)
+            _, verified = self.get_context().verify(signed_data, signature)
+            if not any(self.is_signer(sig.fpr) for sig in verified.signatures):
+                cprint('GPG signature made by an unexpected key for downloaded file:', data_file, style='error', \
+                        stderr=True)
+                result = False
+            #
         except gpg.errors.BadSignatures:
             cprint('Bad GPG signature for downloaded file:', data_file, style='error', stderr=True)
             result = False
@@ -109,4 +187,9 @@ class GPGVerifier:
 
         return result
     #
+    def is_signer(self, fpr):
+        # Signatures may identify the signing key by its full fingerprint or only by its long key ID
+        fpr = (fpr or '').lower()
+        return len(fpr) >= 16 and any(signer.endswith(fpr) for signer in self.signers)
+    #
 #
@@ -0,0 +1,232 @@
+# Persistent per-mirror health and performance statistics, used to rank mirrors.
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import json
+import logging
+import pathlib
+import threading
+import time
+
+from urllib.parse import urlparse
+
+from tealpkg.util.atomic_write import atomic_write
+
+
+# Weight given to each new sample in the exponentially weighted moving averages
+ALPHA = 0.3
+
+# Scores decay toward the prior with this half-life (in seconds), so that old measurements are gradually forgotten
+HALF_LIFE = 86400
+
+# A mirror is re-probed (tried first once) after this many seconds without a sample. The interval doubles with
+# each consecutive failure, up to MAX_BACKOFF doublings.
+PROBE_INTERVAL = 21600
+MAX_BACKOFF = 5
+
+# Transfers smaller than this are too short to give a meaningful throughput sample
+MIN_THROUGHPUT_BYTES = 65536
+
+# Expected cost of an unknown mirror: PRIOR_LATENCY seconds to the first byte, then PRIOR_THROUGHPUT bytes/second
+PRIOR_LATENCY = 0.25
+PRIOR_THROUGHPUT = 1000000
+
+# Scores are the expected time (in seconds) to fetch REFERENCE_SIZE bytes, inflated by the failure rate and by
+# serving outdated metadata
+REFERENCE_SIZE = 1048576
+FAILURE_PENALTY = 4
+STALE_PENALTY = 4
+
+
+class MirrorStats:
+    '''
+    Tracks latency (time to first byte), throughput, failure rate, and metadata freshness for each mirror of a
+    repository, and ranks mirrors by the expected time to download a file from them. Rankings favor the best mirrors,
+    while measurements decay over time and idle mirrors are periodically probed, so that a mirror that has recovered
+    can win back traffic.
+    '''
+    def __init__(self, path):
+        '''
+        Constructor.
+
+        path   --   path to the file in which the statistics are persisted
+        '''
+        self.path = pathlib.PosixPath(path)
+        self.entries = {}
+        self.dirty = False
+        self.probed = False    # at most one mirror is probed per run, so that other traffic stays on the best mirror
+        self.lock = threading.Lock()
+        self.log = logging.getLogger(__name__)
+
+        if self.path.exists():
+            try:
+                with open(self.path, 'r') as fh:
+                    self.entries = json.load(fh)
+                #
+            except (OSError, ValueError) as e:
+                self.log.warning('Ignoring unreadable mirror statistics %s: %s', self.path, e)
+            #
+        #
+    #
+    def get_entry(self, mirror):
+        if mirror not in self.entries:
+            self.entries[mirror] = { 'latency': None, 'throughput': None, 'failure_rate': 0.0, 'failures': 0, \
+                    'timestamp': 0, 'updated': 0 }
+        #
+        return self.entries[mirror]
+    #
+    def record(self, mirror, success, latency=None, throughput=None, size=0):
+        '''
+        Records the outcome of a transfer from a mirror.
+
+        mirror       --   mirror (base URL) from which the transfer was attempted
+        success      --   True iff the transfer succeeded (and the file passed its checks)
+        latency      --   time to the first byte, in seconds
+        throughput   --   average transfer rate, in bytes per second
+        size         --   number of bytes transferred
+        '''
+        with self.lock:
+            entry = self.get_entry(mirror)
+            entry['failure_rate'] = (1 - ALPHA) * entry['failure_rate'] + (0 if success else ALPHA)
+            if success:
+                entry['failures'] = 0
+                if latency is not None:
+                    entry['latency'] = latency if entry['latency'] is None else \
+                            (1 - ALPHA) * entry['latency'] + ALPHA * latency
+                #
+                if throughput and size >= MIN_THROUGHPUT_BYTES:
+                    entry['throughput'] = throughput if entry['throughput'] is None else \
+                            (1 - ALPHA) * entry['throughput'] + ALPHA * throughput
+                #
+            else:
+                entry['failures'] += 1
+            #
+            entry['updated'] = time.time()
+            self.dirty = True
+        #
+    #
+    def record_timestamp(self, mirror, timestamp):
+        '''
+        Records the timestamp of the metadata (PACKAGES.TXT) most recently served by a mirror.
+
+        mirror      --   mirror (base URL) that served the metadata
+        timestamp   --   metadata timestamp (in seconds since the epoch)
+        '''
+        with self.lock:
+            self.get_entry(mirror)['timestamp'] = timestamp
+            self.dirty = True
+        #
+    #
+    def score(self, mirror, now, newest=0):
+        '''
+        Returns the score of a mirror (lower is better).
+
+        mirror   --   mirror (base URL)
+        now      --   current time
+        newest   --   newest metadata timestamp served by any mirror
+        '''
+        prior = PRIOR_LATENCY + REFERENCE_SIZE / PRIOR_THROUGHPUT
+        result = prior
+
+        entry = self.entries.get(mirror)
+        if entry and entry['updated']:
+            latency = entry['latency'] if entry['latency'] is not None else PRIOR_LATENCY
+            throughput = entry['throughput'] if entry['throughput'] else PRIOR_THROUGHPUT
+            cost = (latency + REFERENCE_SIZE / throughput) * (1 + FAILURE_PENALTY * entry['failure_rate'])
+            if entry['timestamp'] and entry['timestamp'] < newest:
+                cost *= STALE_PENALTY
+            #
+
+            weight = 0.5 ** (max(now - entry['updated'], 0) / HALF_LIFE)
+            result = weight * cost + (1 - weight) * prior
+        #
+
+        return result
+    #
+    def healthy(self, mirror):
+        '''
+        Returns True unless the most recent transfer from a mirror failed.
+
+        mirror   --   mirror (base URL)
+        '''
+        with self.lock:
+            entry = self.entries.get(mirror)
+            return entry is None or entry['failures'] == 0
+        #
+    #
+    def due_for_probe(self, mirror, now):
+        entry = self.entries.get(mirror)
+        result = True
+        if entry and entry['updated']:
+            interval = PROBE_INTERVAL * (2 ** min(entry['failures'], MAX_BACKOFF))
+            result = (now - entry['updated']) > interval
+        #
+        return result
+    #
+    def rank(self, mirrorlist):
+        '''
+        Returns a new list of the mirrors, ordered from best to worst. Local mirrors always come first, and mirrors
+        with equal scores keep their configured order. If the best remote mirror has been sampled recently and another
+        remote mirror is due to be probed, the first such mirror is placed at the front of the remote mirrors, so that
+        it is sampled by the next download. Only one probe is made per instance (that is, per run), since otherwise
+        every unsampled mirror would be due, and the downloads would be spread over all of them in turn.
+
+        mirrorlist   --   configured list of mirrors
+        '''
+        now = time.time()
+        with self.lock:
+            newest = max([ entry['timestamp'] for entry in self.entries.values() ], default=0)
+            local = [ m for m in mirrorlist if urlparse(m).scheme in ('', 'file') ]
+            remote = [ m for m in mirrorlist if urlparse(m).scheme not in ('', 'file') ]
+            remote.sort(key=lambda m: self.score(m, now, newest))
+
+            # Until the best mirror has been sampled, keep the configured order
+            probe = []
+            if remote and not self.probed and not self.due_for_probe(remote[0], now):
+                probe = [ m for m in remote[1:] if self.due_for_probe(m, now) ]
+            #
+            if probe:
+                self.log.debug('Probing mirror %s', probe[0])
+                self.probed = True
+                remote.remove(probe[0])
+                remote.insert(0, probe[0])
+            #
+        #
+
+        return local + remote
+    #
+    def save(self):
+        '''
+        Writes the statistics file if any new samples have been recorded.
+        '''
+        with self.lock:
+            if self.dirty:
+                try:
+                    atomic_write(self.path, json.dumps(self.entries, indent=1, sort_keys=True))
+                    self.dirty = False
+                except OSError as e:
+                    self.log.error('Unable to write mirror statistics %s: %s', self.path, e)
+                #
+            #
+        #
+    #
+#
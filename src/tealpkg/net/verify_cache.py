@@ -0,0 +1,244 @@
+# Persistent cache of successful GPG signature verifications.
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import threading
+
+from tealpkg.util.atomic_write import atomic_write
+
+
+def file_key(path):
+    '''
+    Returns the [ inode, modification time, size ] of a file, which identifies a version of the file without reading
+    it: replacing the file (even by renaming) changes the inode, and writing to it changes the modification time.
+
+    path   --   path to the file
+    '''
+    st = os.stat(path)
+    return [ st.st_ino, st.st_mtime_ns, st.st_size ]
+#
+
+
+class VerificationCache:
+    '''
+    Remembers files whose detached signatures have been verified, so that unchanged cached files do not need to be
+    verified again on every run. An entry matches only if the file still has the same inode, modification time, and
+    size, and if its signature file has the same SHA-256 digest. The whole cache is discarded if the fingerprint of the
+    repository key changes.
+    '''
+    def __init__(self, path, fingerprint, reverify=False):
+        '''
+        Constructor.
+
+        path          --   path to the cache file
+        fingerprint   --   fingerprint of the key used for verification
+        reverify      --   ignore existing entries (new verifications are still recorded)
+        '''
+        self.path = pathlib.PosixPath(path)
+        self.fingerprint = fingerprint.lower().replace(':', '').replace(' ', '')
+        self.reverify = reverify
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.log = logging.getLogger(__name__)
+
+        if self.path.exists():
+            try:
+                with open(self.path, 'r') as fh:
+                    data = json.load(fh)
+                #
+                if data.get('fingerprint') == self.fingerprint:
+                    self.entries = data.get('entries', {})
+                else:
+                    self.log.info('Repository key changed: discarding verification cache %s', self.path)
+                    self.dirty = True
+                #
+            except (OSError, ValueError) as e:
+                self.log.warning('Ignoring unreadable verification cache %s: %s', self.path, e)
+            #
+        #
+    #
+    def make_key(self, data_file, signature_file):
+        with open(signature_file, 'rb') as fh:
+            sig_digest = hashlib.sha256(fh.read()).hexdigest()
+        #
+        return file_key(data_file) + [ sig_digest ]
+    #
+    def check(self, data_file, signature_file):
+        '''
+        Returns True iff the file and signature are unchanged since they were last verified successfully.
+
+        data_file        --   path to the signed file
+        signature_file   --   path to the detached signature
+        '''
+        result = False
+        if not self.reverify:
+            try:
+                key = self.make_key(data_file, signature_file)
+            except OSError:
+                key = None
+            #
+            with self.lock:
+                result = key is not None and self.entries.get(os.path.abspath(data_file)) == key
+            #
+        #
+        return result
+    #
+    def add(self, data_file, signature_file):
+        '''
+        Records a successful verification.
+
+        data_file        --   path to the signed file
+        signature_file   --   path to the detached signature
+        '''
+        try:
+            key = self.make_key(data_file, signature_file)
+        except OSError:
+            key = None
+        #
+        if key:
+            with self.lock:
+                self.entries[os.path.abspath(data_file)] = key
+                self.dirty = True
+            #
+        #
+    #
+    def save(self):
+        '''
+        Writes the cache file if it has changed, dropping entries for files that no longer exist.
+        '''
+        with self.lock:
+            if self.dirty:
+                entries = {}
+                for name in self.entries:
+                    if os.path.exists(name):
+                        entries[name] = self.entries[name]
+                    #
+                #
+                data = { 'fingerprint': self.fingerprint, 'entries': entries }
+
+                try:
+                    atomic_write(self.path, json.dumps(data))
+                    self.entries = entries
+                    self.dirty = False
+                except OSError as e:
+                    self.log.error('Unable to write verification cache %s: %s', self.path, e)
+                #
+            #
+        #
+    #
+#
+
+
+class DigestCache:
+    '''
+    Remembers the MD5 digests of files that have passed their checksum tests, so that unchanged cached files do not
+    need to be read again on every run. An entry matches only if the file still has the same inode, modification time,
+    and size (as in VerificationCache).
+    '''
+    def __init__(self, path):
+        '''
+        Constructor.
+
+        path   --   path to the cache file
+        '''
+        self.path = pathlib.PosixPath(path)
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.log = logging.getLogger(__name__)
+
+        if self.path.exists():
+            try:
+                with open(self.path, 'r') as fh:
+                    self.entries = json.load(fh)
+                #
+            except (OSError, ValueError) as e:
+                self.log.warning('Ignoring unreadable digest cache %s: %s', self.path, e)
+            #
+        #
+    #
+    def check(self, path):
+        '''
+        Returns the recorded MD5 digest of a file, or None if the file is not recorded or has changed since.
+
+        path   --   path to the file
+        '''
+        result = None
+        try:
+            key = file_key(path)
+        except OSError:
+            key = None
+        #
+        with self.lock:
+            entry = self.entries.get(os.path.abspath(path))
+        #
+        if key and entry and entry[:3] == key:
+            result = entry[3]
+        #
+        return result
+    #
+    def add(self, path, digest):
+        '''
+        Records the MD5 digest of a file that has passed its checksum test.
+
+        path     --   path to the file
+        digest   --   MD5 digest of the file
+        '''
+        try:
+            entry = file_key(path) + [ digest ]
+        except OSError:
+            entry = None
+        #
+        if entry:
+            with self.lock:
+                name = os.path.abspath(path)
+                if self.entries.get(name) != entry:
+                    self.entries[name] = entry
+                    self.dirty = True
+                #
+            #
+        #
+    #
+    def save(self):
+        '''
+        Writes the cache file if it has changed, dropping entries for files that no longer exist.
+        '''
+        with self.lock:
+            if self.dirty:
+                entries = { name: self.entries[name] for name in self.entries if os.path.exists(name) }
+                try:
+                    atomic_write(self.path, json.dumps(entries))
+                    self.entries = entries
+                    self.dirty = False
+                except OSError as e:
+                    self.log.error('Unable to write digest cache %s: %s', self.path, e)
+                #
+            #
+        #
+    #
+#
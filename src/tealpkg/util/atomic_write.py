@@ -0,0 +1,51 @@
+# Atomic replacement of small state files.
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import os
+import pathlib
+import tempfile
+
+
+def atomic_write(path, text, mode=0o644):
+    '''
+    Writes text to a file by writing a temporary file in the same directory and renaming it into place, so that
+    readers never see a partially written file. Raises OSError if the file cannot be written.
+
+    path   --   path to the file
+    text   --   text to write
+    mode   --   permissions of the new file
+    '''
+    target = pathlib.PosixPath(path)
+    target.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(dir=target.parent.as_posix(), prefix='.' + target.name + '.')
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(text)
+        #
+        os.chmod(temp_name, mode)
+        os.replace(temp_name, target.as_posix())
+    except OSError:
+        pathlib.PosixPath(temp_name).unlink(missing_ok=True)
+        raise
+    #
+#
@@ -0,0 +1,58 @@
+# Incremental file digest computation.
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import hashlib
+
+
+BLOCK_SIZE = 1 << 20
+
+
+def update_digest(md, path):
+    '''
+    Updates a hashlib object with the contents of a file, which is read in fixed-size blocks.
+
+    md     --   hashlib object to update
+    path   --   path to the file
+    '''
+    with open(path, 'rb') as fh:
+        block = fh.read(BLOCK_SIZE)
+        while block:
+            md.update(block)
+            block = fh.read(BLOCK_SIZE)
+        #
+    #
+#
+
+
+def file_digest(path, algorithm='md5'):
+    '''
+    Returns the hexadecimal digest of a file, which is read in fixed-size blocks so that large files are never held
+    in memory all at once.
+
+    path        --   path to the file
+    algorithm   --   name of the hashlib algorithm to use
+    '''
+    md = hashlib.new(algorithm)
+    update_digest(md, path)
+    return md.hexdigest().lower()
+#
@@ -0,0 +1,144 @@
+# Advisory file locks (flock) with shared and exclusive modes.
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import fcntl
+import logging
+import os
+import time
+
+from tealpkg.cli.colorprint import cprint
+from tealpkg.util.metrics import get_metrics
+
+
+# Interval between attempts when waiting for a lock with a timeout
+RETRY_INTERVAL = 0.1
+
+
+class FileLock:
+    '''
+    Advisory lock on a file, held through an open file descriptor with flock(). Any number of processes may hold a
+    shared lock at once, while an exclusive lock excludes all others. Locks are released automatically by the kernel
+    when the process exits, so a crashed process never leaves a stale lock behind.
+    '''
+    def __init__(self, path, name='lock', timeout=-1):
+        '''
+        Constructor.
+
+        path      --   path to the lock file (created if necessary, and never removed)
+        name      --   name of the lock, for messages and metrics
+        timeout   --   seconds to wait for the lock (0 to fail immediately, negative to wait indefinitely)
+        '''
+        self.path = path
+        self.name = name
+        self.timeout = timeout
+        self.fd = None
+        self.mode = None
+        self.log = logging.getLogger(__name__)
+    #
+    def try_lock(self, operation):
+        result = True
+        try:
+            fcntl.flock(self.fd, operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            result = False
+        #
+        return result
+    #
+    def wait(self, operation):
+        '''
+        Blocks until the lock is obtained or the timeout expires. Returns True if the lock was obtained.
+
+        operation   --   fcntl.LOCK_SH or fcntl.LOCK_EX
+        '''
+        result = False
+        if self.timeout < 0:
+            fcntl.flock(self.fd, operation)
+            result = True
+        else:
+            deadline = time.monotonic() + self.timeout
+            result = self.try_lock(operation)
+            while not result and time.monotonic() < deadline:
+                time.sleep(RETRY_INTERVAL)
+                result = self.try_lock(operation)
+            #
+        #
+        return result
+    #
+    def acquire(self, exclusive=True):
+        '''
+        Obtains the lock in shared or exclusive mode, waiting (up to the timeout) if another process holds a
+        conflicting lock. A lock already held by this object is converted to the requested mode. The time spent
+        waiting is logged and recorded in the tealpkg_lock_wait_seconds metric. Returns True if the lock was obtained.
+
+        exclusive   --   True for an exclusive (writer) lock, False for a shared (reader) lock
+        '''
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        #
+
+        start = time.monotonic()
+        result = self.try_lock(operation)
+        if not result and self.timeout != 0:
+            cprint('Waiting for the', self.name, 'lock held by another tealpkg process...', style='notice', \
+                    stderr=True)
+            result = self.wait(operation)
+        #
+        waited = time.monotonic() - start
+
+        get_metrics().set('tealpkg_lock_wait_seconds', waited, 'Time spent waiting for a lock', lock=self.name)
+        if result:
+            self.mode = 'exclusive' if exclusive else 'shared'
+            if waited >= RETRY_INTERVAL:
+                self.log.info('Waited %.1f seconds for the %s %s lock', waited, self.mode, self.name)
+            #
+        else:
+            self.log.error('Timed out after %.1f seconds waiting for the %s lock', waited, self.name)
+
+            # Converting a lock may drop the old lock before failing, so try to restore it
+            if self.mode and not self.try_lock(fcntl.LOCK_EX if self.mode == 'exclusive' else fcntl.LOCK_SH):
+                self.mode = None
+            #
+        #
+
+        return result
+    #
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+            self.mode = None
+        #
+    #
+    def write_pid(self):
+        '''
+        Records the process ID in the lock file, for the information of administrators. The lock itself does not
+        depend on the contents of the file.
+        '''
+        if self.fd is not None:
+            os.ftruncate(self.fd, 0)
+            os.pwrite(self.fd, (str(os.getpid()) + '\n').encode(), 0)
+        #
+    #
+#
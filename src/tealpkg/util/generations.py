@@ -0,0 +1,157 @@
+# Immutable directory generations published by an atomic symbolic link swap.
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import logging
+import os
+import pathlib
+import re
+import shutil
+
+
+# Generation directories are named gen-<number>
+GENERATION_NAME = re.compile(r'^gen-([0-9]+)$')
+
+
+class Generations:
+    '''
+    Immutable snapshots ("generations") of a set of files, kept in numbered gen-N subdirectories of a base directory.
+    The published generation is named by the "current" symbolic link in the base directory. A new generation is
+    prepared beside the published one, seeded with hard links to its files, and then published by renaming a new
+    link over the old one. Since the swap is a single rename, a reader that resolves the link once always sees one
+    complete generation, even while another is being prepared. Files in a generation must therefore only ever be
+    replaced by renaming, and never rewritten in place, since they may be shared with other generations.
+    '''
+    def __init__(self, base, keep=1):
+        '''
+        Constructor.
+
+        base   --   directory holding the generations
+        keep   --   number of generations older than the published one to keep for readers still using them
+        '''
+        self.base = pathlib.PosixPath(base)
+        self.link = self.base.joinpath('current')
+        self.keep = keep
+        self.log = logging.getLogger(__name__)
+    #
+    def current(self):
+        '''
+        Returns the path to the published generation, or None if no generation has been published.
+        '''
+        result = None
+        try:
+            path = self.base.joinpath(os.readlink(self.link))
+            if path.is_dir():
+                result = path
+            #
+        except OSError:
+            pass
+        #
+        return result
+    #
+    def numbered(self):
+        '''
+        Returns a list of (number, path) tuples for all the generation directories, published or not, in order.
+        '''
+        result = []
+        if self.base.is_dir():
+            for path in self.base.iterdir():
+                match = GENERATION_NAME.match(path.name)
+                if match and path.is_dir() and not path.is_symlink():
+                    result.append( (int(match.group(1)), path) )
+            #####
+        #
+        result.sort()
+        return result
+    #
+    def create(self):
+        '''
+        Creates a new, unpublished generation, containing hard links to the files in the published generation (if
+        any), so that unchanged files are neither copied nor downloaded again. Returns the path to the generation.
+        '''
+        self.base.mkdir(mode=0o755, parents=True, exist_ok=True)
+        number = max( [ number for number, path in self.numbered() ], default=0 )
+
+        result = None
+        while result is None:
+            number += 1
+            try:
+                path = self.base.joinpath('gen-' + str(number))
+                path.mkdir(mode=0o755)
+                result = path
+            except FileExistsError:
+                pass
+            #
+        #
+
+        current = self.current()
+        if current:
+            for item in current.iterdir():
+                if item.is_file() and not item.is_symlink() and not item.name.endswith('.part'):
+                    os.link(item, result.joinpath(item.name))
+        #####
+
+        self.log.debug('Created generation %s', result)
+        return result
+    #
+    def publish(self, path):
+        '''
+        Makes a generation the published one, by atomically replacing the current link.
+
+        path   --   path to the generation, as returned by create()
+        '''
+        temp = self.base.joinpath('.current.' + str(os.getpid()) + '.tmp')
+        temp.unlink(missing_ok=True)
+        temp.symlink_to(pathlib.PosixPath(path).name)
+        os.replace(temp, self.link)
+        self.log.debug('Published generation %s', path)
+    #
+    def discard(self, path):
+        '''
+        Removes an unpublished generation.
+
+        path   --   path to the generation, as returned by create()
+        '''
+        shutil.rmtree(path, ignore_errors=True)
+    #
+    def collect(self):
+        '''
+        Garbage-collects old generations, keeping the published generation and the newest keep generations before
+        it. Generations newer than the published one are never removed, since another process may still be preparing
+        them, but one left over from an interrupted refresh becomes older than the published generation (and so is
+        removed) once a later refresh is published. Returns the number of generations removed.
+        '''
+        result = 0
+        current = self.current()
+        match = GENERATION_NAME.match(current.name) if current else None
+        if match:
+            published = int(match.group(1))
+            older = [ path for number, path in self.numbered() if number < published ]
+            for path in older[:max(0, len(older) - self.keep)]:
+                self.log.debug('Removing generation %s', path)
+                shutil.rmtree(path, ignore_errors=True)
+                result += 1
+            #
+        #
+        return result
+    #
+#
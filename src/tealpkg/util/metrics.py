@@ -0,0 +1,168 @@
+# Run metrics collection and export (Prometheus textfile collector and JSON).
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import json
+import logging
+import threading
+import time
+
+from tealpkg.util.atomic_write import atomic_write
+
+
+class Metrics:
+    '''
+    Collects metrics about a single run of the program, such as the number of bytes downloaded from each mirror. All
+    metrics are gauges that describe the most recent run, since the output files are rewritten after every run. When
+    no output file is configured, the collection methods return immediately.
+    '''
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if Metrics.__instance is None:
+            Metrics.__instance = Metrics()
+        #
+        return Metrics.__instance
+    #
+    def __init__(self):
+        '''
+        Constructor.
+        '''
+        self.enabled = False
+        self.textfile_path = None
+        self.json_path = None
+        self.families = {}     # name: { 'help': text, 'samples': { label tuple: value } }
+        self.lock = threading.Lock()
+        self.log = logging.getLogger(__name__)
+    #
+    def enable(self, textfile_path=None, json_path=None):
+        '''
+        Enables metrics collection if at least one output path is given.
+
+        textfile_path   --   path to the Prometheus textfile collector output (should end in .prom)
+        json_path       --   path to the JSON output
+        '''
+        self.textfile_path = textfile_path
+        self.json_path = json_path
+        self.enabled = bool(textfile_path or json_path)
+    #
+    def sample(self, name, help_text, labels):
+        if name not in self.families:
+            self.families[name] = { 'help': help_text, 'samples': {} }
+        #
+        return self.families[name]['samples'], tuple(sorted(labels.items()))
+    #
+    def add(self, name, value, help_text='', **labels):
+        '''
+        Adds a value to a metric, starting from zero if the metric (with the given labels) has not been seen.
+
+        name        --   metric name
+        value       --   amount to add
+        help_text   --   description of the metric
+        labels      --   label names and values
+        '''
+        if self.enabled:
+            with self.lock:
+                samples, key = self.sample(name, help_text, labels)
+                samples[key] = samples.get(key, 0) + value
+            #
+        #
+    #
+    def set(self, name, value, help_text='', **labels):
+        '''
+        Sets the value of a metric.
+
+        name        --   metric name
+        value       --   new value
+        help_text   --   description of the metric
+        labels      --   label names and values
+        '''
+        if self.enabled:
+            with self.lock:
+                samples, key = self.sample(name, help_text, labels)
+                samples[key] = value
+            #
+        #
+    #
+    def format_prometheus(self):
+        lines = []
+        for name in sorted(self.families):
+            family = self.families[name]
+            lines.append('# HELP ' + name + ' ' + family['help'])
+            lines.append('# TYPE ' + name + ' gauge')
+            for key in sorted(family['samples']):
+                labels = ''
+                if key:
+                    pairs = []
+                    for label, value in key:
+                        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                        pairs.append(label + '="' + escaped + '"')
+                    #
+                    labels = '{' + ','.join(pairs) + '}'
+                #
+                lines.append(name + labels + ' ' + repr(float(family['samples'][key])))
+            #
+        #
+        return '\n'.join(lines) + '\n'
+    #
+    def format_json(self):
+        data = { 'timestamp': time.time(), 'metrics': {} }
+        for name in sorted(self.families):
+            family = self.families[name]
+            samples = []
+            for key in sorted(family['samples']):
+                samples.append({ 'labels': dict(key), 'value': family['samples'][key] })
+            #
+            data['metrics'][name] = { 'help': family['help'], 'samples': samples }
+        #
+        return json.dumps(data, indent=2, sort_keys=True) + '\n'
+    #
+    def write_file(self, path, text):
+        # Write to a temporary file and rename it into place, so that a collector never sees a partial file
+        try:
+            atomic_write(path, text)
+        except OSError as e:
+            self.log.error('Unable to write metrics to %s: %s', path, e)
+        #
+    #
+    def write(self):
+        '''
+        Writes the collected metrics to the configured output files.
+        '''
+        if self.enabled:
+            with self.lock:
+                if self.textfile_path:
+                    self.write_file(self.textfile_path, self.format_prometheus())
+                #
+                if self.json_path:
+                    self.write_file(self.json_path, self.format_json())
+                #
+            #
+        #
+    #
+#
+
+
+def get_metrics():
+    return Metrics.get_instance()
+#
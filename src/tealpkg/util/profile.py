@@ -0,0 +1,199 @@
+# Lightweight phase profiler: wall time, CPU time, and peak traced memory.
+#
+# Copyright 2022 Coastal Carolina University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import contextlib
+import cProfile
+import functools
+import logging
+import threading
+import time
+import tracemalloc
+
+
+# Shared do-nothing context manager, returned whenever profiling is disabled
+NULL_SPAN = contextlib.nullcontext()
+
+
+class PhaseStats:
+    '''
+    Accumulated measurements for one named phase.
+    '''
+    def __init__(self, name):
+        '''
+        Constructor.
+
+        name   --   name of the phase
+        '''
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak = 0
+    #
+#
+
+
+class Profiler:
+    '''
+    Records wall time, CPU time, and the peak traced memory for named phases of a run. Phases are measured using
+    the span() context manager. When the profiler is disabled, span() returns a shared null context, so that the
+    instrumentation hooks cost nothing beyond a method call.
+    '''
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if Profiler.__instance is None:
+            Profiler.__instance = Profiler()
+        #
+        return Profiler.__instance
+    #
+    def __init__(self):
+        '''
+        Constructor.
+        '''
+        self.enabled = False
+        self.phases = {}
+        self.stack = []       # [ name, peak ] for each active span
+        self.active = set()
+        self.stats_path = None
+        self.cprofile = None
+        self.log = logging.getLogger(__name__)
+    #
+    def enable(self, stats_path=None):
+        '''
+        Starts profiling. Memory tracing (tracemalloc) is started, which slows down allocation-heavy code, so the
+        profiler should only be enabled on request.
+
+        stats_path   --   optional path to which cProfile statistics are dumped when profiling is disabled
+        '''
+        if not self.enabled:
+            self.enabled = True
+            tracemalloc.start()
+            if stats_path:
+                self.stats_path = stats_path
+                self.cprofile = cProfile.Profile()
+                self.cprofile.enable()
+            #
+        #
+    #
+    def disable(self):
+        '''
+        Stops profiling, logs the accumulated phase statistics, and writes the cProfile statistics file (if one
+        was requested).
+        '''
+        if self.enabled:
+            if self.cprofile:
+                self.cprofile.disable()
+                self.cprofile.dump_stats(self.stats_path)
+                self.log.info('Wrote cProfile statistics to %s', self.stats_path)
+            #
+            tracemalloc.stop()
+            self.enabled = False
+
+            for phase in self.phases.values():
+                self.log.info('Profile %s: calls=%d wall=%.3fs cpu=%.3fs peak=%d bytes', phase.name, phase.calls, \
+                        phase.wall, phase.cpu, phase.peak)
+            #
+        #
+    #
+    def span(self, name):
+        '''
+        Returns a context manager that measures the enclosed block as part of the named phase. Repeated calls with
+        the same name accumulate into the same phase. A span nested inside an active span of the same name is not
+        counted again. Only spans on the main thread are measured, since the span stack is not thread-safe.
+
+        name   --   name of the phase
+        '''
+        result = NULL_SPAN
+        if self.enabled and name not in self.active and threading.current_thread() is threading.main_thread():
+            result = self.measure(name)
+        #
+        return result
+    #
+    @contextlib.contextmanager
+    def measure(self, name):
+        if name not in self.phases:
+            self.phases[name] = PhaseStats(name)
+        #
+        phase = self.phases[name]
+
+        # tracemalloc only keeps a single global peak, so save the peak seen so far by the enclosing span before
+        # resetting it for this one
+        if self.stack:
+            self.stack[-1][1] = max(self.stack[-1][1], tracemalloc.get_traced_memory()[1])
+        #
+        tracemalloc.reset_peak()
+        frame = [ name, 0 ]
+        self.stack.append(frame)
+        self.active.add(name)
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield phase
+        finally:
+            phase.wall += time.perf_counter() - wall_start
+            phase.cpu += time.process_time() - cpu_start
+            phase.calls += 1
+
+            peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+            phase.peak = max(phase.peak, peak)
+            self.stack.pop()
+            self.active.discard(name)
+            if self.stack:
+                self.stack[-1][1] = max(self.stack[-1][1], peak)
+            #
+        #
+    #
+#
+
+
+def get_profiler():
+    return Profiler.get_instance()
+#
+
+def profile_span(name):
+    return Profiler.get_instance().span(name)
+#
+
+
+def profiled(name):
+    '''
+    Decorator that measures every call of the decorated function as part of the named phase, as if its body were
+    enclosed in profile_span(name).
+
+    name   --   name of the phase
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profile_span(name):
+                result = function(*args, **kwargs)
+            #
+            return result
+        #
+        return wrapper
+    #
+    return decorator
+#
@@ -21,46 +21,144 @@
 # IN THE SOFTWARE.
 
 
+
+import codecs
 import logging
+import os
+import selectors
 import subprocess
 import sys
-import tempfile
-import time
 
 
-def log_run(args, quiet=False, log_output=False):
-    status = 1
+# Size of each read from the output pipe
+READ_SIZE = 65536
 
-    with tempfile.NamedTemporaryFile() as temp:
-        with open(temp.name, 'w') as wfh, open(temp.name, 'r') as rfh:
-            # For the subprocess, set start_new_session=True to make a setsid call prior to the exec. This
-            # way, the subprocess doesn't receive SIGHUP if tealpkg is run via SSH and the connection drops.
-            proc = subprocess.Popen(args, stdout=wfh, stderr=subprocess.STDOUT, text=True, bufsize=1, \
-                                    start_new_session=True)
-            while proc.poll() is None:
-                if not quiet:
-                    sys.stdout.write(rfh.read())
-                #
-                time.sleep(0.1)
+# Longest partial line held for the log before it is written out anyway, which bounds the memory used
+MAX_LINE = 65536
+
+
+class OutputHandler:
+    def __init__(self, quiet, log_output, on_output):
+        '''
+        Constructor. Passes the output of a process to the terminal, the log, and an optional callback as it arrives.
+
+        quiet        --   do not write the output to stdout
+        log_output   --   write the output to the log, one line at a time
+        on_output    --   optional callback, called with each chunk of decoded output
+        '''
+        self.quiet = quiet
+        self.log_output = log_output
+        self.on_output = on_output
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.partial = ''
+        self.log = logging.getLogger(__name__)
+    #
+    def write(self, data, final=False):
+        text = self.decoder.decode(data, final)
+        if text:
+            if not self.quiet:
+                sys.stdout.write(text)
+                sys.stdout.flush()
             #
-            status = proc.returncode
-            if not quiet:
-                # Capture any remaining that was written while sleeping
-                sys.stdout.write(rfh.read())
+            if self.on_output:
+                self.on_output(text)
             #
+            if self.log_output:
+                lines = (self.partial + text).split('\n')
+                self.partial = lines.pop()
+                if len(self.partial) > MAX_LINE:
+                    lines.append(self.partial)
+                    self.partial = ''
+                #
+                for line in lines:
+                    self.log.info(line)
+                #
+            #
+        #
+        if final and self.log_output and self.partial:
+            self.log.info(self.partial)
+            self.partial = ''
         #
+    #
+#
 
-        if log_output:
-            data = ''
-            with open(temp.name, 'r') as fh:
-                data = fh.read()
-            #
 
-            logger = logging.getLogger(__name__)
-            logger.info('Executed: %s', ' '.join(args))
-            logger.info(data)
+def drain(fd, handler):
+    # Reads whatever output remains in the pipe without blocking (a background process started by the command may
+    # still hold the write end open, so end-of-file cannot be relied upon)
+    os.set_blocking(fd, False)
+    try:
+        data = os.read(fd, READ_SIZE)
+        while data:
+            handler.write(data)
+            data = os.read(fd, READ_SIZE)
         #
+    except BlockingIOError:
+        pass
+    #
+#
+
+
+def log_run(args, quiet=False, log_output=False, cwd=None, on_output=None):
+    status = 1
+    handler = OutputHandler(quiet, log_output, on_output)
+    if log_output:
+        logging.getLogger(__name__).info('Executed: %s', ' '.join(args))
+    #
+
+    # For the subprocess, set start_new_session=True to make a setsid call prior to the exec. This
+    # way, the subprocess doesn't receive SIGHUP if tealpkg is run via SSH and the connection drops.
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True, cwd=cwd)
+    fd = proc.stdout.fileno()
+
+    # The output pipe and (where supported) a pidfd for the process are watched together, so that the output is
+    # passed on as soon as it arrives and the exit of the process is noticed without polling.
+    pidfd = None
+    if hasattr(os, 'pidfd_open'):
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+        except OSError:
+            pass   # kernel without pidfd support
+        #
+    #
+
+    with selectors.DefaultSelector() as selector:
+        selector.register(fd, selectors.EVENT_READ, 'output')
+        if pidfd is not None:
+            selector.register(pidfd, selectors.EVENT_READ, 'exit')
+        #
+
+        running = True
+        while running:
+            # Without a pidfd, wake up once a second to check for a process that exited while its background
+            # children keep the pipe open
+            events = selector.select(None if pidfd is not None else 1.0)
+            for key, mask in events:
+                if running and key.data == 'output':
+                    data = os.read(fd, READ_SIZE)
+                    if data:
+                        handler.write(data)
+                    else:
+                        running = False
+                    #
+                elif running:
+                    drain(fd, handler)
+                    running = False
+                #
+            #
+            if running and pidfd is None and proc.poll() is not None:
+                drain(fd, handler)
+                running = False
+            #
+        #
+    #
+
+    if pidfd is not None:
+        os.close(pidfd)
     #
+    proc.stdout.close()
+    status = proc.wait()
+    handler.write(b'', final=True)
 
     return status
 #